@@ -1,32 +1,166 @@
 # Copyright (C) @Wolfy004
 # Channel: https://t.me/Wolfy004
 
+import math
 from functools import wraps
+from time import monotonic
+from typing import Optional
 from pyrogram.types import Message
 from database import db
+from client_pool import user_client_pool
+from config import PyroConf
 from logger import LOGGER
 
+class AuthContext:
+    """Authorization state of one update, shared by decorators and handlers"""
+    
+    def __init__(self, user_id: int, snapshot: dict):
+        self.user_id = user_id
+        self.user = snapshot['user']
+        self.user_type = snapshot['user_type']
+        self.is_admin = snapshot['is_admin']
+        self.is_banned = snapshot['is_banned']
+        self.daily_usage = snapshot['daily_usage']
+
+async def get_auth_context(message: Message) -> AuthContext:
+    """Register the sender and load their authorization state once per update"""
+    context = getattr(message, "_auth_context", None)
+    if context is not None:
+        return context
+    
+    user_id = message.from_user.id
+    
+    # Add user to database if not exists
+    await db.aadd_user(
+        user_id=user_id,
+        username=message.from_user.username,
+        first_name=message.from_user.first_name,
+        last_name=message.from_user.last_name
+    )
+    
+    context = AuthContext(user_id, await db.aget_auth_snapshot(user_id))
+    message._auth_context = context
+    return context
+
+class RateLimited(Exception):
+    """A download request was rejected, retry_after is in seconds"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class _UserGate:
+    """Token bucket and running job count of one user"""
+    
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.in_flight = 0
+    
+    def refill(self, rate_per_minute: float, burst: int):
+        """Add the tokens earned since the last call, under the user's current tier"""
+        now = monotonic()
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate_per_minute / 60)
+        self.updated = now
+    
+    def idle(self) -> bool:
+        self.refill(self.rate_per_minute, self.burst)
+        return not self.in_flight and self.tokens >= self.burst
+
+class DownloadAdmission:
+    """Per-user, per-tier admission control in front of download jobs.
+    
+    Requests are stored as jobs first, so the jobs table is the user's
+    queue: once max_queued of them are waiting new requests are rejected
+    with a retry-after estimate. A job is only started once the user has
+    a token and a free in-flight slot, otherwise the worker puts it back
+    for the time try_acquire returns.
+    """
+    
+    def __init__(self, limits: dict, max_idle_gates: int = 10000, busy_retry: float = 5):
+        self.limits = limits
+        self.max_idle_gates = max_idle_gates
+        self.busy_retry = busy_retry
+        self._gates = {}
+    
+    def _limits(self, user_type: str) -> tuple:
+        return self.limits.get(user_type, self.limits['free'])
+    
+    def _gate(self, user_id: int, rate_per_minute: float, burst: int) -> _UserGate:
+        gate = self._gates.get(user_id)
+        if gate is None:
+            if len(self._gates) >= self.max_idle_gates:
+                # Forgetting an idle user with a full bucket grants nothing
+                for other_id in [other_id for other_id, other in self._gates.items() if other.idle()]:
+                    del self._gates[other_id]
+            gate = self._gates[user_id] = _UserGate(rate_per_minute, burst)
+        return gate
+    
+    def try_acquire(self, user_id: int, user_type: str) -> Optional[float]:
+        """Take a job slot, or return the seconds after which to try again"""
+        rate_per_minute, burst, max_in_flight, _ = self._limits(user_type)
+        gate = self._gate(user_id, rate_per_minute, burst)
+        gate.refill(rate_per_minute, burst)
+        if gate.in_flight < max_in_flight and gate.tokens >= 1:
+            gate.tokens -= 1
+            gate.in_flight += 1
+            return None
+        # A running job may end any moment, the next token is due at a known time
+        token_wait = max(0.0, (1 - gate.tokens) * 60 / rate_per_minute)
+        return max(token_wait, self.busy_retry) if gate.in_flight >= max_in_flight else token_wait
+    
+    def release(self, user_id: int):
+        """Free the slot taken by try_acquire"""
+        gate = self._gates.get(user_id)
+        if gate is not None:
+            gate.in_flight -= 1
+    
+    def check_queue(self, user_id: int, user_type: str, waiting: int):
+        """Raise RateLimited once the user has more than max_queued jobs waiting"""
+        rate_per_minute, burst, _, max_queued = self._limits(user_type)
+        if waiting <= max_queued:
+            return
+        gate = self._gate(user_id, rate_per_minute, burst)
+        gate.refill(rate_per_minute, burst)
+        # Time until the other waiting jobs and this one have tokens
+        missing = waiting - gate.tokens
+        raise RateLimited(max(1, math.ceil(missing * 60 / rate_per_minute)))
+    
+    def snapshot(self, user_id: int, user_type: str, queued: int = 0) -> dict:
+        """Current counts and limits of a user, for /myinfo"""
+        rate_per_minute, burst, max_in_flight, max_queued = self._limits(user_type)
+        gate = self._gates.get(user_id)
+        if gate is not None:
+            gate.refill(rate_per_minute, burst)
+        return {
+            'in_flight': gate.in_flight if gate else 0,
+            'queued': queued,
+            'tokens': int(gate.tokens) if gate else burst,
+            'rate_per_minute': rate_per_minute,
+            'burst': burst,
+            'max_in_flight': max_in_flight,
+            'max_queued': max_queued
+        }
+
+download_admission = DownloadAdmission(PyroConf.RATE_LIMITS)
+
 def admin_only(func):
     """Decorator to restrict command to admins only"""
     @wraps(func)
     async def wrapper(client, message: Message):
-        user_id = message.from_user.id
-        
-        # Add user to database if not exists
-        db.add_user(
-            user_id=user_id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
+        context = await get_auth_context(message)
         
         # Check if banned
-        if db.is_banned(user_id):
+        if context.is_banned:
             await message.reply("❌ **You are banned from using this bot.**")
             return
         
         # Check admin status
-        if not db.is_admin(user_id):
+        if not context.is_admin:
             await message.reply("❌ **This command is restricted to administrators only.**")
             return
         
@@ -37,23 +171,14 @@ def paid_or_admin_only(func):
     """Decorator to restrict command to paid users and admins"""
     @wraps(func)
     async def wrapper(client, message: Message):
-        user_id = message.from_user.id
-        
-        # Add user to database if not exists
-        db.add_user(
-            user_id=user_id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
+        context = await get_auth_context(message)
         
         # Check if banned
-        if db.is_banned(user_id):
+        if context.is_banned:
             await message.reply("❌ **You are banned from using this bot.**")
             return
         
-        user_type = db.get_user_type(user_id)
-        if user_type not in ['paid', 'admin']:
+        if context.user_type not in ['paid', 'admin']:
             await message.reply(
                 "❌ **This feature is available for premium users only.**\n\n"
                 "💎 **Upgrade to Premium:**\n"
@@ -71,30 +196,21 @@ def check_download_limit(func):
     """Decorator to check download limits for free users"""
     @wraps(func)
     async def wrapper(client, message: Message):
-        user_id = message.from_user.id
-        
-        # Add user to database if not exists
-        db.add_user(
-            user_id=user_id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
+        context = await get_auth_context(message)
         
         # Check if banned
-        if db.is_banned(user_id):
+        if context.is_banned:
             await message.reply("❌ **You are banned from using this bot.**")
             return
         
         # Check download limits
-        can_download, message_text = db.can_download(user_id)
+        can_download, message_text = db.check_quota(context.user_type, context.daily_usage)
         if not can_download:
             await message.reply(f"❌ **{message_text}**")
             return
         
         # Show remaining downloads for free users
-        user_type = db.get_user_type(user_id)
-        if user_type == 'free' and message_text:
+        if context.user_type == 'free' and message_text:
             await message.reply(f"ℹ️ {message_text}")
         
         return await func(client, message)
@@ -104,18 +220,10 @@ def register_user(func):
     """Decorator to register user in database"""
     @wraps(func)
     async def wrapper(client, message: Message):
-        user_id = message.from_user.id
-        
-        # Add user to database if not exists
-        db.add_user(
-            user_id=user_id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
+        context = await get_auth_context(message)
         
         # Check if banned
-        if db.is_banned(user_id):
+        if context.is_banned:
             await message.reply("❌ **You are banned from using this bot.**")
             return
         
@@ -124,26 +232,23 @@ def register_user(func):
 
 async def check_user_session(user_id: int):
     """Check if user has their own session string"""
-    session = db.get_user_session(user_id)
+    session = await db.aget_user_session(user_id)
     return session is not None
 
 async def get_user_client(user_id: int):
-    """Get user's personal client if they have session"""
-    session = db.get_user_session(user_id)
+    """Get user's personal client if they have session (pass it to release_user_client when done)"""
+    session = await db.aget_user_session(user_id)
     if session:
-        from pyrogram import Client
-        from config import PyroConf
-        
-        try:
-            user_client = Client(
-                f"user_{user_id}", 
-                api_id=PyroConf.API_ID,
-                api_hash=PyroConf.API_HASH,
-                session_string=session
-            )
-            await user_client.start()
-            return user_client
-        except Exception as e:
-            LOGGER(__name__).error(f"Failed to start user client for {user_id}: {e}")
-            return None
-    return None
\ No newline at end of file
+        return await user_client_pool.acquire(user_id, session)
+    return None
+
+async def release_user_client(user_client):
+    """Hand a client from get_user_client back to the pool"""
+    if user_client:
+        await user_client_pool.release(user_client)
+
+async def update_user_session(user_id: int, session_string: str = None) -> bool:
+    """Store a new session (None to logout) and drop the client of the old one"""
+    updated = await db.aset_user_session(user_id, session_string)
+    await user_client_pool.invalidate(user_id)
+    return updated
@@ -4,8 +4,12 @@
 import asyncio
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from access_control import admin_only, register_user
-from database import db
+from access_control import admin_only, register_user, get_auth_context, download_admission
+from database import db, FREE_DAILY_LIMIT
+from client_pool import user_client_pool
+from scheduler import transfer_scheduler
+from resources import resource_admission
+from helpers.files import get_readable_time, get_readable_file_size
 from logger import LOGGER
 
 @admin_only
@@ -19,7 +23,7 @@ async def add_admin_command(client: Client, message: Message):
         target_user_id = int(message.command[1])
         admin_user_id = message.from_user.id
         
-        if db.add_admin(target_user_id, admin_user_id):
+        if await db.aadd_admin(target_user_id, admin_user_id):
             # Try to get user info
             try:
                 user_info = await client.get_users(target_user_id)
@@ -48,7 +52,7 @@ async def remove_admin_command(client: Client, message: Message):
         
         target_user_id = int(message.command[1])
         
-        if db.remove_admin(target_user_id):
+        if await db.aremove_admin(target_user_id):
             await message.reply(f"✅ **Successfully removed admin privileges from user {target_user_id}.**")
             LOGGER(__name__).info(f"Admin {message.from_user.id} removed admin privileges from {target_user_id}")
         else:
@@ -72,7 +76,7 @@ async def set_premium_command(client: Client, message: Message):
         target_user_id = int(args[0])
         days = int(args[1]) if len(args) > 1 else 30
         
-        if db.set_user_type(target_user_id, 'paid', days):
+        if await db.aset_user_type(target_user_id, 'paid', days):
             await message.reply(f"✅ **Successfully upgraded user {target_user_id} to premium for {days} days.**")
             LOGGER(__name__).info(f"Admin {message.from_user.id} set {target_user_id} as premium for {days} days")
         else:
@@ -93,7 +97,7 @@ async def remove_premium_command(client: Client, message: Message):
         
         target_user_id = int(message.command[1])
         
-        if db.set_user_type(target_user_id, 'free'):
+        if await db.aset_user_type(target_user_id, 'free'):
             await message.reply(f"✅ **Successfully downgraded user {target_user_id} to free plan.**")
             LOGGER(__name__).info(f"Admin {message.from_user.id} removed premium from {target_user_id}")
         else:
@@ -118,11 +122,11 @@ async def ban_user_command(client: Client, message: Message):
             await message.reply("❌ **You cannot ban yourself.**")
             return
         
-        if db.is_admin(target_user_id):
+        if await db.ais_admin(target_user_id):
             await message.reply("❌ **Cannot ban another admin.**")
             return
         
-        if db.ban_user(target_user_id):
+        if await db.aban_user(target_user_id):
             await message.reply(f"✅ **Successfully banned user {target_user_id}.**")
             LOGGER(__name__).info(f"Admin {message.from_user.id} banned {target_user_id}")
         else:
@@ -143,7 +147,7 @@ async def unban_user_command(client: Client, message: Message):
         
         target_user_id = int(message.command[1])
         
-        if db.unban_user(target_user_id):
+        if await db.aunban_user(target_user_id):
             await message.reply(f"✅ **Successfully unbanned user {target_user_id}.**")
             LOGGER(__name__).info(f"Admin {message.from_user.id} unbanned {target_user_id}")
         else:
@@ -193,7 +197,7 @@ async def broadcast_command(client: Client, message: Message):
 
 async def execute_broadcast(client: Client, admin_id: int, broadcast_message: str):
     """Execute the actual broadcast"""
-    all_users = db.get_all_users()
+    all_users = await db.aget_all_users()
     total_users = len(all_users)
     successful_sends = 0
     
@@ -211,7 +215,7 @@ async def execute_broadcast(client: Client, admin_id: int, broadcast_message: st
             continue
     
     # Save broadcast history
-    db.save_broadcast(broadcast_message, admin_id, total_users, successful_sends)
+    await db.asave_broadcast(broadcast_message, admin_id, total_users, successful_sends)
     
     return total_users, successful_sends
 
@@ -219,7 +223,10 @@ async def execute_broadcast(client: Client, admin_id: int, broadcast_message: st
 async def admin_stats_command(client: Client, message: Message):
     """Show detailed admin statistics"""
     try:
-        stats = db.get_stats()
+        stats = await db.aget_stats()
+        cache = db.auth_cache_stats()
+        clients = user_client_pool.stats()
+        trends = await db.aget_download_trends(6)
         
         stats_text = (
             "**📊 Bot Statistics**\n\n"
@@ -229,22 +236,93 @@ async def admin_stats_command(client: Client, message: Message):
             f"• Premium Users: `{stats.get('paid_users', 0)}`\n"
             f"• Administrators: `{stats.get('admin_count', 0)}`\n\n"
             f"**📈 Activity:**\n"
-            f"• Downloads Today: `{stats.get('today_downloads', 0)}`\n"
+            f"• Downloads Today: `{stats.get('today_downloads', 0)}`\n\n"
+            f"**⚡ Auth Cache:**\n"
+            f"• Hit Rate: `{cache['hit_rate'] * 100:.1f}%` "
+            f"(`{cache['hits']}` hits / `{cache['misses']}` misses)\n"
+            f"• Cached Users: `{cache['size']}`\n\n"
+            f"**🔌 User Clients:**\n"
+            f"• Connected: `{clients['open']}` (`{clients['busy']}` busy)\n"
+            f"• Started / Reused: `{clients['started']}` / `{clients['reused']}`\n"
         )
         
+        if trends:
+            stats_text += "\n**📅 Monthly Downloads:**\n"
+            for month, downloads in trends:
+                stats_text += f"• {month // 100}-{month % 100:02d}: `{downloads}`\n"
+        
         await message.reply(stats_text)
     
     except Exception as e:
         await message.reply(f"❌ **Error getting stats: {str(e)}**")
         LOGGER(__name__).error(f"Error in admin_stats_command: {e}")
 
+@admin_only
+async def queue_command(client: Client, message: Message):
+    """Show transfer slots, queue depth and ETA per pool and each user's share"""
+    try:
+        snapshot = transfer_scheduler.snapshot()
+        
+        queue_text = f"**📦 Transfer Queue** (`{snapshot['jobs']}` job(s))\n\n"
+        for name, pool in snapshot['pools'].items():
+            if pool['queued'] == 0:
+                eta = "none"
+            elif pool['eta'] is None:
+                eta = "unknown"
+            else:
+                eta = get_readable_time(pool['eta'])
+            queue_text += (
+                f"**{name.title()}:** `{pool['busy']}/{pool['slots']}` busy, "
+                f"`{pool['queued']}` queued, `{pool['paused']}` paused\n"
+                f"• Queue ETA: `{eta}`\n"
+            )
+        
+        users = sorted(
+            snapshot['users'].items(),
+            key=lambda item: (item[1]['share'], item[1]['jobs']),
+            reverse=True
+        )
+        if users:
+            queue_text += "\n**👥 Users by Share:**\n"
+            for user_id, stats in users[:10]:
+                queue_text += (
+                    f"• `{user_id}`: `{stats['share'] * 100:.0f}%` of busy slots, "
+                    f"`{stats['jobs']}` job(s), `{stats['running']}` running, `{stats['queued']}` waiting\n"
+                )
+            if len(users) > 10:
+                queue_text += f"• … and `{len(users) - 10}` more\n"
+        
+        stored = await db.aget_job_counts()
+        queue_text += (
+            f"\n**🗄 Stored Jobs:** `{stored.get('queued', 0)}` queued, "
+            f"`{stored.get('running', 0)}` running (all instances)\n"
+        )
+        
+        admission = resource_admission.snapshot()
+        queue_text += (
+            f"\n**💾 Disk:** `{get_readable_file_size(admission['free'])}` free, "
+            f"`{get_readable_file_size(admission['outstanding'])}` still reserved "
+            f"by `{admission['reservations']}` download(s)\n"
+            f"• Held for resources: `{admission['held']}`, rejected: `{admission['rejected']}`\n"
+        )
+        
+        await message.reply(queue_text)
+    
+    except Exception as e:
+        await message.reply(f"❌ **Error getting queue: {str(e)}**")
+        LOGGER(__name__).error(f"Error in queue_command: {e}")
+
 @register_user
 async def user_info_command(client: Client, message: Message):
     """Show user information"""
     try:
-        user_id = message.from_user.id
-        user_type = db.get_user_type(user_id)
-        daily_usage = db.get_daily_usage(user_id)
+        context = await get_auth_context(message)
+        user_id = context.user_id
+        user_type = context.user_type
+        daily_usage = context.daily_usage
+        if daily_usage is None:
+            # Not loaded for unlimited tiers when the snapshot came from the cache
+            daily_usage = await db.aget_daily_usage(user_id)
         
         user_info_text = (
             f"**👤 Your Account Information**\n\n"
@@ -253,20 +331,30 @@ async def user_info_command(client: Client, message: Message):
         )
         
         if user_type == 'free':
-            remaining = 5 - daily_usage
+            remaining = FREE_DAILY_LIMIT - daily_usage
             user_info_text += (
-                f"**Today's Downloads:** `{daily_usage}/5`\n"
+                f"**Today's Downloads:** `{daily_usage}/{FREE_DAILY_LIMIT}`\n"
                 f"**Remaining:** `{remaining}`\n\n"
-                "💎 **Upgrade to Premium for unlimited downloads!**"
+                "💎 **Upgrade to Premium for unlimited downloads!**\n"
             )
         elif user_type == 'paid':
-            user = db.get_user(user_id)
+            user = context.user or await db.aget_user(user_id)
             if user and user['subscription_end']:
                 user_info_text += f"**Subscription Valid Until:** `{user['subscription_end']}`\n"
             user_info_text += f"**Today's Downloads:** `{daily_usage}` (unlimited)\n"
         else:  # admin
             user_info_text += f"**Today's Downloads:** `{daily_usage}` (unlimited)\n**Privileges:** `Administrator`\n"
         
+        queued = (await db.aget_job_counts(user_id)).get('queued', 0)
+        jobs = download_admission.snapshot(user_id, user_type, queued)
+        user_info_text += (
+            f"\n**⚙️ Download Jobs:**\n"
+            f"• Running: `{jobs['in_flight']}/{jobs['max_in_flight']}`\n"
+            f"• Queued: `{jobs['queued']}/{jobs['max_queued']}`\n"
+            f"• Burst Available: `{jobs['tokens']}/{jobs['burst']}` "
+            f"(refills `{jobs['rate_per_minute']:g}`/min)\n"
+        )
+        
         await message.reply(user_info_text)
     
     except Exception as e:
@@ -0,0 +1,299 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+from time import monotonic
+from typing import Dict
+from config import PyroConf
+from logger import LOGGER
+from scheduler import transfer_scheduler
+from resources import resource_admission
+from helpers.downloader import PARALLEL_MIN_SIZE, parallel_download
+from helpers.files import get_download_path, cleanup_download, max_file_size, get_readable_file_size
+from helpers.msg import get_file_name, get_parsed_msg
+from helpers.utils import send_media, prepare_media, checkpoint_progress, download_media_group, send_media_group
+from helpers.file_cache import message_media, get_delivered, send_delivered, remember_delivered
+
+# get_messages takes at most this many ids per call
+PAGE_SIZE = 200
+
+
+class _Post:
+    """One post on its way through the pipeline"""
+    
+    def __init__(self, chat_message, url: str):
+        self.chat_message = chat_message
+        self.url = url
+        # skip, post (delivered by handle_post), group, cached, file or failed
+        self.kind = None
+        # The downloaded album, and the last id the post covers
+        self.group = None
+        self.last_id = chat_message.id
+        self.caption = None
+        self.media_path = None
+        self.media_type = None
+        self.file_size = 0
+        self.prepared = None
+        self.error = None
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class BatchPipeline:
+    """Runs the posts of a /bdl range through bounded, overlapping stages.
+    
+    A fetch task reads the range in pages, download workers fetch the
+    files, process workers probe them for duration and thumbnail, and a
+    single upload task delivers the results. Later posts download while
+    earlier ones upload, and the upload task takes the posts in the order
+    they were fetched, so they arrive in message-id order however the
+    stages finish. At most window posts are between fetch and delivery,
+    which bounds the disk the batch uses. Every stage takes the global
+    scheduler slots and disk reservations a single download takes, so a
+    batch never gets more than its fair share of them.
+    
+    An album is queued once, at the first of its members in the range;
+    a download worker fetches all its members and the upload task sends
+    them as one group. The other members are passed over and the album
+    counts as one post. Text and other posts are delivered by handle_post,
+    in order, from the upload task; it returns whether the post went out
+    and raises on errors, and only delivered posts move the job's cursor.
+    """
+    
+    def __init__(self, bot, message, client, chat_id, prefix: str, start_id: int, end_id: int,
+                 concurrency: int, handle_post, on_delivered, status_message=None):
+        self.bot = bot
+        self.message = message
+        self.client = client
+        self.chat_id = chat_id
+        self.prefix = prefix
+        self.start_id = start_id
+        self.end_id = end_id
+        self.concurrency = max(1, concurrency)
+        self.window = self.concurrency * 2
+        self.handle_post = handle_post
+        self.on_delivered = on_delivered
+        self.status_message = status_message
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.is_premium = False
+        self._order = asyncio.Queue()
+        self._downloads = asyncio.Queue(self.concurrency)
+        self._processing = asyncio.Queue(self.concurrency)
+        self._in_flight = asyncio.Semaphore(self.window)
+        self._files = set()
+        self._albums = set()
+        self._status_updated = monotonic()
+    
+    async def run(self) -> Dict[str, int]:
+        """Deliver the range, returns the downloaded, skipped and failed counts"""
+        me = self.client.me or await self.client.get_me()
+        self.is_premium = getattr(me, 'is_premium', False)
+        
+        tasks = [asyncio.create_task(self._fetch()), asyncio.create_task(self._upload())]
+        tasks += [asyncio.create_task(self._download_worker()) for _ in range(self.concurrency)]
+        tasks += [asyncio.create_task(self._process_worker()) for _ in range(self.concurrency)]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Files downloaded for posts that were never delivered
+            for path in self._files:
+                cleanup_download(path)
+        
+        return {'downloaded': self.downloaded, 'skipped': self.skipped, 'failed': self.failed}
+    
+    async def _fetch(self):
+        for page_start in range(self.start_id, self.end_id + 1, PAGE_SIZE):
+            page_ids = list(range(page_start, min(page_start + PAGE_SIZE, self.end_id + 1)))
+            # One call per page; a failing page fails the batch, which is
+            # retried from the last delivered post
+            chat_messages = await self.client.get_messages(chat_id=self.chat_id, message_ids=page_ids)
+            
+            for chat_message in chat_messages:
+                if chat_message.media_group_id is not None and not chat_message.empty:
+                    if chat_message.media_group_id in self._albums:
+                        # Sent with the album's first member
+                        continue
+                    self._albums.add(chat_message.media_group_id)
+                
+                await self._in_flight.acquire()
+                post = _Post(chat_message, f"{self.prefix}/{chat_message.id}")
+                await self._order.put(post)
+                await self._downloads.put(post)
+        
+        await self._order.put(None)
+        for _ in range(self.concurrency):
+            await self._downloads.put(None)
+    
+    async def _download_worker(self):
+        while True:
+            post = await self._downloads.get()
+            if post is None:
+                await self._processing.put(None)
+                return
+            try:
+                await self._download(post)
+            except Exception as e:
+                post.kind = "failed"
+                post.error = e
+            
+            if post.kind == "file":
+                await self._processing.put(post)
+            else:
+                post.done.set_result(None)
+    
+    async def _download(self, post: _Post):
+        chat_message = post.chat_message
+        if chat_message.empty or not (chat_message.media or chat_message.text or chat_message.caption):
+            # Deleted, service or empty posts need no further calls
+            post.kind = "skip"
+            return
+        
+        if chat_message.media_group_id:
+            members = await chat_message.get_media_group()
+            post.last_id = max(member.id for member in members)
+            post.group = await download_media_group(self.message, members)
+            self._files.update(post.group.paths)
+            post.kind = "group"
+            return
+        
+        media, media_type = message_media(chat_message)
+        if media is None:
+            post.kind = "post"
+            return
+        
+        post.caption = await get_parsed_msg(chat_message.caption or "", chat_message.caption_entities)
+        if await get_delivered(chat_message) is not None:
+            post.kind = "cached"
+            return
+        
+        post.file_size = getattr(media, "file_size", 0) or 0
+        if post.file_size > max_file_size(self.is_premium):
+            raise ValueError(
+                f"The file size exceeds the {get_readable_file_size(max_file_size(self.is_premium))} "
+                f"limit and cannot be downloaded."
+            )
+        
+        post.media_type = media_type if media_type in ("photo", "video", "audio") else "document"
+        # A folder per post, documents of a batch may share a file name
+        download_path = get_download_path(
+            f"{self.message.id}-{chat_message.id}", get_file_name(chat_message.id, chat_message)
+        )
+        await resource_admission.reserve(download_path, post.file_size)
+        self._files.add(download_path)
+        post.media_path = download_path
+        
+        async with transfer_scheduler.slot("download", post.file_size):
+            if post.file_size >= PARALLEL_MIN_SIZE:
+                media_path = await parallel_download(
+                    self.client,
+                    chat_message,
+                    post.file_size,
+                    download_path,
+                    progress=checkpoint_progress,
+                    max_connections=PyroConf.DOWNLOAD_CONNECTIONS,
+                    resume_key=media.file_unique_id,
+                )
+            else:
+                media_path = await chat_message.download(
+                    file_name=download_path, progress=checkpoint_progress
+                )
+        # Sent and cleaned up where the download actually landed
+        if media_path and media_path != download_path:
+            self._files.add(media_path)
+            post.media_path = media_path
+        post.kind = "file"
+    
+    async def _process_worker(self):
+        while True:
+            post = await self._processing.get()
+            if post is None:
+                return
+            try:
+                post.prepared = await prepare_media(post.media_path, post.media_type)
+            except Exception as e:
+                post.kind = "failed"
+                post.error = e
+            post.done.set_result(None)
+    
+    async def _upload(self):
+        while True:
+            post = await self._order.get()
+            if post is None:
+                return
+            # The reorder buffer: later posts may be ready, this one goes first
+            await post.done
+            try:
+                delivered = await self._deliver(post)
+            except Exception as e:
+                post.error = e
+                delivered = False
+            finally:
+                if post.media_path:
+                    cleanup_download(post.media_path)
+                    self._files.discard(post.media_path)
+                if post.group is not None:
+                    # send_media_group removed them
+                    self._files.difference_update(post.group.paths)
+                self._in_flight.release()
+            
+            if post.kind == "skip":
+                self.skipped += 1
+            elif delivered:
+                self.downloaded += 1
+                await self.on_delivered(post.last_id)
+            else:
+                self.failed += 1
+                # Without an error the reason was already reported, e.g. the upload size limit
+                if post.error is not None:
+                    LOGGER(__name__).error(f"Error at {post.url}: {post.error}")
+                    await self.message.reply(f"**❌ {str(post.error)}**")
+            await self._update_status()
+    
+    async def _deliver(self, post: _Post) -> bool:
+        if post.kind in ("skip", "failed"):
+            return False
+        if post.kind == "cached":
+            if await send_delivered(self.message, post.chat_message, post.caption):
+                return True
+            # Telegram rejected the cached file_id, deliver it the slow way
+            post.kind = "post"
+        if post.kind == "post":
+            return await self.handle_post(post.url, post.chat_message)
+        if post.kind == "group":
+            # Reports an album without valid media itself
+            return await send_media_group(self.bot, self.message, post.group)
+        
+        async with transfer_scheduler.slot("upload", post.file_size):
+            sent = await send_media(
+                self.bot,
+                self.message,
+                post.media_path,
+                post.media_type,
+                post.caption,
+                None,
+                None,
+                prepared=post.prepared,
+            )
+        if sent is None:
+            return False
+        await remember_delivered(post.chat_message, sent)
+        return True
+    
+    async def _update_status(self):
+        if self.status_message is None or monotonic() - self._status_updated < 10:
+            return
+        self._status_updated = monotonic()
+        try:
+            await self.status_message.edit(
+                f"📥 **Downloading posts {self.start_id}–{self.end_id}…**\n"
+                f"`{self.downloaded}` delivered, `{self.skipped}` skipped, `{self.failed}` failed"
+            )
+        except Exception:
+            pass
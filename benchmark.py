@@ -0,0 +1,492 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+# Database benchmark
+# Usage: python benchmark.py [--users 1000] [--ops 5000]
+#        python benchmark.py --query-count
+#        python benchmark.py --mix [--sizes 10000,100000,1000000] [--concurrency 8]
+#                           [--ops 20000] [--mode threads|async] [--json results.json]
+#        python benchmark.py --download [--file-mb 256] [--latency-ms 60]
+#                           [--connection-mbps 6] [--total-mbps 40] [--connections 8]
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import perf_counter
+from types import SimpleNamespace
+
+from database import DatabaseManager, WriteBehindBuffer
+from helpers.downloader import CHUNK_SIZE, RangeDownloader
+
+# Relative frequency of each call in the decorator-level mix: every update
+# registers the sender and checks bans, links also check tier and quota,
+# broadcasts and /adminstats are rare
+DEFAULT_MIX = {
+    'add_user': 30,
+    'is_banned': 25,
+    'can_download': 20,
+    'get_user_type': 15,
+    'increment_usage': 9,
+    'get_stats': 0.9,
+    'get_all_users': 0.1
+}
+
+
+class UnbufferedWrites(WriteBehindBuffer):
+    """Write buffer that never absorbs a profile touch, so add_user always writes"""
+
+    def touch(self, user_id: int, username: str, first_name: str, last_name: str) -> bool:
+        return False
+
+
+class LegacyDatabaseManager(DatabaseManager):
+    """DatabaseManager with the old connection-per-call behaviour.
+
+    The authorization cache and the write-behind buffer are switched off
+    too, so every call reaches the database as it did before.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['auth_cache_size'] = 0
+        super().__init__(*args, **kwargs)
+        self._write_buffer = UnbufferedWrites()
+
+    @contextmanager
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if not self._schema_ready:
+                self._init_schema(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def increment_usage(self, user_id: int, count: int = 1) -> bool:
+        date = datetime.now().strftime('%Y-%m-%d')
+        self._write_buffer.add_usage(user_id, date, count)
+        return self.flush_writes()
+
+
+class CountingDatabaseManager(DatabaseManager):
+    """DatabaseManager that counts the SQL statements it executes"""
+
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        self._last = None
+        super().__init__(*args, **kwargs)
+
+    def _open_connection(self) -> sqlite3.Connection:
+        conn = super()._open_connection()
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    def reset_statements(self):
+        """Start a new count"""
+        self.statements.clear()
+        self._last = None
+
+    def _trace(self, statement: str):
+        # SQLite reports the statement again for every trigger step it fires,
+        # back to back repeats within one count are counted once
+        if statement == self._last:
+            return
+        self._last = statement
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            self.statements.append(statement)
+
+
+def run_add_user_can_download(manager: DatabaseManager, users: int, ops: int) -> float:
+    """Run the add_user + can_download pair and return pairs per second"""
+    user_ids = [random.randint(1, users) for _ in range(ops)]
+    started = perf_counter()
+    for user_id in user_ids:
+        manager.add_user(user_id, f"user{user_id}", "First", "Last")
+        manager.can_download(user_id)
+    return ops / (perf_counter() - started)
+
+
+async def count_decorator_queries(manager: CountingDatabaseManager) -> int:
+    """Count the statements check_download_limit issues for one pasted link"""
+    import access_control
+
+    access_control.db = manager
+
+    async def reply(*args, **kwargs):
+        pass
+
+    @access_control.check_download_limit
+    async def handler(client, message):
+        pass
+
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=42, username="user42", first_name="First", last_name="Last"),
+        reply=reply
+    )
+    await handler(None, message)
+    manager.reset_statements()
+
+    message = SimpleNamespace(from_user=message.from_user, reply=reply)
+    await handler(None, message)
+    return len(manager.statements)
+
+
+class ErrorCounter(logging.Handler):
+    """Count the errors DatabaseManager logs instead of raising"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.errors = 0
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord):
+        message = record.getMessage().lower()
+        with self._lock:
+            self.errors += 1
+            if "locked" in message or "busy" in message:
+                self.lock_errors += 1
+
+
+def seed_users(manager: DatabaseManager, users: int, batch_size: int = 10000):
+    """Insert synthetic users: 5% paid, 1% banned, 10 admins and some usage today"""
+    rng = random.Random(users)
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    conn = manager.get_connection()
+    cursor = conn.cursor()
+    for start in range(1, users + 1, batch_size):
+        rows = []
+        for user_id in range(start, min(start + batch_size, users + 1)):
+            paid = rng.random() < 0.05
+            subscription_end = (now + timedelta(days=rng.randint(-10, 60))).strftime('%Y-%m-%d') if paid else None
+            last_activity = now - timedelta(days=rng.randint(0, 60), seconds=rng.randint(0, 86400))
+            rows.append((user_id, f"user{user_id}", "First", "Last", 'paid' if paid else 'free',
+                         subscription_end, last_activity, rng.random() < 0.01))
+        cursor.executemany('''
+            INSERT INTO users (user_id, username, first_name, last_name, user_type,
+                               subscription_end, last_activity, is_banned)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        cursor.executemany('''
+            INSERT INTO daily_usage (user_id, date, files_downloaded) VALUES (?, ?, ?)
+        ''', [(row[0], today, rng.randint(1, 5)) for row in rows if rng.random() < 0.1])
+        conn.commit()
+    cursor.executemany('INSERT INTO admins (user_id, added_by) VALUES (?, ?)',
+                       [(user_id, 1) for user_id in range(1, min(users, 10) + 1)])
+    conn.commit()
+
+
+def mix_call(manager: DatabaseManager, name: str, user_id: int):
+    """Return a zero-argument callable for one call of the mix"""
+    if name == 'add_user':
+        return lambda: manager.add_user(user_id, f"user{user_id}", "First", "Last")
+    if name in ('get_all_users', 'get_stats'):
+        return getattr(manager, name)
+    return lambda: getattr(manager, name)(user_id)
+
+
+def mix_acall(manager: DatabaseManager, name: str, user_id: int):
+    """Async facade counterpart of mix_call"""
+    method = getattr(manager, 'a' + name)
+    if name == 'add_user':
+        return lambda: method(user_id, f"user{user_id}", "First", "Last")
+    if name in ('get_all_users', 'get_stats'):
+        return method
+    return lambda: method(user_id)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_mix(manager: DatabaseManager, users: int, ops: int, concurrency: int,
+            mode: str, mix: dict, seed: int) -> dict:
+    """Drive the call mix from concurrency workers and collect latencies per call"""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    exceptions = {name: 0 for name in names}
+    per_worker = [ops // concurrency + (1 if index < ops % concurrency else 0) for index in range(concurrency)]
+
+    def plan(index: int) -> list:
+        rng = random.Random(seed + index)
+        return [(rng.choices(names, weights)[0], rng.randint(1, users)) for _ in range(per_worker[index])]
+
+    plans = [plan(index) for index in range(concurrency)]
+
+    def record(name: str, started: float, failed: bool):
+        latencies[name].append(perf_counter() - started)
+        if failed:
+            exceptions[name] += 1
+
+    def worker(calls: list):
+        for name, user_id in calls:
+            call = mix_call(manager, name, user_id)
+            started = perf_counter()
+            try:
+                call()
+                record(name, started, False)
+            except Exception:
+                record(name, started, True)
+
+    async def aworker(calls: list):
+        for name, user_id in calls:
+            call = mix_acall(manager, name, user_id)
+            started = perf_counter()
+            try:
+                await call()
+                record(name, started, False)
+            except Exception:
+                record(name, started, True)
+
+    async def arun():
+        await asyncio.gather(*(aworker(calls) for calls in plans))
+
+    started = perf_counter()
+    if mode == 'async':
+        asyncio.run(arun())
+    else:
+        threads = [threading.Thread(target=worker, args=(calls,)) for calls in plans]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = perf_counter() - started
+
+    calls = {}
+    for name in names:
+        samples = sorted(latencies[name])
+        calls[name] = {
+            'count': len(samples),
+            'exceptions': exceptions[name],
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 4),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 4)
+        }
+    everything = sorted(sample for samples in latencies.values() for sample in samples)
+    return {
+        'ops': ops,
+        'seconds': round(elapsed, 3),
+        'ops_per_second': round(ops / elapsed, 1),
+        'p50_ms': round(percentile(everything, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(everything, 0.99) * 1000, 4),
+        'calls': calls
+    }
+
+
+def run_mix_suite(args) -> dict:
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, args.mix_weights.split(",")):
+        name, weight = item.split("=")
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f"Unknown call in --mix-weights: {name}")
+        mix[name] = float(weight)
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+
+    counter = ErrorCounter()
+    logging.getLogger("database").addHandler(counter)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'seed': args.seed,
+        'mix': mix,
+        'runs': []
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for users in (int(size) for size in args.sizes.split(",")):
+            manager = DatabaseManager(os.path.join(tmp, f"mix_{users}.db"))
+            started = perf_counter()
+            seed_users(manager, users)
+            seeded = perf_counter() - started
+
+            errors, lock_errors = counter.errors, counter.lock_errors
+            result = run_mix(manager, users, args.ops, args.concurrency, args.mode, mix, args.seed)
+            manager.close()
+            result.update(
+                users=users,
+                seed_seconds=round(seeded, 3),
+                errors=counter.errors - errors,
+                lock_errors=counter.lock_errors - lock_errors
+            )
+            report['runs'].append(result)
+            print(f"{users:>9,} users: {result['ops_per_second']:>10,.0f} ops/s  "
+                  f"p50 {result['p50_ms']:.3f}ms  p99 {result['p99_ms']:.3f}ms  "
+                  f"errors {result['errors']} (lock {result['lock_errors']})")
+    logging.getLogger("database").removeHandler(counter)
+    return report
+
+
+class SimulatedMediaClient:
+    """Stand-in for a Pyrogram client serving a single file.
+
+    Every stream_media call acts like a new media connection: it pays two
+    round trips of setup, then each 1 MB chunk costs a round trip plus its
+    transfer at the lower of the per-connection bandwidth and an equal share
+    of the total bandwidth.
+    """
+
+    def __init__(self, file_size: int, latency: float, connection_bandwidth: float,
+                 total_bandwidth: float, max_concurrent_transmissions: int = 64):
+        self.file_size = file_size
+        self.latency = latency
+        self.connection_bandwidth = connection_bandwidth
+        self.total_bandwidth = total_bandwidth
+        self.max_concurrent_transmissions = max_concurrent_transmissions
+        self.active = 0
+
+    async def stream_media(self, message, limit: int = 0, offset: int = 0):
+        self.active += 1
+        try:
+            await asyncio.sleep(2 * self.latency)
+            chunks = math.ceil(self.file_size / CHUNK_SIZE)
+            end = min(chunks, offset + limit) if limit else chunks
+            for index in range(offset, end):
+                size = min(CHUNK_SIZE, self.file_size - index * CHUNK_SIZE)
+                bandwidth = min(self.connection_bandwidth, self.total_bandwidth / self.active)
+                await asyncio.sleep(self.latency + size / bandwidth)
+                yield bytes([index % 256]) * size
+        finally:
+            self.active -= 1
+
+
+async def simulated_download(client: SimulatedMediaClient, path: str, connections: int = 0,
+                             adaptive: bool = False) -> dict:
+    """Download into path, sequentially when connections is 0"""
+    started = perf_counter()
+    peak = settled = 1
+    with open(path, "wb") as f:
+        if connections:
+            downloader = RangeDownloader(
+                client, None, client.file_size,
+                min_connections=1 if adaptive else connections,
+                max_connections=connections
+            )
+            async for index, chunk in downloader.chunks():
+                os.pwrite(f.fileno(), chunk, index * CHUNK_SIZE)
+            peak, settled = downloader.peak, downloader.ceiling
+        else:
+            async for chunk in client.stream_media(None):
+                f.write(chunk)
+    elapsed = perf_counter() - started
+
+    # Every chunk carries its own index, check a few landed in place
+    with open(path, "rb") as f:
+        for index in (0, client.file_size // CHUNK_SIZE // 2, (client.file_size - 1) // CHUNK_SIZE):
+            f.seek(index * CHUNK_SIZE)
+            if f.read(1) != bytes([index % 256]):
+                raise SystemExit(f"Chunk {index} was written at the wrong offset")
+    return {
+        'seconds': round(elapsed, 3),
+        'mb_per_second': round(client.file_size / elapsed / CHUNK_SIZE, 2),
+        'connections': peak,
+        'settled_connections': settled
+    }
+
+
+def run_download_suite(args) -> dict:
+    file_size = args.file_mb * CHUNK_SIZE
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'file_mb': args.file_mb,
+        'latency_ms': args.latency_ms,
+        'connection_mbps': args.connection_mbps,
+        'total_mbps': args.total_mbps,
+        'runs': {}
+    }
+    strategies = [("sequential", 0, False)]
+    strategies += [(f"fixed-{n}", n, False) for n in (2, 4, args.connections) if n <= args.connections]
+    strategies.append((f"adaptive-{args.connections}", args.connections, True))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, connections, adaptive in dict.fromkeys(strategies):
+            client = SimulatedMediaClient(
+                file_size, args.latency_ms / 1000,
+                args.connection_mbps * CHUNK_SIZE, args.total_mbps * CHUNK_SIZE
+            )
+            result = asyncio.run(simulated_download(
+                client, os.path.join(tmp, f"{name}.bin"), connections, adaptive
+            ))
+            report['runs'][name] = result
+            print(f"{name:>12}: {result['mb_per_second']:>7.2f} MB/s  "
+                  f"{result['seconds']:>7.2f}s  up to {result['connections']} connections, "
+                  f"settled at {result['settled_connections']}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DatabaseManager hot paths")
+    parser.add_argument("--users", type=int, default=1000, help="distinct user ids")
+    parser.add_argument("--ops", type=int, default=5000,
+                        help="add_user + can_download pairs, or calls per size with --mix")
+    parser.add_argument("--query-count", action="store_true",
+                        help="count the queries check_download_limit issues per message")
+    parser.add_argument("--mix", action="store_true",
+                        help="seed synthetic users and drive the decorator-level call mix")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated user counts to seed with --mix")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent workers with --mix")
+    parser.add_argument("--mode", choices=("threads", "async"), default="threads",
+                        help="call the blocking methods from threads or the async facade from coroutines")
+    parser.add_argument("--mix-weights", default="",
+                        help="override call weights, e.g. get_all_users=0,get_stats=2")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for reproducible runs")
+    parser.add_argument("--download", action="store_true",
+                        help="compare sequential and parallel range downloads on a simulated link")
+    parser.add_argument("--file-mb", type=int, default=256, help="simulated file size with --download")
+    parser.add_argument("--latency-ms", type=float, default=60, help="round trip per chunk with --download")
+    parser.add_argument("--connection-mbps", type=float, default=6,
+                        help="MB/s one connection can reach with --download")
+    parser.add_argument("--total-mbps", type=float, default=40,
+                        help="MB/s shared by all connections with --download")
+    parser.add_argument("--connections", type=int, default=8,
+                        help="most parallel connections with --download")
+    parser.add_argument("--json", help="write the --mix or --download report to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    if args.mix or args.download:
+        report = run_download_suite(args) if args.download else run_mix_suite(args)
+        if args.json == "-":
+            print(json.dumps(report, indent=2))
+        elif args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.query_count:
+            manager = CountingDatabaseManager(os.path.join(tmp, "count.db"))
+            count = asyncio.run(count_decorator_queries(manager))
+            manager.close()
+            print(f"check_download_limit: {count} queries per message")
+            for statement in manager.statements:
+                print("  " + " ".join(statement.split()))
+            return
+
+        results = {}
+        for name, cls in (("legacy", LegacyDatabaseManager), ("pooled", DatabaseManager)):
+            manager = cls(os.path.join(tmp, f"{name}.db"))
+            results[name] = run_add_user_can_download(manager, args.users, args.ops)
+            manager.close()
+
+    for name, rate in results.items():
+        print(f"{name:>8}: {rate:,.0f} add_user + can_download per second")
+    print(f" speedup: {results['pooled'] / results['legacy']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
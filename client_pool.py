@@ -0,0 +1,294 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+from collections import OrderedDict
+from time import monotonic, time
+from typing import Optional, Dict, List, Tuple
+from pyrogram import Client
+from pyrogram.storage import MemoryStorage
+from config import PyroConf
+from database import db
+from logger import LOGGER
+
+class SharedPeerStorage(MemoryStorage):
+    """In-memory session whose peer cache lives in the bot database.
+    
+    Nothing is written to disk per client. Peers the account resolved
+    before are loaded on open, and new or changed ones are queued to the
+    database's write-behind buffer, so restarted clients skip the
+    round trips needed to learn access hashes again.
+    """
+    
+    def __init__(self, name: str, session_string: str):
+        super().__init__(name, session_string)
+        self.owner_id = None
+        self._known = {}
+    
+    async def open(self):
+        await super().open()
+        self.owner_id = await self.user_id()
+        rows = await db.aget_user_peers(self.owner_id)
+        if rows:
+            self.conn.executemany(
+                "REPLACE INTO peers (id, access_hash, type, username, phone_number, last_update_on) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._known = {row[0]: row[1:5] for row in rows}
+    
+    async def update_peers(self, peers: List[Tuple[int, int, str, str, str]]):
+        await super().update_peers(peers)
+        if self.owner_id is None:
+            return
+        
+        # Pyrogram reports the same peers with nearly every response, only
+        # forward the ones that changed
+        now = int(time())
+        changed = []
+        for peer in peers:
+            if self._known.get(peer[0]) != tuple(peer[1:]):
+                self._known[peer[0]] = tuple(peer[1:])
+                changed.append(tuple(peer) + (now,))
+        if changed:
+            db.save_user_peers(self.owner_id, changed)
+
+
+class _PooledClient:
+    """One started user client and the jobs currently using it"""
+    
+    def __init__(self, user_id: int, session_string: str, client: Client):
+        self.user_id = user_id
+        self.session_string = session_string
+        self.client = client
+        self.refs = 0
+        self.last_used = monotonic()
+        self.last_checked = monotonic()
+        self.retired = False
+        self.ready = asyncio.get_running_loop().create_future()
+
+
+class UserClientPool:
+    """Long-lived per-user Pyrogram clients shared by concurrent jobs.
+    
+    A client is started once and handed to every job of that user until it
+    has been idle for idle_timeout seconds, gets evicted (least recently
+    used first) to stay under max_clients, fails a health check or its
+    session is invalidated. Clients in use are reference counted and only
+    stopped once the last job releases them.
+    """
+    
+    def __init__(self, api_id: int, api_hash: str, max_clients: int = 50,
+                 idle_timeout: float = 600, health_interval: float = 120,
+                 acquire_timeout: float = 30, max_transmissions: int = 4):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.acquire_timeout = acquire_timeout
+        self.max_transmissions = max_transmissions
+        self._entries = OrderedDict()
+        self._by_client = {}
+        self._changed = None
+        self._reaper = None
+        self.started = 0
+        self.reused = 0
+        self.evicted = 0
+    
+    def _condition(self) -> asyncio.Condition:
+        # Created lazily so the pool can be built before the event loop runs
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+    
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop())
+    
+    async def acquire(self, user_id: int, session_string: str) -> Optional[Client]:
+        """Get a started client for the user's session, None if it cannot be started"""
+        self._ensure_reaper()
+        changed = self._condition()
+        
+        async with changed:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.session_string != session_string:
+                # The session changed since the client was started
+                if self._retire(entry):
+                    asyncio.create_task(self._stop(entry))
+                entry = None
+            
+            if entry is None:
+                try:
+                    await asyncio.wait_for(changed.wait_for(self._has_room), self.acquire_timeout)
+                except asyncio.TimeoutError:
+                    LOGGER(__name__).error(f"No free user client slot for {user_id} (limit {self.max_clients})")
+                    return None
+                self._evict_idle()
+                
+                client = Client(
+                    f"user_{user_id}",
+                    api_id=self.api_id,
+                    api_hash=self.api_hash,
+                    session_string=session_string,
+                    in_memory=True,
+                    no_updates=True,
+                    max_concurrent_transmissions=self.max_transmissions
+                )
+                client.storage = SharedPeerStorage(client.name, session_string)
+                entry = _PooledClient(user_id, session_string, client)
+                self._entries[user_id] = entry
+                self._by_client[id(entry.client)] = entry
+                entry.refs += 1
+                starting = True
+            else:
+                self._entries.move_to_end(user_id)
+                entry.refs += 1
+                starting = False
+        
+        if starting:
+            try:
+                await entry.client.start()
+                self.started += 1
+                entry.ready.set_result(True)
+            except BaseException as e:
+                # Resolved on cancellation too, or acquirers waiting for this
+                # start would hang on ready forever
+                entry.ready.set_result(False)
+                await self._drop(entry)
+                if not isinstance(e, Exception):
+                    raise
+                LOGGER(__name__).error(f"Failed to start user client for {user_id}: {e}")
+                return None
+        else:
+            if not await entry.ready:
+                await self.release(entry.client)
+                return None
+            if not await self._healthy(entry):
+                await self._drop(entry)
+                return await self.acquire(user_id, session_string)
+            self.reused += 1
+        
+        return entry.client
+    
+    async def release(self, client: Client):
+        """Hand back a client obtained from acquire"""
+        entry = self._by_client.get(id(client))
+        if entry is None:
+            return
+        
+        async with self._condition():
+            entry.refs -= 1
+            entry.last_used = monotonic()
+            stop = entry.retired and entry.refs <= 0
+            self._changed.notify_all()
+        if stop:
+            await self._stop(entry)
+    
+    async def invalidate(self, user_id: int):
+        """Stop the user's client (after its running jobs) because the session changed"""
+        async with self._condition():
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            stop = self._retire(entry)
+            self._changed.notify_all()
+        if stop:
+            await self._stop(entry)
+    
+    async def close(self):
+        """Stop every pooled client"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            await self._stop(entry)
+    
+    def stats(self) -> Dict:
+        return {
+            'open': len(self._entries),
+            'busy': sum(1 for entry in self._entries.values() if entry.refs > 0),
+            'started': self.started,
+            'reused': self.reused,
+            'evicted': self.evicted
+        }
+    
+    def _has_room(self) -> bool:
+        if len(self._entries) < self.max_clients:
+            return True
+        return any(entry.refs <= 0 for entry in self._entries.values())
+    
+    def _evict_idle(self):
+        """Retire least recently used idle clients until a new one fits"""
+        for entry in list(self._entries.values()):
+            if len(self._entries) < self.max_clients:
+                break
+            if entry.refs <= 0:
+                self._retire(entry)
+                self.evicted += 1
+                asyncio.create_task(self._stop(entry))
+    
+    def _retire(self, entry: _PooledClient) -> bool:
+        """Take an entry out of the pool, True if nobody is using it any more"""
+        if self._entries.get(entry.user_id) is entry:
+            del self._entries[entry.user_id]
+        entry.retired = True
+        return entry.refs <= 0
+    
+    async def _healthy(self, entry: _PooledClient) -> bool:
+        if not entry.client.is_connected:
+            return False
+        if monotonic() - entry.last_checked < self.health_interval:
+            return True
+        try:
+            await asyncio.wait_for(entry.client.get_me(), 15)
+            entry.last_checked = monotonic()
+            return True
+        except Exception as e:
+            LOGGER(__name__).warning(f"User client for {entry.user_id} failed health check: {e}")
+            return False
+    
+    async def _drop(self, entry: _PooledClient):
+        """Remove a broken client, stopping it once nobody uses it"""
+        async with self._condition():
+            self._retire(entry)
+            entry.refs -= 1
+            stop = entry.refs <= 0
+            self._changed.notify_all()
+        if stop:
+            await self._stop(entry)
+    
+    async def _stop(self, entry: _PooledClient):
+        self._by_client.pop(id(entry.client), None)
+        try:
+            if entry.client.is_connected:
+                await entry.client.stop()
+        except Exception as e:
+            LOGGER(__name__).error(f"Error stopping user client for {entry.user_id}: {e}")
+    
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            now = monotonic()
+            async with self._condition():
+                idle = [entry for entry in self._entries.values()
+                        if entry.refs <= 0 and now - entry.last_used > self.idle_timeout]
+                for entry in idle:
+                    self._retire(entry)
+                if idle:
+                    self._changed.notify_all()
+            for entry in idle:
+                await self._stop(entry)
+
+
+# Initialize the shared pool
+user_client_pool = UserClientPool(
+    PyroConf.API_ID,
+    PyroConf.API_HASH,
+    max_clients=PyroConf.USER_CLIENT_POOL_SIZE,
+    idle_timeout=PyroConf.USER_CLIENT_IDLE_TIMEOUT,
+    max_transmissions=PyroConf.DOWNLOAD_CONNECTIONS
+)
@@ -1,103 +1,552 @@
 # Copyright (C) @Wolfy004
 # Channel: https://t.me/Wolfy004
 
-import sqlite3
+import asyncio
+import queue
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict
+from config import PyroConf
 from logger import LOGGER
+from storage import SCHEMA_VERSION, StorageBackend, SQLiteBackend, create_backend
 
-class DatabaseManager:
-    def __init__(self, db_path: str = "bot_database.db"):
-        self.db_path = db_path
-        self.init_database()
+FREE_DAILY_LIMIT = 5
+
+# Columns of a job as handed to the worker
+JOB_COLUMNS = (
+    'id', 'user_id', 'source_chat', 'source_message_id', 'end_message_id', 'next_message_id',
+    'post_url', 'request_chat_id', 'request_message_id', 'kind', 'attempts', 'last_error'
+)
+
+def _resolve_futures(outcomes):
+    """Hand a batch of results back to their awaiting coroutines"""
+    for future, error, value in outcomes:
+        if future.cancelled():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+
+class DatabaseExecutor:
+    """Run blocking database calls on one dedicated thread.
+
+    Calls are queued and drained in micro-batches: everything queued while
+    the thread was busy runs back to back, and each event loop is woken once
+    per batch rather than once per call.
+    """
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
+    def __init__(self, max_batch: int = 64):
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
     
-    def init_database(self):
-        """Initialize database tables"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-executor", daemon=True)
+                self._thread.start()
+    
+    def submit(self, func, *args, **kwargs) -> asyncio.Future:
+        """Queue func(*args, **kwargs) and return a future for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._ensure_started()
+        self._queue.put((loop, future, func, args, kwargs))
+        return future
+    
+    def shutdown(self):
+        """Finish queued calls and stop the thread"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+    
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
             
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    user_type TEXT DEFAULT 'free',
-                    subscription_end DATE,
-                    joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT FALSE,
-                    session_string TEXT
-                )
-            ''')
+            outcomes = {}
+            for loop, future, func, args, kwargs in batch:
+                try:
+                    outcome = (future, None, func(*args, **kwargs))
+                except Exception as e:
+                    outcome = (future, e, None)
+                outcomes.setdefault(loop, []).append(outcome)
             
-            # Daily usage tracking
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS daily_usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    date DATE,
-                    files_downloaded INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(user_id, date)
-                )
-            ''')
+            for loop, results in outcomes.items():
+                try:
+                    loop.call_soon_threadsafe(_resolve_futures, results)
+                except RuntimeError:
+                    # The loop was closed while the call was running
+                    pass
+
+
+class AuthCache:
+    """Bounded LRU cache of user authorization records with a TTL.
+    
+    A record is a dict with the keys exists, user_type, subscription_end
+    (epoch seconds or None), is_banned and is_admin.
+    """
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._records.get(user_id)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._records[user_id]
+                self.misses += 1
+                return None
+            self._records.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+    
+    def peek(self, user_id: int) -> Optional[Dict]:
+        """Get a record without touching LRU order or hit/miss counters"""
+        with self._lock:
+            entry = self._records.get(user_id)
+            return entry[1] if entry is not None else None
+    
+    def put(self, user_id: int, record: Dict):
+        with self._lock:
+            self._records[user_id] = (time.monotonic() + self.ttl, record)
+            self._records.move_to_end(user_id)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._records.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._records),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class WriteBehindBuffer:
+    """Pending profile touches, usage increments and peers waiting to be written.
+    
+    Remembers the last persisted profile of recently seen users, so touches
+    that change nothing (and activity within activity_resolution seconds)
+    are dropped instead of queued.
+    """
+    
+    def __init__(self, max_entries: int = 500, known_users: int = 100000,
+                 activity_resolution: float = 60):
+        self.max_entries = max_entries
+        self.known_users = known_users
+        self.activity_resolution = activity_resolution
+        self.wakeup = threading.Event()
+        self._profiles = {}
+        self._usage = {}
+        self._peers = {}
+        # Usage taken by a flush that has not committed yet, still counted
+        # by pending_usage so quota reads never miss it
+        self._flushing = {}
+        self._persisted = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def remember(self, user_id: int, username: str, first_name: str, last_name: str):
+        """Record the profile that was just written directly to the database"""
+        with self._lock:
+            self._persisted[user_id] = (username, first_name, last_name, time.time())
+            self._persisted.move_to_end(user_id)
+            while len(self._persisted) > self.known_users:
+                self._persisted.popitem(last=False)
+    
+    def touch(self, user_id: int, username: str, first_name: str, last_name: str) -> bool:
+        """Queue a profile touch, False if the user is unknown and must be written directly"""
+        now = time.time()
+        with self._lock:
+            state = self._persisted.get(user_id)
+            if state is None:
+                return False
+            self._persisted.move_to_end(user_id)
             
-            # Admins table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id INTEGER PRIMARY KEY,
-                    added_by INTEGER,
-                    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+            # Same COALESCE semantics as add_user: None keeps the stored value
+            profile = (
+                username if username is not None else state[0],
+                first_name if first_name is not None else state[1],
+                last_name if last_name is not None else state[2]
+            )
+            if profile == state[:3] and now - state[3] < self.activity_resolution:
+                return True
             
-            # Broadcast history
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS broadcasts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message TEXT,
-                    sent_by INTEGER,
-                    sent_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    total_users INTEGER,
-                    successful_sends INTEGER,
-                    FOREIGN KEY (sent_by) REFERENCES users(user_id)
-                )
-            ''')
+            self._persisted[user_id] = profile + (now,)
+            self._profiles[user_id] = profile + (datetime.now(),)
+            full = self._pending() >= self.max_entries
+        if full:
+            self.wakeup.set()
+        return True
+    
+    def add_usage(self, user_id: int, date: str, count: int):
+        with self._lock:
+            key = (user_id, date)
+            self._usage[key] = self._usage.get(key, 0) + count
+            full = self._pending() >= self.max_entries
+        if full:
+            self.wakeup.set()
+    
+    def add_peers(self, owner_id: int, peers: List[tuple]):
+        """Queue (peer_id, access_hash, type, username, phone_number, updated_at) rows"""
+        with self._lock:
+            for peer in peers:
+                self._peers[(owner_id, peer[0])] = peer[1:]
+            full = self._pending() >= self.max_entries
+        if full:
+            self.wakeup.set()
+    
+    def _pending(self) -> int:
+        return len(self._profiles) + len(self._usage) + len(self._peers)
+    
+    def pending_usage(self, user_id: int, date: str) -> int:
+        """Usage not committed yet, including what a running flush is writing"""
+        key = (user_id, date)
+        with self._lock:
+            return self._usage.get(key, 0) + self._flushing.get(key, 0)
+    
+    def drain(self) -> tuple[Dict, Dict, Dict]:
+        """Take every pending write out of the buffer until settle or restore"""
+        with self._lock:
+            profiles, self._profiles = self._profiles, {}
+            usage, self._usage = self._usage, {}
+            peers, self._peers = self._peers, {}
+            self._move_flushing(usage, 1)
+        return profiles, usage, peers
+    
+    def settle(self, usage: Dict):
+        """Forget drained usage once its flush has committed"""
+        with self._lock:
+            self._move_flushing(usage, -1)
+    
+    def _move_flushing(self, usage: Dict, sign: int):
+        for key, count in usage.items():
+            remaining = self._flushing.get(key, 0) + sign * count
+            if remaining:
+                self._flushing[key] = remaining
+            else:
+                self._flushing.pop(key, None)
+    
+    def restore(self, profiles: Dict, usage: Dict, peers: Dict):
+        """Put back writes that failed to flush, keeping anything newer"""
+        with self._lock:
+            self._move_flushing(usage, -1)
+            for user_id, profile in profiles.items():
+                self._profiles.setdefault(user_id, profile)
+            for key, count in usage.items():
+                self._usage[key] = self._usage.get(key, 0) + count
+            for key, peer in peers.items():
+                self._peers.setdefault(key, peer)
+
+
+class QuotaReservation:
+    """One download slot taken from a user's daily quota"""
+    
+    def __init__(self, user_id: int, date: str, limited: bool = True):
+        self.user_id = user_id
+        self.date = date
+        self.limited = limited
+        self.settled = False
+
+
+class QuotaCounter:
+    """In-memory mirror of today's reserved downloads per user.
+    
+    Lets a user who already hit the limit be refused without a database
+    round trip. The guarded upsert stays the source of truth.
+    """
+    
+    def __init__(self):
+        self._date = None
+        self._counts = {}
+        self._lock = threading.Lock()
+    
+    def _roll(self, date: str):
+        if date != self._date:
+            self._date = date
+            self._counts.clear()
+    
+    def get(self, user_id: int, date: str) -> Optional[int]:
+        with self._lock:
+            self._roll(date)
+            return self._counts.get(user_id)
+    
+    def set(self, user_id: int, date: str, count: int):
+        with self._lock:
+            self._roll(date)
+            self._counts[user_id] = count
+    
+    def add(self, user_id: int, date: str, delta: int):
+        with self._lock:
+            self._roll(date)
+            if user_id in self._counts:
+                self._counts[user_id] = max(0, self._counts[user_id] + delta)
+
+
+def _subscription_epoch(subscription_end: Optional[str]) -> Optional[float]:
+    """Convert a stored YYYY-MM-DD subscription end into epoch seconds"""
+    if not subscription_end:
+        return None
+    return datetime.strptime(subscription_end, '%Y-%m-%d').timestamp()
+
+
+def _auth_record(exists, user_type, subscription_end, is_banned, is_admin) -> Dict:
+    return {
+        'exists': bool(exists),
+        'user_type': user_type or 'free',
+        'subscription_end': _subscription_epoch(subscription_end),
+        'is_banned': bool(is_banned),
+        'is_admin': bool(is_admin)
+    }
+
+
+def _effective_user_type(record: Dict) -> str:
+    """Resolve free/paid/admin from an authorization record"""
+    if not record['exists']:
+        return 'free'
+    if record['is_admin']:
+        return 'admin'
+    if record['user_type'] == 'paid' and record['subscription_end'] and record['subscription_end'] > time.time():
+        return 'paid'
+    return 'free'
+
+
+class DatabaseManager:
+    """Users, roles, quotas and statistics on top of a StorageBackend.
+    
+    SQL issued here stays portable (? placeholders, upserts with qualified
+    columns, no engine-specific functions) so any backend can run it.
+    """
+    
+    def __init__(self, db_path: str = "bot_database.db", cache_size_kb: int = 16384,
+                 mmap_size: int = 256 * 1024 * 1024, statement_cache_size: int = 256,
+                 auth_cache_size: int = 10000, auth_cache_ttl: Optional[float] = None,
+                 flush_interval: float = 0.5, flush_max_entries: int = 500,
+                 file_cache_size: int = 100000, backend: Optional[StorageBackend] = None):
+        if backend is None:
+            backend = SQLiteBackend(db_path, cache_size_kb, mmap_size, statement_cache_size)
+        if auth_cache_ttl is None:
+            auth_cache_ttl = backend.auth_cache_ttl
+        self.backend = backend
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.file_cache_size = file_cache_size
+        self._file_cache_writes = 0
+        self._local = threading.local()
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._executor = DatabaseExecutor()
+        self._auth_cache = AuthCache(auth_cache_size, auth_cache_ttl)
+        self._write_buffer = WriteBehindBuffer(flush_max_entries)
+        self._quota_counter = QuotaCounter()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self._flusher_stop = threading.Event()
+        self._rollup = None
+        self._rollup_stop = threading.Event()
+    
+    def get_connection(self):
+        """Get the calling thread's pooled connection, opening it on first use.
+
+        Connections are long-lived, so SQLite's prepared statement cache is
+        reused across calls instead of being rebuilt on every query.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not self.backend.is_usable(conn):
+            # Dropped by the server, lease a fresh one
+            self._discard_connection(conn)
+            conn = None
+        if conn is None:
+            conn = self._open_connection()
+            self._local.conn = conn
+            with self._pool_lock:
+                self._pool.append(conn)
+        if not self._schema_ready:
+            self._init_schema(conn)
+        return conn
+    
+    def _open_connection(self):
+        return self.backend.connect()
+    
+    def _discard_connection(self, conn):
+        with self._pool_lock:
+            if conn in self._pool:
+                self._pool.remove(conn)
+        self._local.conn = None
+        try:
+            self.backend.release(conn)
+        except Exception as e:
+            LOGGER(__name__).error(f"Error releasing database connection: {e}")
+    
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._flusher_lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher_stop.clear()
+                self._flusher = threading.Thread(target=self._flush_loop, name="db-flusher", daemon=True)
+                self._flusher.start()
+    
+    def _flush_loop(self):
+        while not self._flusher_stop.is_set():
+            self._write_buffer.wakeup.wait(self.flush_interval)
+            self._write_buffer.wakeup.clear()
+            self.flush_writes()
+    
+    def flush_writes(self) -> bool:
+        """Write buffered profile touches, usage increments and peers in one transaction"""
+        profiles, usage, peers = self._write_buffer.drain()
+        if not profiles and not usage and not peers:
+            return True
+        
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    UPDATE users SET
+                        username = COALESCE(?, username),
+                        first_name = COALESCE(?, first_name),
+                        last_name = COALESCE(?, last_name),
+                        last_activity = ?
+                    WHERE user_id = ?
+                ''', [profile + (user_id,) for user_id, profile in profiles.items()])
+                cursor.executemany('''
+                    INSERT INTO daily_usage (user_id, date, files_downloaded)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, date) DO UPDATE SET
+                        files_downloaded = daily_usage.files_downloaded + excluded.files_downloaded
+                ''', [key + (count,) for key, count in usage.items()])
+                cursor.executemany('''
+                    INSERT INTO user_peers
+                    (owner_id, peer_id, access_hash, type, username, phone_number, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(owner_id, peer_id) DO UPDATE SET
+                        access_hash = excluded.access_hash,
+                        type = excluded.type,
+                        username = excluded.username,
+                        phone_number = excluded.phone_number,
+                        updated_at = excluded.updated_at
+                ''', [key + peer for key, peer in peers.items()])
+                conn.commit()
+            self._write_buffer.settle(usage)
+            return True
+        except Exception as e:
+            LOGGER(__name__).error(f"Error flushing buffered writes: {e}")
+            self._write_buffer.restore(profiles, usage, peers)
+            return False
+    
+    def close(self):
+        """Stop the database thread, flush buffered writes and close every pooled connection"""
+        self._executor.shutdown()
+        if self._rollup is not None:
+            self._rollup_stop.set()
+            self._rollup.join()
+            self._rollup = None
+        with self._flusher_lock:
+            flusher = self._flusher
+            self._flusher = None
+        if flusher is not None:
+            self._flusher_stop.set()
+            self._write_buffer.wakeup.set()
+            flusher.join()
+        self.flush_writes()
+        with self._pool_lock:
+            for conn in self._pool:
+                try:
+                    self.backend.release(conn)
+                except Exception as e:
+                    LOGGER(__name__).error(f"Error closing database connection: {e}")
+            self._pool.clear()
+            self._local = threading.local()
+        self.backend.close()
+    
+    def init_database(self):
+        """Initialize database tables (otherwise done on first use)"""
+        self.get_connection()
+    
+    def _init_schema(self, conn):
+        """Create tables, triggers and indexes unless the stored schema version is current"""
+        with self._schema_lock:
+            if self._schema_ready:
+                return
             
-            conn.commit()
-            LOGGER(__name__).info("Database initialized successfully")
+            if self.backend.schema_version(conn) != SCHEMA_VERSION:
+                self.backend.create_schema(conn)
+            self._schema_ready = True
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None, 
                  last_name: str = None, user_type: str = 'free') -> bool:
         """Add new user or update basic profile information (preserves roles and settings)"""
+        # Known users only need a buffered touch, and only if something changed
+        if self._write_buffer.touch(user_id, username, first_name, last_name):
+            self._ensure_flusher()
+            return True
+        
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                # First try to insert new user
+                # Insert new users, otherwise update only basic profile fields,
+                # preserving important data
                 cursor.execute('''
-                    INSERT OR IGNORE INTO users 
+                    INSERT INTO users 
                     (user_id, username, first_name, last_name, user_type, last_activity)
                     VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = COALESCE(excluded.username, users.username),
+                        first_name = COALESCE(excluded.first_name, users.first_name),
+                        last_name = COALESCE(excluded.last_name, users.last_name),
+                        last_activity = excluded.last_activity
                 ''', (user_id, username, first_name, last_name, user_type, datetime.now()))
-                
-                # Then update only basic profile fields, preserving important data
-                cursor.execute('''
-                    UPDATE users SET 
-                        username = COALESCE(?, username),
-                        first_name = COALESCE(?, first_name),
-                        last_name = COALESCE(?, last_name),
-                        last_activity = ?
-                    WHERE user_id = ?
-                ''', (username, first_name, last_name, datetime.now(), user_id))
                 conn.commit()
-                return True
+            
+            self._write_buffer.remember(user_id, username, first_name, last_name)
+            record = self._auth_cache.peek(user_id)
+            if record is not None and not record['exists']:
+                # A cached "unknown user" record is stale now
+                self._auth_cache.invalidate(user_id)
+            return True
         except Exception as e:
             LOGGER(__name__).error(f"Error adding user {user_id}: {e}")
             return False
@@ -117,34 +566,129 @@ class DatabaseManager:
             LOGGER(__name__).error(f"Error getting user {user_id}: {e}")
             return None
     
-    def get_user_type(self, user_id: int) -> str:
-        """Get user type (free, paid, admin)"""
-        user = self.get_user(user_id)
-        if not user:
-            return 'free'
+    def get_auth_record(self, user_id: int) -> Optional[Dict]:
+        """Get the cached authorization record of a user, loading it on a miss"""
+        record = self._auth_cache.get(user_id)
+        if record is not None:
+            return record
         
-        # Check if admin
-        if self.is_admin(user_id):
-            return 'admin'
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT u.user_id IS NOT NULL, u.user_type, u.subscription_end,
+                           u.is_banned, a.user_id IS NOT NULL
+                    FROM (SELECT ? AS user_id) k
+                    LEFT JOIN users u ON u.user_id = k.user_id
+                    LEFT JOIN admins a ON a.user_id = k.user_id
+                ''', (user_id,))
+                record = _auth_record(*cursor.fetchone())
+        except Exception as e:
+            LOGGER(__name__).error(f"Error loading authorization record for {user_id}: {e}")
+            return None
         
-        # Check if paid subscription is active
-        if user['user_type'] == 'paid' and user['subscription_end']:
-            sub_end = datetime.strptime(user['subscription_end'], '%Y-%m-%d')
-            if sub_end > datetime.now():
-                return 'paid'
+        self._auth_cache.put(user_id, record)
+        return record
+    
+    def warm_auth_cache(self) -> int:
+        """Preload authorization records of admins and active premium users"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT u.user_id, u.user_type, u.subscription_end, u.is_banned,
+                           a.user_id IS NOT NULL
+                    FROM users u
+                    LEFT JOIN admins a ON a.user_id = u.user_id
+                    WHERE a.user_id IS NOT NULL
+                       OR (u.user_type = 'paid' AND u.subscription_end > ?)
+                ''', (today,))
+                rows = cursor.fetchall()
+        except Exception as e:
+            LOGGER(__name__).error(f"Error warming authorization cache: {e}")
+            return 0
         
-        return 'free'
+        for user_id, user_type, subscription_end, is_banned, is_admin in rows:
+            self._auth_cache.put(user_id, _auth_record(True, user_type, subscription_end, is_banned, is_admin))
+        return len(rows)
     
-    def is_admin(self, user_id: int) -> bool:
-        """Check if user is admin"""
+    def auth_cache_stats(self) -> Dict:
+        """Get authorization cache size and hit/miss counters"""
+        return self._auth_cache.stats()
+    
+    def get_auth_snapshot(self, user_id: int) -> Dict:
+        """Get profile, admin and ban flags, effective tier and today's usage in one query.
+        
+        A live authorization record in the cache answers without the join:
+        the profile is then None, and today's usage is only read for free
+        users, the one tier it limits (None for the others).
+        """
+        snapshot = {
+            'user': None,
+            'is_admin': False,
+            'is_banned': False,
+            'user_type': 'free',
+            'daily_usage': 0
+        }
+        today = datetime.now().strftime('%Y-%m-%d')
+        record = self._auth_cache.get(user_id)
+        if record is not None and record['exists']:
+            user_type = _effective_user_type(record)
+            snapshot.update(
+                is_admin=record['is_admin'],
+                is_banned=record['is_banned'],
+                user_type=user_type,
+                daily_usage=self.get_daily_usage(user_id, today) if user_type == 'free' else None
+            )
+            return snapshot
+        
+        # Read before the query: a flush committing in between is then
+        # counted twice for a moment rather than not at all
+        pending = self._write_buffer.pending_usage(user_id, today)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('SELECT 1 FROM admins WHERE user_id = ?', (user_id,))
-                return cursor.fetchone() is not None
+                cursor.execute('''
+                    SELECT u.*, a.user_id IS NOT NULL, COALESCE(d.files_downloaded, 0)
+                    FROM users u
+                    LEFT JOIN admins a ON a.user_id = u.user_id
+                    LEFT JOIN daily_usage d ON d.user_id = u.user_id AND d.date = ?
+                    WHERE u.user_id = ?
+                ''', (today, user_id))
+                row = cursor.fetchone()
+                if not row:
+                    return snapshot
+                columns = [desc[0] for desc in cursor.description[:-2]]
         except Exception as e:
-            LOGGER(__name__).error(f"Error checking admin status for {user_id}: {e}")
-            return False
+            LOGGER(__name__).error(f"Error getting authorization snapshot for {user_id}: {e}")
+            return snapshot
+        
+        user = dict(zip(columns, row[:-2]))
+        is_admin, daily_usage = row[-2:]
+        record = _auth_record(True, user['user_type'], user['subscription_end'], user['is_banned'], is_admin)
+        self._auth_cache.put(user_id, record)
+        
+        snapshot.update(
+            user=user,
+            is_admin=record['is_admin'],
+            is_banned=record['is_banned'],
+            user_type=_effective_user_type(record),
+            daily_usage=daily_usage + pending
+        )
+        return snapshot
+    
+    def get_user_type(self, user_id: int) -> str:
+        """Get user type (free, paid, admin)"""
+        record = self.get_auth_record(user_id)
+        if not record:
+            return 'free'
+        return _effective_user_type(record)
+    
+    def is_admin(self, user_id: int) -> bool:
+        """Check if user is admin"""
+        record = self.get_auth_record(user_id)
+        return bool(record and record['is_admin'])
     
     def add_admin(self, user_id: int, added_by: int) -> bool:
         """Add user as admin"""
@@ -152,10 +696,12 @@ class DatabaseManager:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT OR IGNORE INTO admins (user_id, added_by) 
+                    INSERT INTO admins (user_id, added_by) 
                     VALUES (?, ?)
+                    ON CONFLICT(user_id) DO NOTHING
                 ''', (user_id, added_by))
                 conn.commit()
+                self._auth_cache.invalidate(user_id)
                 return True
         except Exception as e:
             LOGGER(__name__).error(f"Error adding admin {user_id}: {e}")
@@ -168,6 +714,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
                 conn.commit()
+                self._auth_cache.invalidate(user_id)
                 return cursor.rowcount > 0
         except Exception as e:
             LOGGER(__name__).error(f"Error removing admin {user_id}: {e}")
@@ -187,6 +734,7 @@ class DatabaseManager:
                     WHERE user_id = ?
                 ''', (user_type, subscription_end, user_id))
                 conn.commit()
+                self._auth_cache.invalidate(user_id)
                 return cursor.rowcount > 0
         except Exception as e:
             LOGGER(__name__).error(f"Error setting user type for {user_id}: {e}")
@@ -197,6 +745,8 @@ class DatabaseManager:
         if not date:
             date = datetime.now().strftime('%Y-%m-%d')
         
+        # Before the query, like get_auth_snapshot
+        pending = self._write_buffer.pending_usage(user_id, date)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
@@ -205,42 +755,111 @@ class DatabaseManager:
                     WHERE user_id = ? AND date = ?
                 ''', (user_id, date))
                 result = cursor.fetchone()
-                return result[0] if result else 0
+                return (result[0] if result else 0) + pending
         except Exception as e:
             LOGGER(__name__).error(f"Error getting daily usage for {user_id}: {e}")
             return 0
     
     def increment_usage(self, user_id: int, count: int = 1) -> bool:
-        """Increment daily usage count"""
+        """Increment daily usage count (buffered, written by the next flush)"""
         date = datetime.now().strftime('%Y-%m-%d')
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO daily_usage (user_id, date, files_downloaded)
-                    VALUES (?, ?, COALESCE((SELECT files_downloaded FROM daily_usage 
-                                          WHERE user_id = ? AND date = ?), 0) + ?)
-                ''', (user_id, date, user_id, date, count))
-                conn.commit()
-                return True
-        except Exception as e:
-            LOGGER(__name__).error(f"Error incrementing usage for {user_id}: {e}")
-            return False
+        self._write_buffer.add_usage(user_id, date, count)
+        self._ensure_flusher()
+        return True
     
     def can_download(self, user_id: int) -> tuple[bool, str]:
         """Check if user can download (considering daily limits)"""
         user_type = self.get_user_type(user_id)
         
+        # Admins and paid users have unlimited access
+        if user_type in ['admin', 'paid']:
+            return True, ""
+        
+        return self.check_quota(user_type, self.get_daily_usage(user_id))
+    
+    @staticmethod
+    def check_quota(user_type: str, daily_usage: int) -> tuple[bool, str]:
+        """Apply the daily limit to an already known tier and usage"""
         # Admins and paid users have unlimited access
         if user_type in ['admin', 'paid']:
             return True, ""
         
         # Free users have daily limit
-        daily_usage = self.get_daily_usage(user_id)
-        if daily_usage >= 5:
-            return False, "Daily limit reached (5 files). Upgrade to premium for unlimited downloads."
+        if daily_usage >= FREE_DAILY_LIMIT:
+            return False, f"Daily limit reached ({FREE_DAILY_LIMIT} files). Upgrade to premium for unlimited downloads."
         
-        return True, f"Downloads remaining today: {5 - daily_usage}"
+        return True, f"Downloads remaining today: {FREE_DAILY_LIMIT - daily_usage}"
+    
+    def reserve_download(self, user_id: int, user_type: str) -> tuple[Optional[QuotaReservation], str]:
+        """Atomically reserve one of today's downloads (None if the daily limit is reached)"""
+        date = datetime.now().strftime('%Y-%m-%d')
+        
+        # Admins and paid users have unlimited access, nothing to reserve
+        if user_type in ['admin', 'paid']:
+            return QuotaReservation(user_id, date, limited=False), ""
+        
+        # The shortcut is only safe while no other instance can release slots
+        used = None if self.backend.shared else self._quota_counter.get(user_id, date)
+        if used is not None and used >= FREE_DAILY_LIMIT:
+            return None, self.check_quota(user_type, used)[1]
+        
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                # Take a slot only while the user is under the limit; no row
+                # back means the limit was already reached
+                cursor.execute('''
+                    INSERT INTO daily_usage (user_id, date, files_downloaded)
+                    VALUES (?, ?, 1)
+                    ON CONFLICT(user_id, date) DO UPDATE SET
+                        files_downloaded = daily_usage.files_downloaded + 1
+                    WHERE daily_usage.files_downloaded < ?
+                    RETURNING files_downloaded
+                ''', (user_id, date, FREE_DAILY_LIMIT))
+                row = cursor.fetchone()
+                conn.commit()
+        except Exception as e:
+            LOGGER(__name__).error(f"Error reserving download for {user_id}: {e}")
+            return None, "Could not check your download limit, please try again."
+        
+        if row is None:
+            self._quota_counter.set(user_id, date, FREE_DAILY_LIMIT)
+            return None, self.check_quota(user_type, FREE_DAILY_LIMIT)[1]
+        
+        self._quota_counter.set(user_id, date, row[0])
+        return QuotaReservation(user_id, date), f"Downloads remaining today: {FREE_DAILY_LIMIT - row[0]}"
+    
+    def commit_download(self, reservation: QuotaReservation) -> bool:
+        """Keep a reserved download once it has been delivered"""
+        if reservation.settled:
+            return False
+        reservation.settled = True
+        if not reservation.limited:
+            # Unlimited users were not counted up front
+            return self.increment_usage(reservation.user_id)
+        return True
+    
+    def release_download(self, reservation: QuotaReservation) -> bool:
+        """Give back a reserved download that failed or was cancelled"""
+        if reservation.settled:
+            return False
+        reservation.settled = True
+        if not reservation.limited:
+            return True
+        
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE daily_usage SET files_downloaded = files_downloaded - 1
+                    WHERE user_id = ? AND date = ? AND files_downloaded > 0
+                ''', (reservation.user_id, reservation.date))
+                conn.commit()
+            self._quota_counter.add(reservation.user_id, reservation.date, -1)
+            return True
+        except Exception as e:
+            LOGGER(__name__).error(f"Error releasing download for {reservation.user_id}: {e}")
+            return False
     
     def get_all_users(self) -> List[int]:
         """Get all user IDs"""
@@ -275,6 +894,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE users SET is_banned = TRUE WHERE user_id = ?', (user_id,))
                 conn.commit()
+                self._auth_cache.invalidate(user_id)
                 return cursor.rowcount > 0
         except Exception as e:
             LOGGER(__name__).error(f"Error banning user {user_id}: {e}")
@@ -287,6 +907,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE users SET is_banned = FALSE WHERE user_id = ?', (user_id,))
                 conn.commit()
+                self._auth_cache.invalidate(user_id)
                 return cursor.rowcount > 0
         except Exception as e:
             LOGGER(__name__).error(f"Error unbanning user {user_id}: {e}")
@@ -294,8 +915,8 @@ class DatabaseManager:
     
     def is_banned(self, user_id: int) -> bool:
         """Check if user is banned"""
-        user = self.get_user(user_id)
-        return user and user.get('is_banned', False)
+        record = self.get_auth_record(user_id)
+        return bool(record and record['exists'] and record['is_banned'])
     
     def set_user_session(self, user_id: int, session_string: str = None) -> bool:
         """Set user's session string for accessing restricted content (None to logout)"""
@@ -316,36 +937,417 @@ class DatabaseManager:
         user = self.get_user(user_id)
         return user.get('session_string') if user else None
     
+    def get_user_peers(self, owner_id: int, limit: int = 5000) -> List[tuple]:
+        """Get the most recently seen peers of a Telegram account, newest first"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT peer_id, access_hash, type, username, phone_number, updated_at
+                    FROM user_peers
+                    WHERE owner_id = ?
+                    ORDER BY updated_at DESC
+                    LIMIT ?
+                ''', (owner_id, limit))
+                return cursor.fetchall()
+        except Exception as e:
+            LOGGER(__name__).error(f"Error getting peers of {owner_id}: {e}")
+            return []
+    
+    def save_user_peers(self, owner_id: int, peers: List[tuple]) -> bool:
+        """Store peers resolved by an account (buffered, cheap enough for the event loop)"""
+        self._write_buffer.add_peers(owner_id, peers)
+        self._ensure_flusher()
+        return True
+    
+    def get_cached_file(self, chat_id: int, message_id: int, file_unique_id: str) -> Optional[Dict]:
+        """Get the bot-side copy of a source file delivered before, None if not cached"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT file_id, media_type, last_used
+                    FROM file_cache
+                    WHERE chat_id = ? AND message_id = ? AND file_unique_id = ?
+                ''', (chat_id, message_id, file_unique_id))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                
+                # Recency only has to be good enough for LRU eviction, so
+                # hot entries are not rewritten on every hit
+                now = int(time.time())
+                if now - row[2] > 3600:
+                    cursor.execute('''
+                        UPDATE file_cache SET last_used = ?
+                        WHERE chat_id = ? AND message_id = ? AND file_unique_id = ?
+                    ''', (now, chat_id, message_id, file_unique_id))
+                    conn.commit()
+                
+                return {'file_id': row[0], 'media_type': row[1]}
+        except Exception as e:
+            LOGGER(__name__).error(f"Error getting cached file {chat_id}/{message_id}: {e}")
+            return None
+    
+    def cache_file(self, chat_id: int, message_id: int, file_unique_id: str, file_id: str,
+                   media_type: str) -> bool:
+        """Remember the file_id a source file was delivered as, evicting least recently used entries"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO file_cache
+                    (chat_id, message_id, file_unique_id, file_id, media_type, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id, message_id, file_unique_id) DO UPDATE SET
+                        file_id = excluded.file_id,
+                        media_type = excluded.media_type,
+                        last_used = excluded.last_used
+                ''', (chat_id, message_id, file_unique_id, file_id, media_type, int(time.time())))
+                
+                # Counting scans the table, so trim every few hundred inserts
+                self._file_cache_writes += 1
+                if self._file_cache_writes % 256 == 0:
+                    cursor.execute('SELECT COUNT(*) FROM file_cache')
+                    excess = cursor.fetchone()[0] - self.file_cache_size
+                    if excess > 0:
+                        cursor.execute('''
+                            DELETE FROM file_cache
+                            WHERE (chat_id, message_id, file_unique_id) IN (
+                                SELECT chat_id, message_id, file_unique_id FROM file_cache
+                                ORDER BY last_used
+                                LIMIT ?
+                            )
+                        ''', (excess,))
+                conn.commit()
+                return True
+        except Exception as e:
+            LOGGER(__name__).error(f"Error caching file {chat_id}/{message_id}: {e}")
+            return False
+    
+    def invalidate_cached_file(self, chat_id: int, message_id: int, file_unique_id: str) -> bool:
+        """Forget a cached file_id, e.g. after Telegram rejected it"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM file_cache
+                    WHERE chat_id = ? AND message_id = ? AND file_unique_id = ?
+                ''', (chat_id, message_id, file_unique_id))
+                conn.commit()
+                return True
+        except Exception as e:
+            LOGGER(__name__).error(f"Error invalidating cached file {chat_id}/{message_id}: {e}")
+            return False
+    
+    def enqueue_job(self, user_id: int, source_chat: str, source_message_id: int, end_message_id: int,
+                    post_url: str, request_chat_id: int, request_message_id: int,
+                    kind: str) -> tuple[Optional[int], bool]:
+        """Queue a download job, returns (job id, created); created is False for a duplicate"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                now = int(time.time())
+                cursor.execute('''
+                    INSERT INTO jobs
+                    (user_id, source_chat, source_message_id, end_message_id, next_message_id, post_url,
+                     request_chat_id, request_message_id, kind, available_at, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, source_chat, source_message_id, end_message_id) DO NOTHING
+                ''', (user_id, source_chat, source_message_id, end_message_id, source_message_id, post_url,
+                      request_chat_id, request_message_id, kind, now, now))
+                created = cursor.rowcount == 1
+                cursor.execute('''
+                    SELECT id FROM jobs
+                    WHERE user_id = ? AND source_chat = ? AND source_message_id = ? AND end_message_id = ?
+                ''', (user_id, source_chat, source_message_id, end_message_id))
+                row = cursor.fetchone()
+                conn.commit()
+                return (row[0] if row else None), created
+        except Exception as e:
+            LOGGER(__name__).error(f"Error queueing job for {user_id}: {e}")
+            return None, False
+    
+    def claim_job(self, owner: str, lease_seconds: int) -> Optional[Dict]:
+        """Lease the oldest due job, or one whose lease ran out because its worker died"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                # Another instance may take the same row first, then try the next one
+                for _ in range(5):
+                    now = int(time.time())
+                    cursor.execute('''
+                        SELECT id FROM jobs
+                        WHERE (status = 'queued' AND available_at <= ?)
+                           OR (status = 'running' AND lease_expires < ?)
+                        ORDER BY id
+                        LIMIT 1
+                    ''', (now, now))
+                    row = cursor.fetchone()
+                    if row is None:
+                        return None
+                    
+                    cursor.execute('''
+                        UPDATE jobs
+                        SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+                        WHERE id = ? AND (status = 'queued' OR lease_expires < ?)
+                    ''', (owner, now + lease_seconds, row[0], now))
+                    if cursor.rowcount != 1:
+                        conn.commit()
+                        continue
+                    
+                    cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (row[0],))
+                    job = dict(zip(JOB_COLUMNS, cursor.fetchone()))
+                    conn.commit()
+                    return job
+                return None
+        except Exception as e:
+            LOGGER(__name__).error(f"Error claiming job: {e}")
+            return None
+    
+    def renew_job_lease(self, job_id: int, owner: str, lease_seconds: int) -> bool:
+        """Extend the lease of a running job, False if it was lost to another worker"""
+        return self._update_job(job_id, '''
+            UPDATE jobs SET lease_expires = ?
+            WHERE id = ? AND lease_owner = ? AND status = 'running'
+        ''', (int(time.time()) + lease_seconds, job_id, owner))
+    
+    def advance_job(self, job_id: int, owner: str, next_message_id: int) -> bool:
+        """Record how far a batch job got, so a redelivery continues from there"""
+        return self._update_job(job_id, '''
+            UPDATE jobs SET next_message_id = ?
+            WHERE id = ? AND lease_owner = ?
+        ''', (next_message_id, job_id, owner))
+    
+    def retry_job(self, job_id: int, owner: str, delay: int, error: str) -> bool:
+        """Give a failed job back to the queue, due again after delay seconds"""
+        return self._update_job(job_id, '''
+            UPDATE jobs
+            SET status = 'queued', available_at = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?
+            WHERE id = ? AND lease_owner = ?
+        ''', (int(time.time()) + delay, error, job_id, owner))
+    
+    def release_job(self, job_id: int, owner: str, delay: int = 0) -> bool:
+        """Give a job back without counting the attempt, e.g. on shutdown or when its user is at their limit"""
+        return self._update_job(job_id, '''
+            UPDATE jobs
+            SET status = 'queued', available_at = ?, lease_owner = NULL, lease_expires = NULL,
+                attempts = attempts - 1
+            WHERE id = ? AND lease_owner = ?
+        ''', (int(time.time()) + delay, job_id, owner))
+    
+    def finish_job(self, job_id: int) -> bool:
+        return self._update_job(job_id, 'DELETE FROM jobs WHERE id = ?', (job_id,))
+    
+    def cancel_job(self, job_id: int) -> bool:
+        """Delete a job unless a worker has claimed it already"""
+        return self._update_job(job_id, "DELETE FROM jobs WHERE id = ? AND status = 'queued'", (job_id,))
+    
+    def _update_job(self, job_id: int, sql: str, params: tuple) -> bool:
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                conn.commit()
+                return cursor.rowcount == 1
+        except Exception as e:
+            LOGGER(__name__).error(f"Error updating job {job_id}: {e}")
+            return False
+    
+    def cancel_queued_jobs(self, user_id: int = None) -> List[int]:
+        """Delete jobs that have not started yet, of one user or of everyone, returns their ids"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if user_id is None:
+                    cursor.execute("SELECT id FROM jobs WHERE status = 'queued'")
+                else:
+                    cursor.execute("SELECT id FROM jobs WHERE status = 'queued' AND user_id = ?", (user_id,))
+                job_ids = [row[0] for row in cursor.fetchall()]
+                # A job a worker claimed meanwhile is left to /killall's cancellation
+                cursor.executemany(
+                    "DELETE FROM jobs WHERE id = ? AND status = 'queued'", [(job_id,) for job_id in job_ids]
+                )
+                conn.commit()
+                return job_ids
+        except Exception as e:
+            LOGGER(__name__).error(f"Error cancelling queued jobs: {e}")
+            return []
+    
+    def get_job_counts(self, user_id: int = None) -> Dict[str, int]:
+        """Queued and running jobs of all instances, of one user or of everyone"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if user_id is None:
+                    cursor.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+                else:
+                    cursor.execute('SELECT status, COUNT(*) FROM jobs WHERE user_id = ? GROUP BY status', (user_id,))
+                return {status: count for status, count in cursor.fetchall()}
+        except Exception as e:
+            LOGGER(__name__).error(f"Error counting jobs: {e}")
+            return {}
+    
+    def rollup_usage(self, retention_days: int, batch_size: int = 500) -> int:
+        """Fold one batch of daily_usage rows older than the retention window into monthly rollups"""
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, user_id, date, files_downloaded FROM daily_usage
+                    WHERE date < ?
+                    ORDER BY date
+                    LIMIT ?
+                ''', (cutoff, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    # Everything before the cutoff is in the monthly totals,
+                    # which also clears buckets left from older rollups
+                    cursor.execute(
+                        "DELETE FROM stat_buckets WHERE kind = 'downloads' AND day < ?", (cutoff,)
+                    )
+                    conn.commit()
+                    return 0
+                
+                per_user = {}
+                per_month = {}
+                per_day = {}
+                for _, user_id, date, files_downloaded in rows:
+                    month = int(date[:4] + date[5:7])
+                    files, days = per_user.get((user_id, month), (0, 0))
+                    per_user[(user_id, month)] = (files + files_downloaded, days + 1)
+                    per_month[month] = per_month.get(month, 0) + files_downloaded
+                    per_day[date] = per_day.get(date, 0) + files_downloaded
+                
+                cursor.executemany('''
+                    INSERT INTO usage_monthly (user_id, month, files_downloaded, active_days)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, month) DO UPDATE SET
+                        files_downloaded = usage_monthly.files_downloaded + excluded.files_downloaded,
+                        active_days = usage_monthly.active_days + excluded.active_days
+                ''', [key + value for key, value in per_user.items()])
+                cursor.executemany('''
+                    INSERT INTO usage_monthly_totals (month, files_downloaded)
+                    VALUES (?, ?)
+                    ON CONFLICT(month) DO UPDATE SET
+                        files_downloaded = usage_monthly_totals.files_downloaded + excluded.files_downloaded
+                ''', list(per_month.items()))
+                cursor.executemany('DELETE FROM daily_usage WHERE id = ?', [(row[0],) for row in rows])
+                # Rolled days move from the daily buckets to the monthly
+                # totals, so download trends never count them twice
+                cursor.executemany('''
+                    UPDATE stat_buckets SET value = value - ?
+                    WHERE kind = 'downloads' AND day = ?
+                ''', [(files, date) for date, files in per_day.items()])
+                cursor.execute(
+                    "DELETE FROM stat_buckets WHERE kind = 'downloads' AND day < ? AND value <= 0", (cutoff,)
+                )
+                conn.commit()
+                return len(rows)
+        except Exception as e:
+            LOGGER(__name__).error(f"Error rolling up usage: {e}")
+            return 0
+    
+    def start_usage_rollup(self, retention_days: int, interval: float = 3600,
+                           batch_size: int = 500, batch_pause: float = 0.1):
+        """Run rollup_usage in the background every interval seconds"""
+        if self._rollup is not None and self._rollup.is_alive():
+            return
+        self._rollup_stop.clear()
+        self._rollup = threading.Thread(
+            target=self._rollup_loop,
+            args=(retention_days, interval, batch_size, batch_pause),
+            name="db-rollup",
+            daemon=True
+        )
+        self._rollup.start()
+    
+    def _rollup_loop(self, retention_days: int, interval: float, batch_size: int, batch_pause: float):
+        while not self._rollup_stop.is_set():
+            total = 0
+            # Small batches with a pause in between, so the write lock is
+            # never held long enough to stall request handling
+            while not self._rollup_stop.is_set():
+                rolled = self.rollup_usage(retention_days, batch_size)
+                total += rolled
+                if rolled < batch_size:
+                    break
+                self._rollup_stop.wait(batch_pause)
+            if total:
+                LOGGER(__name__).info(f"Rolled up {total} daily usage row(s)")
+            self._rollup_stop.wait(interval)
+    
+    def get_download_trends(self, months: int = 6) -> List[tuple[int, int]]:
+        """Get (YYYYMM, files downloaded) for the most recent months, oldest first.
+        
+        Reads the monthly totals of rolled up usage and the per-day
+        'downloads' buckets of the retention window; the rollup moves a day
+        from one to the other, so neither the raw table nor history is scanned.
+        """
+        now = datetime.now()
+        first = now.year * 12 + now.month - months
+        first_month = (first // 12) * 100 + first % 12 + 1
+        first_day = f"{first_month // 100:04d}-{first_month % 100:02d}-01"
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT month, files_downloaded FROM usage_monthly_totals
+                    WHERE month >= ?
+                ''', (first_month,))
+                totals = dict(cursor.fetchall())
+                cursor.execute('''
+                    SELECT day, value FROM stat_buckets
+                    WHERE kind = 'downloads' AND day >= ?
+                ''', (first_day,))
+                for day, value in cursor.fetchall():
+                    month = int(day[:4] + day[5:7])
+                    totals[month] = totals.get(month, 0) + value
+                return sorted(totals.items())[-months:]
+        except Exception as e:
+            LOGGER(__name__).error(f"Error getting download trends: {e}")
+            return []
+    
     def get_stats(self) -> Dict:
         """Get bot statistics"""
+        self.flush_writes()
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 # Total users
-                cursor.execute('SELECT COUNT(*) FROM users')
-                total_users = cursor.fetchone()[0]
+                cursor.execute("SELECT value FROM stat_counters WHERE name = 'total_users'")
+                row = cursor.fetchone()
+                total_users = row[0] if row else 0
                 
-                # Active users (last 7 days)
-                week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-                cursor.execute('SELECT COUNT(*) FROM users WHERE last_activity > ?', (week_ago,))
-                active_users = cursor.fetchone()[0]
+                # Active users (last 7 days), from the per-day activity buckets
+                week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+                cursor.execute('''
+                    SELECT SUM(value) FROM stat_buckets
+                    WHERE kind = 'active' AND day > ?
+                ''', (week_ago,))
+                active_users = cursor.fetchone()[0] or 0
                 
-                # Paid users
+                # Paid users, from subscriptions that end in the future
+                today = datetime.now().strftime('%Y-%m-%d')
                 cursor.execute('''
-                    SELECT COUNT(*) FROM users 
-                    WHERE user_type = 'paid' AND subscription_end > date('now')
-                ''')
-                paid_users = cursor.fetchone()[0]
+                    SELECT SUM(value) FROM stat_buckets
+                    WHERE kind = 'paid' AND day > ?
+                ''', (today,))
+                paid_users = cursor.fetchone()[0] or 0
                 
                 # Admins
                 cursor.execute('SELECT COUNT(*) FROM admins')
                 admin_count = cursor.fetchone()[0]
                 
                 # Today's downloads
-                today = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute('SELECT SUM(files_downloaded) FROM daily_usage WHERE date = ?', (today,))
-                today_downloads = cursor.fetchone()[0] or 0
+                cursor.execute('''
+                    SELECT value FROM stat_buckets
+                    WHERE kind = 'downloads' AND day = ?
+                ''', (today,))
+                row = cursor.fetchone()
+                today_downloads = row[0] if row else 0
                 
                 return {
                     'total_users': total_users,
@@ -357,6 +1359,132 @@ class DatabaseManager:
         except Exception as e:
             LOGGER(__name__).error(f"Error getting stats: {e}")
             return {}
+    
+    # Async facade: same semantics as the methods above, executed on the
+    # database thread so handlers never block the event loop
+    
+    async def aadd_user(self, user_id: int, username: str = None, first_name: str = None,
+                        last_name: str = None, user_type: str = 'free') -> bool:
+        return await self._executor.submit(self.add_user, user_id, username, first_name, last_name, user_type)
+    
+    async def aget_user(self, user_id: int) -> Optional[Dict]:
+        return await self._executor.submit(self.get_user, user_id)
+    
+    async def aget_auth_snapshot(self, user_id: int) -> Dict:
+        return await self._executor.submit(self.get_auth_snapshot, user_id)
+    
+    async def aget_user_type(self, user_id: int) -> str:
+        return await self._executor.submit(self.get_user_type, user_id)
+    
+    async def ais_admin(self, user_id: int) -> bool:
+        return await self._executor.submit(self.is_admin, user_id)
+    
+    async def aadd_admin(self, user_id: int, added_by: int) -> bool:
+        return await self._executor.submit(self.add_admin, user_id, added_by)
+    
+    async def aremove_admin(self, user_id: int) -> bool:
+        return await self._executor.submit(self.remove_admin, user_id)
+    
+    async def aset_user_type(self, user_id: int, user_type: str, days: int = 30) -> bool:
+        return await self._executor.submit(self.set_user_type, user_id, user_type, days)
+    
+    async def aget_daily_usage(self, user_id: int, date: str = None) -> int:
+        return await self._executor.submit(self.get_daily_usage, user_id, date)
+    
+    async def aincrement_usage(self, user_id: int, count: int = 1) -> bool:
+        return await self._executor.submit(self.increment_usage, user_id, count)
+    
+    async def acan_download(self, user_id: int) -> tuple[bool, str]:
+        return await self._executor.submit(self.can_download, user_id)
+    
+    async def areserve_download(self, user_id: int, user_type: str) -> tuple[Optional[QuotaReservation], str]:
+        return await self._executor.submit(self.reserve_download, user_id, user_type)
+    
+    async def acommit_download(self, reservation: QuotaReservation) -> bool:
+        return await self._executor.submit(self.commit_download, reservation)
+    
+    async def arelease_download(self, reservation: QuotaReservation) -> bool:
+        return await self._executor.submit(self.release_download, reservation)
+    
+    async def aget_all_users(self) -> List[int]:
+        return await self._executor.submit(self.get_all_users)
+    
+    async def asave_broadcast(self, message: str, sent_by: int, total_users: int, successful_sends: int) -> bool:
+        return await self._executor.submit(self.save_broadcast, message, sent_by, total_users, successful_sends)
+    
+    async def aban_user(self, user_id: int) -> bool:
+        return await self._executor.submit(self.ban_user, user_id)
+    
+    async def aunban_user(self, user_id: int) -> bool:
+        return await self._executor.submit(self.unban_user, user_id)
+    
+    async def ais_banned(self, user_id: int) -> bool:
+        return await self._executor.submit(self.is_banned, user_id)
+    
+    async def aset_user_session(self, user_id: int, session_string: str = None) -> bool:
+        return await self._executor.submit(self.set_user_session, user_id, session_string)
+    
+    async def aget_user_session(self, user_id: int) -> Optional[str]:
+        return await self._executor.submit(self.get_user_session, user_id)
+    
+    async def aget_user_peers(self, owner_id: int, limit: int = 5000) -> List[tuple]:
+        return await self._executor.submit(self.get_user_peers, owner_id, limit)
+    
+    async def aget_cached_file(self, chat_id: int, message_id: int, file_unique_id: str) -> Optional[Dict]:
+        return await self._executor.submit(self.get_cached_file, chat_id, message_id, file_unique_id)
+    
+    async def acache_file(self, chat_id: int, message_id: int, file_unique_id: str, file_id: str,
+                          media_type: str) -> bool:
+        return await self._executor.submit(
+            self.cache_file, chat_id, message_id, file_unique_id, file_id, media_type
+        )
+    
+    async def ainvalidate_cached_file(self, chat_id: int, message_id: int, file_unique_id: str) -> bool:
+        return await self._executor.submit(self.invalidate_cached_file, chat_id, message_id, file_unique_id)
+    
+    async def aenqueue_job(self, user_id: int, source_chat: str, source_message_id: int, end_message_id: int,
+                           post_url: str, request_chat_id: int, request_message_id: int,
+                           kind: str) -> tuple[Optional[int], bool]:
+        return await self._executor.submit(
+            self.enqueue_job, user_id, source_chat, source_message_id, end_message_id, post_url,
+            request_chat_id, request_message_id, kind
+        )
+    
+    async def aclaim_job(self, owner: str, lease_seconds: int) -> Optional[Dict]:
+        return await self._executor.submit(self.claim_job, owner, lease_seconds)
+    
+    async def arenew_job_lease(self, job_id: int, owner: str, lease_seconds: int) -> bool:
+        return await self._executor.submit(self.renew_job_lease, job_id, owner, lease_seconds)
+    
+    async def aadvance_job(self, job_id: int, owner: str, next_message_id: int) -> bool:
+        return await self._executor.submit(self.advance_job, job_id, owner, next_message_id)
+    
+    async def aretry_job(self, job_id: int, owner: str, delay: int, error: str) -> bool:
+        return await self._executor.submit(self.retry_job, job_id, owner, delay, error)
+    
+    async def arelease_job(self, job_id: int, owner: str, delay: int = 0) -> bool:
+        return await self._executor.submit(self.release_job, job_id, owner, delay)
+    
+    async def afinish_job(self, job_id: int) -> bool:
+        return await self._executor.submit(self.finish_job, job_id)
+    
+    async def acancel_job(self, job_id: int) -> bool:
+        return await self._executor.submit(self.cancel_job, job_id)
+    
+    async def acancel_queued_jobs(self, user_id: int = None) -> List[int]:
+        return await self._executor.submit(self.cancel_queued_jobs, user_id)
+    
+    async def aget_job_counts(self, user_id: int = None) -> Dict[str, int]:
+        return await self._executor.submit(self.get_job_counts, user_id)
+    
+    async def aget_stats(self) -> Dict:
+        return await self._executor.submit(self.get_stats)
+    
+    async def aget_download_trends(self, months: int = 6) -> List[tuple[int, int]]:
+        return await self._executor.submit(self.get_download_trends, months)
 
-# Initialize database instance
-db = DatabaseManager()
\ No newline at end of file
+# Initialize database instance (DATABASE_URL selects the storage backend)
+db = DatabaseManager(
+    file_cache_size=PyroConf.FILE_CACHE_SIZE,
+    backend=create_backend(PyroConf.DATABASE_URL)
+)
\ No newline at end of file
@@ -0,0 +1,383 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+import json
+import math
+import os
+import weakref
+from collections import deque
+from time import monotonic, time
+
+from pyrogram.errors import FloodWait
+
+from logger import LOGGER
+
+# stream_media offsets and limits count chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# Smaller files finish before extra connections pay for their setup
+PARALLEL_MIN_SIZE = 20 * 1024 * 1024
+
+# Partial downloads kept for resuming, named by file_unique_id
+PARTIAL_DIR = os.path.join("downloads", ".partial")
+
+# Completed chunks are made durable and recorded this often
+SAVE_EVERY_CHUNKS = 8
+
+# One download per partial file, a second request waits and resumes it
+_partial_locks = weakref.WeakValueDictionary()
+
+
+class RangeDownloader:
+    """Fetch a file as ranges of chunks over several media connections.
+
+    Every stream_media call opens its own media session, so each worker
+    fetching a range is one connection. The download starts with
+    max_connections workers, so a short file never waits for a ramp-up.
+
+    From there the count follows the observed speed. About once per range
+    per connection, the aggregate rate is measured and one connection is
+    dropped on trial: if the rate holds within tolerance, the per-connection
+    speed of the others made up for it and the cut is kept, otherwise the
+    connection comes back and the next trial waits twice as long. A failed
+    range or a flood wait halves the connections (down to min_connections),
+    and clean ranges add them back up to the count the speed settled on.
+    """
+
+    def __init__(self, client, message, file_size: int, min_connections: int = 1,
+                 max_connections: int = 4, range_chunks: int = 16, min_range_chunks: int = 4,
+                 retries: int = 3, tolerance: float = 0.01, done: set = frozenset()):
+        self.client = client
+        self.message = message
+        self.file_size = file_size
+        self.total_chunks = max(1, math.ceil(file_size / CHUNK_SIZE))
+        # Chunks in done are already stored, only the rest is fetched
+        missing = [index for index in range(self.total_chunks) if index not in done]
+        self.remaining = len(missing)
+        # Connections beyond the client's transmission limit would only queue
+        limit = getattr(client, "max_concurrent_transmissions", max_connections) or max_connections
+        self.max_connections = max(1, min(max_connections, limit))
+        self.min_connections = max(1, min(min_connections, self.max_connections))
+        # At least two ranges per connection, unless that makes them tiny
+        self.range_chunks = max(min_range_chunks, min(range_chunks, self.remaining // (self.max_connections * 2)))
+        self.retries = retries
+        self.tolerance = tolerance
+        # Connections the observed speed justifies, target is below it only
+        # while backing off after errors
+        self.ceiling = self.max_connections
+        self.target = self.max_connections
+        self.peak = 0
+        self.window_chunks = self.max_connections * self.range_chunks
+        self._baseline = None
+        self._trial = False
+        self._settling = True
+        self._hold = 0
+        self._hold_windows = 2
+        self._ranges = deque()
+        for index in missing:
+            if self._ranges:
+                start, count = self._ranges[-1]
+                if start + count == index and count < self.range_chunks:
+                    self._ranges[-1] = (start, count + 1)
+                    continue
+            self._ranges.append((index, 1))
+        self._workers = []
+        self._active = 0
+        self._chunks = None
+
+    async def chunks(self):
+        """Yield (chunk index, bytes) in the order they arrive"""
+        # Bounded, so a slow consumer holds back the connections
+        self._chunks = asyncio.Queue(self.max_connections * 4)
+        for _ in range(self.target):
+            self._spawn()
+
+        window_started = monotonic()
+        window = 0
+        try:
+            for _ in range(self.remaining):
+                item = await self._chunks.get()
+                if isinstance(item, Exception):
+                    raise item
+                window += 1
+                if window >= self.window_chunks:
+                    now = monotonic()
+                    self._adapt(window / max(now - window_started, 1e-6))
+                    window_started, window = now, 0
+                yield item
+        finally:
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def _adapt(self, rate: float):
+        """Move the ceiling by the chunks per second of the window that just ended"""
+        if not self._ranges:
+            # Workers run out of ranges at the end, their rate says nothing
+            return
+        if self._settling:
+            # Workers leave or join at range boundaries, the window after a
+            # change still mixes both counts
+            self._settling = False
+            return
+        if self._trial:
+            self._trial = False
+            if rate < self._baseline * (1 - self.tolerance):
+                # The dropped connection carried its own share, give it back
+                self._set_ceiling(self.ceiling + 1)
+                self._hold_windows = min(self._hold_windows * 2, 32)
+                self._hold = self._hold_windows
+                return
+            # Keep the baseline, so successive cuts cannot add up to more
+            # than tolerance
+            self._hold_windows = 2
+        elif self._hold:
+            self._hold -= 1
+            return
+        else:
+            self._baseline = rate
+        # A cut late in the download cannot pay off and leaves the last
+        # ranges to fewer workers
+        if (self.ceiling > self.min_connections and self.target == self.ceiling
+                and len(self._ranges) >= 2 * self.ceiling):
+            self._trial = True
+            self._set_ceiling(self.ceiling - 1)
+
+    def _set_ceiling(self, connections: int):
+        if self.target >= self.ceiling:
+            self.target = connections
+        else:
+            self.target = min(self.target, connections)
+        self.ceiling = connections
+        self._settling = True
+        while self._ranges and self._active < self.target:
+            self._spawn()
+
+    def _spawn(self):
+        self._active += 1
+        self.peak = max(self.peak, self._active)
+        self._workers.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self):
+        try:
+            while self._ranges and self._active <= self.target:
+                start, count = self._ranges.popleft()
+                await self._fetch(start, count)
+                # A clean range wins back a connection lost to a back-off
+                if self.target < self.ceiling:
+                    self.target += 1
+                    if self._ranges and self._active < self.target:
+                        self._spawn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._chunks.put(e)
+        finally:
+            self._active -= 1
+
+    async def _fetch(self, start: int, count: int):
+        done = 0
+        attempt = 0
+        while True:
+            try:
+                async for chunk in self.client.stream_media(
+                    self.message, offset=start + done, limit=count - done
+                ):
+                    await self._chunks.put((start + done, chunk))
+                    done += 1
+                if done < count:
+                    raise ValueError(f"Range at chunk {start} ended after {done} of {count} chunks")
+                return
+            except Exception as e:
+                # Keep the chunks already delivered and resume after them
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                self.target = max(self.min_connections, self.target // 2)
+                delay = e.value if isinstance(e, FloodWait) else attempt
+                LOGGER(__name__).warning(
+                    f"Retrying range at chunk {start + done} in {delay}s with up to {self.target} connections: {e}"
+                )
+                await asyncio.sleep(delay)
+
+
+class DownloadState:
+    """Chunks of a partial download that are safely on disk.
+
+    Stored next to the partial file as JSON, with the file's identity so
+    a record of another file (or another chunk size) is never trusted.
+    The record is only written after the data it lists was flushed, so
+    after a crash every listed chunk holds what was downloaded.
+    """
+
+    def __init__(self, path: str, file_unique_id: str, file_size: int):
+        self.path = path
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        self.done = set()
+
+    def load(self, partial_path: str):
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+            if (record["file_unique_id"] == self.file_unique_id and record["file_size"] == self.file_size
+                    and record["chunk_size"] == CHUNK_SIZE
+                    and os.path.getsize(partial_path) == self.file_size):
+                self.done = {
+                    index for start, end in record["done"]
+                    for index in range(start // CHUNK_SIZE, math.ceil(end / CHUNK_SIZE))
+                }
+        except (OSError, ValueError, KeyError, TypeError):
+            self.done = set()
+
+    def save(self):
+        # Completed byte ranges, [start, end)
+        ranges = []
+        for index in sorted(self.done):
+            start, end = index * CHUNK_SIZE, min((index + 1) * CHUNK_SIZE, self.file_size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({
+                "file_unique_id": self.file_unique_id,
+                "file_size": self.file_size,
+                "chunk_size": CHUNK_SIZE,
+                "done": ranges,
+                "updated": time()
+            }, f)
+        os.replace(temp_path, self.path)
+
+    def completed_bytes(self) -> int:
+        return sum(min(CHUNK_SIZE, self.file_size - index * CHUNK_SIZE) for index in self.done)
+
+
+async def parallel_download(client, message, file_size: int, file_name: str, progress=None,
+                            progress_args: tuple = (), resume_key: str = None, attempts: int = 5,
+                            **options) -> str:
+    """Download the media of message into file_name with a RangeDownloader, returns the path.
+
+    The file is preallocated and every chunk is written at its own offset,
+    so ranges can complete in any order. With a resume_key (the media's
+    file_unique_id) the partial file and the chunks known to be on disk
+    survive errors, cancellation and restarts in PARTIAL_DIR, and the
+    next attempt only fetches what is missing. A failed attempt is retried
+    up to attempts times with exponential backoff. Without one, a partial
+    file is removed on error.
+    """
+    if resume_key is None:
+        return await _download_attempts(
+            client, message, file_size, file_name, file_name, None, progress, progress_args, attempts, options
+        )
+
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    lock = _partial_locks.setdefault(resume_key, asyncio.Lock())
+    async with lock:
+        partial_path = os.path.join(PARTIAL_DIR, f"{resume_key}.temp")
+        state = DownloadState(os.path.join(PARTIAL_DIR, f"{resume_key}.json"), resume_key, file_size)
+        state.load(partial_path)
+        if state.done:
+            LOGGER(__name__).info(
+                f"Resuming {file_name} from {len(state.done)} of "
+                f"{math.ceil(file_size / CHUNK_SIZE)} chunks on disk"
+            )
+
+        await _download_attempts(
+            client, message, file_size, file_name, partial_path, state, progress, progress_args, attempts, options
+        )
+        os.replace(partial_path, file_name)
+        os.remove(state.path)
+    return os.path.abspath(file_name)
+
+
+async def _download_attempts(client, message, file_size: int, file_name: str, target: str, state,
+                             progress, progress_args: tuple, attempts: int, options: dict):
+    attempt = 0
+    while True:
+        try:
+            await _download_once(client, message, file_size, file_name, target, state, progress, progress_args, options)
+            return os.path.abspath(target)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt >= attempts:
+                raise
+            delay = min(2 ** attempt, 60)
+            LOGGER(__name__).warning(
+                f"Download of {file_name} failed (attempt {attempt} of {attempts}), retrying in {delay}s: {e}"
+            )
+            await asyncio.sleep(delay)
+
+
+async def _download_once(client, message, file_size: int, file_name: str, target: str, state,
+                         progress, progress_args: tuple, options: dict):
+    done = state.done if state is not None else set()
+    downloader = RangeDownloader(client, message, file_size, done=done, **options)
+    LOGGER(__name__).info(
+        f"Downloading {file_name} ({downloader.remaining} of {downloader.total_chunks} chunks) "
+        f"over up to {downloader.max_connections} connections"
+    )
+
+    chunks = downloader.chunks()
+    flags = os.O_RDWR | os.O_CREAT | (0 if state is not None else os.O_TRUNC)
+    fd = os.open(target, flags, 0o644)
+    unsaved = 0
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, file_size)
+        else:
+            os.ftruncate(fd, file_size)
+
+        current = state.completed_bytes() if state is not None else 0
+        async for index, chunk in chunks:
+            await asyncio.to_thread(os.pwrite, fd, chunk, index * CHUNK_SIZE)
+            current += len(chunk)
+            if state is not None:
+                done.add(index)
+                unsaved += 1
+                if unsaved >= SAVE_EVERY_CHUNKS:
+                    await asyncio.to_thread(_checkpoint, fd, state)
+                    unsaved = 0
+            if progress:
+                await progress(current, file_size, *progress_args)
+    except BaseException:
+        if state is None:
+            os.remove(target)
+        raise
+    finally:
+        # Stops the remaining connections when the download failed
+        await chunks.aclose()
+        if state is not None and unsaved:
+            # Keep what arrived, also when the job was cancelled
+            _checkpoint(fd, state)
+        os.close(fd)
+
+    LOGGER(__name__).info(f"Downloaded {file_name} using up to {downloader.peak} connections")
+
+
+def _checkpoint(fd: int, state: DownloadState):
+    """Flush the written chunks, then record them"""
+    os.fsync(fd)
+    state.save()
+
+
+def prune_partials(max_age: float = 86400) -> int:
+    """Remove partial downloads nobody resumed within max_age seconds, returns how many"""
+    removed = 0
+    if not os.path.isdir(PARTIAL_DIR):
+        return removed
+    cutoff = time() - max_age
+    for name in os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += name.endswith(".temp")
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,77 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+from typing import Optional, Dict
+
+from database import db
+from logger import LOGGER
+
+# Media kinds the bot delivers, in the order Message exposes them
+MEDIA_TYPES = ("photo", "video", "audio", "document", "animation", "voice")
+
+
+def message_media(message):
+    """The media of a message and its kind, (None, None) when it has none we deliver"""
+    for media_type in MEDIA_TYPES:
+        media = getattr(message, media_type, None)
+        if media is not None:
+            return media, media_type
+    return None, None
+
+
+async def get_delivered(chat_message) -> Optional[Dict]:
+    """Cache entry of a source post delivered before, None if there is none"""
+    media, _ = message_media(chat_message)
+    if media is None:
+        return None
+    return await db.aget_cached_file(chat_message.chat.id, chat_message.id, media.file_unique_id)
+
+
+async def forget_delivered(chat_message):
+    media, _ = message_media(chat_message)
+    if media is not None:
+        await db.ainvalidate_cached_file(chat_message.chat.id, chat_message.id, media.file_unique_id)
+
+
+async def remember_delivered(chat_message, sent):
+    """Store the file_id of the bot's copy of chat_message.
+
+    A file_id re-send keeps the duration, dimensions and thumbnail Telegram
+    stored with the file, so only the id and the media kind are kept.
+    """
+    media, _ = message_media(chat_message)
+    sent_media, sent_type = message_media(sent)
+    if media is None or sent_media is None:
+        return
+
+    await db.acache_file(
+        chat_message.chat.id,
+        chat_message.id,
+        media.file_unique_id,
+        sent_media.file_id,
+        sent_type,
+    )
+
+
+async def send_delivered(message, chat_message, caption) -> bool:
+    """Re-send a cached copy of chat_message by file_id.
+
+    Returns False when there is no cache entry or Telegram rejected the
+    file_id, in which case the entry is dropped and the caller should
+    download the file again.
+    """
+    cached = await get_delivered(chat_message)
+    if cached is None:
+        return False
+
+    try:
+        await message.reply_cached_media(cached["file_id"], caption=caption or "")
+    except Exception as e:
+        LOGGER(__name__).warning(
+            f"Cached file of {chat_message.chat.id}/{chat_message.id} was rejected: {e}"
+        )
+        await forget_delivered(chat_message)
+        return False
+
+    LOGGER(__name__).info(f"Re-sent cached file of {chat_message.chat.id}/{chat_message.id}")
+    return True
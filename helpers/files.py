@@ -5,16 +5,21 @@ import os
 from typing import Optional
 
 from logger import LOGGER
+from resources import resource_admission
 
 SIZE_UNITS = ["B", "KB", "MB", "GB", "TB", "PB"]
 
-def get_download_path(folder_id: int, filename: str, root_dir: str = "downloads") -> str:
+def get_download_path(folder_id, filename: str, root_dir: str = "downloads") -> str:
     folder = os.path.join(root_dir, str(folder_id))
     os.makedirs(folder, exist_ok=True)
-    return os.path.join(folder, filename)
+    # Absolute, Pyrogram resolves relative names against the script's folder
+    # rather than the working directory the reservation was made in
+    return os.path.abspath(os.path.join(folder, filename))
 
 
 def cleanup_download(path: str) -> None:
+    # The file is gone (or never finished), its disk reservation with it
+    resource_admission.release(path)
     try:
         LOGGER(__name__).info(f"Cleaning Download: {path}")
         
@@ -22,6 +27,8 @@ def cleanup_download(path: str) -> None:
             os.remove(path)
         if os.path.exists(path + ".temp"):
             os.remove(path + ".temp")
+        if os.path.exists(path + ".thumb.jpg"):
+            os.remove(path + ".thumb.jpg")
 
         folder = os.path.dirname(path)
         if os.path.isdir(folder) and not os.listdir(folder):
@@ -62,8 +69,12 @@ def get_readable_time(seconds) -> str:
     return result
 
 
+def max_file_size(is_premium=False) -> int:
+    return 2 * 2097152000 if is_premium else 2097152000
+
+
 async def fileSizeLimit(file_size, message, action_type="download", is_premium=False):
-    MAX_FILE_SIZE = 2 * 2097152000 if is_premium else 2097152000
+    MAX_FILE_SIZE = max_file_size(is_premium)
     if file_size > MAX_FILE_SIZE:
         await message.reply(
             f"The file size exceeds the {get_readable_file_size(MAX_FILE_SIZE)} limit and cannot be {action_type}ed."
@@ -42,7 +42,7 @@ def getChatMsgID(link: str):
 
 def get_file_name(message_id: int, chat_message) -> str:
     if chat_message.document:
-        return chat_message.document.file_name
+        return chat_message.document.file_name or f"{message_id}"
     elif chat_message.video:
         return chat_message.video.file_name or f"{message_id}.mp4"
     elif chat_message.audio:
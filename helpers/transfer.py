@@ -0,0 +1,112 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+from hashlib import md5
+
+from pyrogram import raw, types, utils
+
+from logger import LOGGER
+from helpers.downloader import CHUNK_SIZE, PARALLEL_MIN_SIZE, RangeDownloader
+from helpers.files import fileSizeLimit
+from helpers.msg import get_file_name
+from helpers.uploader import PART_SIZE, PartUploader
+from helpers.utils import progressArgs, transfer_progress
+
+
+def can_relay(chat_message) -> bool:
+    """Documents and audio are re-sent unchanged, so they never need the disk"""
+    return bool(chat_message.document or chat_message.audio)
+
+
+async def _numbered(stream):
+    index = 0
+    async for chunk in stream:
+        yield index, chunk
+        index += 1
+
+
+async def relay_media(
+    source_client, bot, message, chat_message, caption, progress_message, start_time,
+    parts_in_flight=8, connections=4
+):
+    """Stream a document or audio file from source_client into a bot upload.
+
+    Parts go straight from the source stream into a PartUploader, so the
+    download and upload overlap and only about 2 * parts_in_flight parts
+    are held in memory. Big files are read over up to `connections`
+    parallel media connections, their parts are uploaded by index so
+    arrival order does not matter.
+    Returns the sent Message, or None if the file is over the upload limit.
+    """
+    media = chat_message.document or chat_message.audio
+    file_size = media.file_size
+    if not await fileSizeLimit(file_size, message, "upload"):
+        return None
+
+    file_name = get_file_name(chat_message.id, chat_message) or str(chat_message.id)
+    uploader = PartUploader(
+        bot, file_size, parts_in_flight,
+        progress=transfer_progress,
+        progress_args=progressArgs("📤 Relaying Progress", progress_message, start_time)
+    )
+    digest = None if uploader.is_big else md5()
+    LOGGER(__name__).info(
+        f"Relaying media: {file_name} ({file_size} bytes, {uploader.total_parts} parts)"
+    )
+
+    if uploader.is_big and file_size >= PARALLEL_MIN_SIZE:
+        source = RangeDownloader(
+            source_client, chat_message, file_size, max_connections=connections
+        ).chunks()
+    else:
+        source = _numbered(source_client.stream_media(chat_message))
+
+    await uploader.start()
+    try:
+        count = 0
+        async for chunk_index, chunk in source:
+            for start in range(0, len(chunk), PART_SIZE):
+                part = chunk[start:start + PART_SIZE]
+                if digest is not None:
+                    digest.update(part)
+                await uploader.put(chunk_index * (CHUNK_SIZE // PART_SIZE) + start // PART_SIZE, part)
+                count += 1
+
+        if count != uploader.total_parts:
+            raise ValueError(f"Source stream ended after {count} of {uploader.total_parts} parts")
+        input_file = await uploader.finish(
+            file_name, digest.hexdigest() if digest is not None else ""
+        )
+    finally:
+        await source.aclose()
+        await uploader.close()
+
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if chat_message.audio:
+        audio = chat_message.audio
+        attributes.append(raw.types.DocumentAttributeAudio(
+            duration=audio.duration or 0,
+            performer=audio.performer,
+            title=audio.title
+        ))
+
+    r = await bot.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await bot.resolve_peer(message.chat.id),
+            media=raw.types.InputMediaUploadedDocument(
+                mime_type=media.mime_type or "application/octet-stream",
+                file=input_file,
+                attributes=attributes
+            ),
+            random_id=bot.rnd_id(),
+            **await utils.parse_text_entities(bot, caption or "", None, None)
+        )
+    )
+
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                bot, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
@@ -0,0 +1,205 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+import inspect
+import math
+import os
+from hashlib import md5
+from pathlib import PurePath
+
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+from logger import LOGGER
+
+# Telegram takes upload parts of 512 KB
+PART_SIZE = 512 * 1024
+
+# Files above this size must be uploaded with SaveBigFilePart
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+# In-flight parts sharing one media session
+PARTS_PER_SESSION = 4
+
+
+class PartUploader:
+    """Upload the parts of one file with several of them in flight.
+
+    Parts are handed in with put() in any order and sent by
+    parts_in_flight workers spread over media sessions of the client. A
+    failing part is retried on its own with backoff; if its session
+    dropped, the session is replaced first. Parts Telegram already stored
+    stay valid, so a transient disconnect only repeats the parts that
+    were in flight.
+    """
+
+    def __init__(self, client: Client, file_size: int, parts_in_flight: int = 8,
+                 retries: int = 5, progress=None, progress_args: tuple = ()):
+        self.client = client
+        self.file_size = file_size
+        self.total_parts = max(1, math.ceil(file_size / PART_SIZE))
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.file_id = client.rnd_id()
+        self.parts_in_flight = max(1, parts_in_flight)
+        self.retries = retries
+        self.progress = progress
+        self.progress_args = progress_args
+        self.uploaded = 0
+        self._parts = asyncio.Queue(self.parts_in_flight)
+        self._sessions = []
+        self._workers = []
+        self._failure = None
+        self._reconnecting = asyncio.Lock()
+
+    async def _new_session(self) -> Session:
+        session = Session(
+            self.client, await self.client.storage.dc_id(), await self.client.storage.auth_key(),
+            await self.client.storage.test_mode(), is_media=True
+        )
+        await session.start()
+        return session
+
+    async def start(self):
+        for _ in range(math.ceil(self.parts_in_flight / PARTS_PER_SESSION)):
+            self._sessions.append(await self._new_session())
+        self._workers = [
+            asyncio.create_task(self._worker(index % len(self._sessions)))
+            for index in range(self.parts_in_flight)
+        ]
+
+    async def put(self, index: int, data: bytes):
+        if self._failure is not None:
+            raise self._failure
+        await self._parts.put((index, data))
+
+    async def finish(self, file_name: str, md5_checksum: str = ""):
+        """Wait for every part and return the InputFile to send"""
+        for _ in self._workers:
+            await self._parts.put(None)
+        await asyncio.gather(*self._workers)
+        if self._failure is not None:
+            raise self._failure
+
+        if self.is_big:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=file_name)
+        return raw.types.InputFile(
+            id=self.file_id, parts=self.total_parts, name=file_name, md5_checksum=md5_checksum
+        )
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for session in self._sessions:
+            try:
+                await session.stop()
+            except Exception:
+                pass
+
+    async def _worker(self, slot: int):
+        while True:
+            item = await self._parts.get()
+            if item is None:
+                return
+            if self._failure is not None:
+                # Keep draining so the producer never blocks on a dead upload
+                continue
+
+            index, data = item
+            if self.is_big:
+                rpc = raw.functions.upload.SaveBigFilePart(
+                    file_id=self.file_id, file_part=index, file_total_parts=self.total_parts, bytes=data
+                )
+            else:
+                rpc = raw.functions.upload.SaveFilePart(file_id=self.file_id, file_part=index, bytes=data)
+
+            try:
+                await self._send(slot, rpc)
+                self.uploaded += len(data)
+                if self.progress:
+                    result = self.progress(self.uploaded, self.file_size, *self.progress_args)
+                    if inspect.isawaitable(result):
+                        await result
+            except Exception as e:
+                self._failure = e
+
+    async def _send(self, slot: int, rpc):
+        attempt = 0
+        while True:
+            session = self._sessions[slot]
+            try:
+                return await session.invoke(rpc)
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                LOGGER(__name__).warning(f"Retrying part {rpc.file_part} (attempt {attempt}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                await self._reconnect(slot, session)
+
+    async def _reconnect(self, slot: int, session: Session):
+        async with self._reconnecting:
+            # Another worker may have replaced it, or it reconnected by itself
+            if self._sessions[slot] is not session or session.is_started.is_set():
+                return
+            try:
+                await session.stop()
+            except Exception:
+                pass
+            self._sessions[slot] = await self._new_session()
+
+
+async def upload_file(client: Client, path: str, progress=None, progress_args: tuple = (),
+                      parts_in_flight: int = 8, retries: int = 5):
+    """Upload the file at path with a PartUploader, returns the InputFile"""
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        raise ValueError("File size equals to 0 B")
+    limit_mib = 4000 if client.me and client.me.is_premium else 2000
+    if file_size > limit_mib * 1024 * 1024:
+        raise ValueError(f"Can't upload files bigger than {limit_mib} MiB")
+
+    uploader = PartUploader(client, file_size, parts_in_flight, retries, progress, progress_args)
+    digest = None if uploader.is_big else md5()
+
+    await uploader.start()
+    try:
+        with open(path, "rb") as f:
+            for index in range(uploader.total_parts):
+                data = await asyncio.to_thread(f.read, PART_SIZE)
+                if digest is not None:
+                    digest.update(data)
+                await uploader.put(index, data)
+        return await uploader.finish(
+            os.path.basename(path), digest.hexdigest() if digest is not None else ""
+        )
+    finally:
+        await uploader.close()
+
+
+class ParallelUploadClient(Client):
+    """Client whose file uploads keep several parts in flight.
+
+    Every send method that takes a file path (reply_video, send_document,
+    send_media_group, ...) uploads through save_file, so overriding it
+    covers all of them. File objects and Pyrogram's re-upload of a single
+    missing part still take the stock implementation.
+    """
+
+    def __init__(self, *args, parts_in_flight: int = 8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parts_in_flight = parts_in_flight
+
+    async def save_file(self, path, file_id: int = None, file_part: int = 0,
+                        progress=None, progress_args: tuple = ()):
+        if file_id is not None or not isinstance(path, (str, PurePath)):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+        async with self.save_file_semaphore:
+            return await upload_file(
+                self, str(path), progress, progress_args, parts_in_flight=self.parts_in_flight
+            )
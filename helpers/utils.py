@@ -2,8 +2,8 @@
 # Channel: https://t.me/Wolfy004
 
 import os
+import json
 from time import time
-from PIL import Image
 from logger import LOGGER
 from typing import Optional
 from asyncio.subprocess import PIPE
@@ -22,11 +22,23 @@ from pyrogram.types import (
 
 from helpers.files import (
     fileSizeLimit,
+    get_download_path,
     cleanup_download
 )
 
 from helpers.msg import (
-    get_parsed_msg
+    get_parsed_msg,
+    get_file_name
+)
+
+from scheduler import transfer_scheduler
+from resources import resource_admission
+
+from helpers.file_cache import (
+    message_media,
+    get_delivered,
+    forget_delivered,
+    remember_delivered
 )
 
 # Progress bar template
@@ -37,11 +49,13 @@ Estimated Time Left: {est_time} seconds
 """
 
 async def cmd_exec(cmd, shell=False):
-    if shell:
-        proc = await create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE)
-    else:
-        proc = await create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = await proc.communicate()
+    # ffmpeg and ffprobe runs share the scheduler's ffmpeg slots
+    async with transfer_scheduler.slot("ffmpeg"):
+        if shell:
+            proc = await create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE)
+        else:
+            proc = await create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = await proc.communicate()
     try:
         stdout = stdout.decode().strip()
     except:
@@ -60,10 +74,14 @@ async def get_media_info(path):
             "-print_format", "json", "-show_format", path,
         ])
     except Exception as e:
-        print(f"Get Media Info: {e}. Mostly File not found! - File: {path}")
+        LOGGER(__name__).error(f"Get Media Info: {e}. Mostly File not found! - File: {path}")
         return 0, None, None
     if result[0] and result[2] == 0:
-        fields = eval(result[0]).get("format")
+        try:
+            fields = json.loads(result[0]).get("format")
+        except ValueError as e:
+            LOGGER(__name__).warning(f"Unreadable ffprobe output for {path}: {e}")
+            return 0, None, None
         if not fields:
             return 0, None, None
         duration = round(float(fields.get("duration", 0)))
@@ -75,7 +93,8 @@ async def get_media_info(path):
 
 
 async def get_video_thumbnail(video_file, duration):
-    output = os.path.join("Assets", "video_thumb.jpg")
+    # Next to the video, so concurrent uploads do not share a thumbnail
+    output = video_file + ".thumb.jpg"
     if duration is None:
         duration = (await get_media_info(video_file))[0]
     if not duration:
@@ -96,195 +115,282 @@ async def get_video_thumbnail(video_file, duration):
     return output
 
 
+# Input media classes for file_ids cached per delivered media kind
+GROUP_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+
 # Generate progress bar for downloading/uploading
 def progressArgs(action: str, progress_message, start_time):
     return (action, progress_message, start_time, PROGRESS_BAR, "▓", "░")
 
 
+async def transfer_progress(current, total, *args):
+    """Progress callback of every transfer, also where the scheduler can pause the job"""
+    await transfer_scheduler.checkpoint()
+    await Leaves.progress_for_pyrogram(current, total, *args)
+
+
+async def prepare_media(media_path, media_type):
+    """Probe duration, tags and thumbnail of a downloaded file, returns the extra send arguments"""
+    if media_type == "video":
+        duration = (await get_media_info(media_path))[0]
+        thumb = await get_video_thumbnail(media_path, duration)
+        if thumb is not None and thumb != "none":
+            # Imported lazily, Pillow is only needed for video thumbnails
+            from PIL import Image
+
+            with Image.open(thumb) as img:
+                width, height = img.size
+        else:
+            width = 480
+            height = 320
+
+        if thumb == "none":
+            thumb = None
+
+        return {"duration": duration, "width": width, "height": height, "thumb": thumb}
+    elif media_type == "audio":
+        duration, artist, title = await get_media_info(media_path)
+        return {"duration": duration, "performer": artist, "title": title}
+    return {}
+
+
+async def checkpoint_progress(current, total):
+    """Progress callback of transfers without a progress message"""
+    await transfer_scheduler.checkpoint()
+
+
 async def send_media(
-    bot, message, media_path, media_type, caption, progress_message, start_time
+    bot, message, media_path, media_type, caption, progress_message, start_time, prepared=None
 ):
     file_size = os.path.getsize(media_path)
 
     if not await fileSizeLimit(file_size, message, "upload"):
         return
 
-    progress_args = progressArgs("📥 Uploading Progress", progress_message, start_time)
+    if progress_message is not None:
+        progress = transfer_progress
+        progress_args = progressArgs("📥 Uploading Progress", progress_message, start_time)
+    else:
+        progress, progress_args = checkpoint_progress, ()
     LOGGER(__name__).info(f"Uploading media: {media_path} ({media_type})")
 
+    if prepared is None:
+        prepared = await prepare_media(media_path, media_type)
+
     if media_type == "photo":
-        await message.reply_photo(
+        return await message.reply_photo(
             media_path,
             caption=caption or "",
-            progress=Leaves.progress_for_pyrogram,
+            progress=progress,
             progress_args=progress_args,
         )
     elif media_type == "video":
-        if os.path.exists("Assets/video_thumb.jpg"):
-            os.remove("Assets/video_thumb.jpg")
-        duration = (await get_media_info(media_path))[0]
-        thumb = await get_video_thumbnail(media_path, duration)
-        if thumb is not None and thumb != "none":
-            with Image.open(thumb) as img:
-                width, height = img.size
-        else:
-            width = 480
-            height = 320
-
-        if thumb == "none":
-            thumb = None
-
-        await message.reply_video(
+        return await message.reply_video(
             media_path,
-            duration=duration,
-            width=width,
-            height=height,
-            thumb=thumb,
             caption=caption or "",
-            progress=Leaves.progress_for_pyrogram,
+            progress=progress,
             progress_args=progress_args,
+            **prepared,
         )
     elif media_type == "audio":
-        duration, artist, title = await get_media_info(media_path)
-        await message.reply_audio(
+        return await message.reply_audio(
             media_path,
-            duration=duration,
-            performer=artist,
-            title=title,
             caption=caption or "",
-            progress=Leaves.progress_for_pyrogram,
+            progress=progress,
             progress_args=progress_args,
+            **prepared,
         )
     elif media_type == "document":
-        await message.reply_document(
+        return await message.reply_document(
             media_path,
             caption=caption or "",
-            progress=Leaves.progress_for_pyrogram,
+            progress=progress,
             progress_args=progress_args,
         )
 
 
-async def processMediaGroup(chat_message, bot, message):
-    media_group_messages = await chat_message.get_media_group()
-    valid_media = []
-    temp_paths = []
-    invalid_paths = []
+async def send_input_media(bot, chat_id, media):
+    if isinstance(media, InputMediaPhoto):
+        return await bot.send_photo(
+            chat_id=chat_id,
+            photo=media.media,
+            caption=media.caption,
+        )
+    elif isinstance(media, InputMediaVideo):
+        return await bot.send_video(
+            chat_id=chat_id,
+            video=media.media,
+            caption=media.caption,
+        )
+    elif isinstance(media, InputMediaDocument):
+        return await bot.send_document(
+            chat_id=chat_id,
+            document=media.media,
+            caption=media.caption,
+        )
+    elif isinstance(media, InputMediaAudio):
+        return await bot.send_audio(
+            chat_id=chat_id,
+            audio=media.media,
+            caption=media.caption,
+        )
+    elif isinstance(media, Voice):
+        return await bot.send_voice(
+            chat_id=chat_id,
+            voice=media.media,
+            caption=media.caption,
+        )
 
-    start_time = time()
-    progress_message = await message.reply("📥 Downloading media group...")
-    LOGGER(__name__).info(
-        f"Downloading media group with {len(media_group_messages)} items..."
-    )
 
-    for msg in media_group_messages:
-        if msg.photo or msg.video or msg.document or msg.audio:
+class MediaGroup:
+    """Album members ready to send: their input media, source messages and downloaded files"""
+
+    def __init__(self):
+        self.media = []
+        self.sources = []
+        self.cached_ids = set()
+        self.paths = []
+
+
+async def download_media_group(message, media_group_messages, progress=checkpoint_progress, progress_args=()):
+    """Download the members of an album for sending in reply to message.
+
+    Each member takes its own disk reservation and download slot, and
+    members delivered before are sent by file_id. Members that fail to
+    download are left out.
+    """
+    group = MediaGroup()
+    try:
+        for msg in media_group_messages:
+            if not (msg.photo or msg.video or msg.document or msg.audio):
+                continue
+            caption = await get_parsed_msg(msg.caption or "", msg.caption_entities)
+
+            # Members delivered before go out by file_id, without a download
+            cached = await get_delivered(msg)
+            if cached and cached["media_type"] in GROUP_MEDIA:
+                group.media.append(GROUP_MEDIA[cached["media_type"]](media=cached["file_id"], caption=caption))
+                group.sources.append(msg)
+                group.cached_ids.add(msg.id)
+                continue
+
+            media_path = None
             try:
-                media_path = await msg.download(
-                    progress=Leaves.progress_for_pyrogram,
-                    progress_args=progressArgs(
-                        "📥 Downloading Progress", progress_message, start_time
-                    ),
-                )
-                temp_paths.append(media_path)
+                media, _ = message_media(msg)
+                # A folder per member, documents of an album may share a file name
+                media_path = get_download_path(f"{message.id}-{msg.id}", get_file_name(msg.id, msg))
+                await resource_admission.reserve(media_path, media.file_size or 0)
+                async with transfer_scheduler.slot("download", media.file_size or 0):
+                    media_path = await msg.download(
+                        file_name=media_path,
+                        progress=progress,
+                        progress_args=progress_args,
+                    )
+                group.paths.append(media_path)
 
                 if msg.photo:
-                    valid_media.append(
-                        InputMediaPhoto(
-                            media=media_path,
-                            caption=await get_parsed_msg(
-                                msg.caption or "", msg.caption_entities
-                            ),
-                        )
-                    )
+                    group.media.append(InputMediaPhoto(media=media_path, caption=caption))
                 elif msg.video:
-                    valid_media.append(
-                        InputMediaVideo(
-                            media=media_path,
-                            caption=await get_parsed_msg(
-                                msg.caption or "", msg.caption_entities
-                            ),
-                        )
-                    )
+                    group.media.append(InputMediaVideo(media=media_path, caption=caption))
                 elif msg.document:
-                    valid_media.append(
-                        InputMediaDocument(
-                            media=media_path,
-                            caption=await get_parsed_msg(
-                                msg.caption or "", msg.caption_entities
-                            ),
-                        )
-                    )
+                    group.media.append(InputMediaDocument(media=media_path, caption=caption))
                 elif msg.audio:
-                    valid_media.append(
-                        InputMediaAudio(
-                            media=media_path,
-                            caption=await get_parsed_msg(
-                                msg.caption or "", msg.caption_entities
-                            ),
-                        )
-                    )
+                    group.media.append(InputMediaAudio(media=media_path, caption=caption))
+                group.sources.append(msg)
 
             except Exception as e:
                 LOGGER(__name__).info(f"Error downloading media: {e}")
-                if media_path and os.path.exists(media_path):
-                    invalid_paths.append(media_path)
+                if media_path:
+                    # Removes a partial file and releases the disk reservation
+                    cleanup_download(media_path)
                 continue
+    except BaseException:
+        for path in group.paths:
+            cleanup_download(path)
+        raise
 
-    LOGGER(__name__).info(f"Valid media count: {len(valid_media)}")
+    LOGGER(__name__).info(f"Valid media count: {len(group.media)}")
+    return group
 
-    if valid_media:
-        try:
-            await bot.send_media_group(chat_id=message.chat.id, media=valid_media)
-            await progress_message.delete()
-        except Exception:
-            await message.reply(
-                "**❌ Failed to send media group, trying individual uploads**"
-            )
-            for media in valid_media:
-                try:
-                    if isinstance(media, InputMediaPhoto):
-                        await bot.send_photo(
-                            chat_id=message.chat.id,
-                            photo=media.media,
-                            caption=media.caption,
-                        )
-                    elif isinstance(media, InputMediaVideo):
-                        await bot.send_video(
-                            chat_id=message.chat.id,
-                            video=media.media,
-                            caption=media.caption,
-                        )
-                    elif isinstance(media, InputMediaDocument):
-                        await bot.send_document(
-                            chat_id=message.chat.id,
-                            document=media.media,
-                            caption=media.caption,
-                        )
-                    elif isinstance(media, InputMediaAudio):
-                        await bot.send_audio(
-                            chat_id=message.chat.id,
-                            audio=media.media,
-                            caption=media.caption,
-                        )
-                    elif isinstance(media, Voice):
-                        await bot.send_voice(
-                            chat_id=message.chat.id,
-                            voice=media.media,
-                            caption=media.caption,
-                        )
-                except Exception as individual_e:
-                    await message.reply(
-                        f"Failed to upload individual media: {individual_e}"
-                    )
 
-            await progress_message.delete()
+async def send_media_group(bot, message, group, progress_message=None, start_time=None) -> bool:
+    """Send a downloaded album in reply to message and remove its files, False if it had no valid media"""
+    if progress_message is not None:
+        progress = transfer_progress
+        progress_args = progressArgs("📥 Downloading Progress", progress_message, start_time)
+    else:
+        progress, progress_args = checkpoint_progress, ()
 
-        for path in temp_paths + invalid_paths:
-            cleanup_download(path)
+    try:
+        if not group.media:
+            await message.reply("❌ No valid media found in the media group.")
+            return False
+
+        async with transfer_scheduler.slot("upload"):
+            try:
+                sent = await bot.send_media_group(chat_id=message.chat.id, media=group.media)
+                for msg, sent_msg in zip(group.sources, sent):
+                    if msg.id not in group.cached_ids:
+                        await remember_delivered(msg, sent_msg)
+            except Exception:
+                await message.reply(
+                    "**❌ Failed to send media group, trying individual uploads**"
+                )
+                for msg, media in zip(group.sources, group.media):
+                    try:
+                        try:
+                            sent_msg = await send_input_media(bot, message.chat.id, media)
+                        except Exception:
+                            if msg.id not in group.cached_ids:
+                                raise
+                            # Telegram no longer accepts the cached file_id,
+                            # fetch the file again
+                            await forget_delivered(msg)
+                            group.cached_ids.discard(msg.id)
+                            path = get_download_path(f"{message.id}-{msg.id}", get_file_name(msg.id, msg))
+                            group.paths.append(path)
+                            await resource_admission.reserve(path, message_media(msg)[0].file_size or 0)
+                            media.media = await msg.download(
+                                file_name=path,
+                                progress=progress,
+                                progress_args=progress_args,
+                            )
+                            sent_msg = await send_input_media(bot, message.chat.id, media)
+
+                        if msg.id not in group.cached_ids:
+                            await remember_delivered(msg, sent_msg)
+                    except Exception as individual_e:
+                        await message.reply(
+                            f"Failed to upload individual media: {individual_e}"
+                        )
         return True
+    finally:
+        for path in group.paths:
+            cleanup_download(path)
+
 
-    await progress_message.delete()
-    await message.reply("❌ No valid media found in the media group.")
-    for path in invalid_paths:
-        cleanup_download(path)
-    return False
+async def processMediaGroup(chat_message, bot, message):
+    media_group_messages = await chat_message.get_media_group()
+
+    start_time = time()
+    progress_message = await message.reply("📥 Downloading media group...")
+    LOGGER(__name__).info(
+        f"Downloading media group with {len(media_group_messages)} items..."
+    )
+
+    group = await download_media_group(
+        message,
+        media_group_messages,
+        progress=transfer_progress,
+        progress_args=progressArgs("📥 Downloading Progress", progress_message, start_time),
+    )
+    try:
+        return await send_media_group(bot, message, group, progress_message, start_time)
+    finally:
+        await progress_message.delete()
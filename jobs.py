@@ -0,0 +1,157 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+import uuid
+from typing import Optional, Dict
+from config import PyroConf
+from database import db
+from logger import LOGGER
+
+
+class JobDeferred(Exception):
+    """Raised by a runner to put its job back unstarted, due again after retry_after seconds"""
+    
+    def __init__(self, retry_after: float):
+        super().__init__(f"Deferred for {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """Download jobs kept in the jobs table and run by a bounded worker pool.
+    
+    A request is stored before any work starts. Workers lease the oldest
+    due job, renew the lease with heartbeats while it runs and delete the
+    row once it is done. A failed job is queued again with exponential
+    backoff until max_attempts; the last attempt reports its own errors.
+    When a worker dies with the process its lease runs out and the job is
+    redelivered, and jobs interrupted by a clean shutdown are handed back
+    right away. The unique key of the table turns a re-pasted link into
+    the job already queued. A runner that may not start its job yet,
+    e.g. while the user is at their limits, raises JobDeferred.
+    """
+    
+    def __init__(self, workers: int, lease_seconds: int = 60, max_attempts: int = 3,
+                 poll_interval: float = 2.0):
+        self.owner = uuid.uuid4().hex
+        self.workers = max(1, workers)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self.stopping = False
+        self.running = {}
+        self._runner = None
+        self._dispatcher = None
+        self._capacity = None
+        self._wakeup = None
+    
+    async def enqueue(self, user_id: int, source_chat, source_message_id: int, post_url: str,
+                      message, end_message_id: int = None, kind: str = "post") -> tuple[Optional[int], bool]:
+        """Store a job for the request message, returns (job id, created)"""
+        job_id, created = await db.aenqueue_job(
+            user_id, str(source_chat), source_message_id,
+            source_message_id if end_message_id is None else end_message_id,
+            post_url, message.chat.id, message.id, kind
+        )
+        if created and self._wakeup is not None:
+            self._wakeup.set()
+        return job_id, created
+    
+    def start(self, runner):
+        """Start dispatching jobs to runner(job, final_attempt)"""
+        self._runner = runner
+        self._capacity = asyncio.Semaphore(self.workers)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+    
+    async def stop(self):
+        """Stop taking jobs and hand the running ones back to the queue"""
+        self.stopping = True
+        tasks = list(self.running.values())
+        if self._dispatcher is not None:
+            tasks.append(self._dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def cancel_queued(self, user_id: int = None) -> int:
+        """Drop jobs that have not started yet, of one user or of everyone, returns how many"""
+        return len(await db.acancel_queued_jobs(user_id))
+    
+    async def _dispatch(self):
+        while True:
+            await self._capacity.acquire()
+            try:
+                job = await db.aclaim_job(self.owner, self.lease_seconds)
+            except BaseException:
+                self._capacity.release()
+                raise
+            if job is None:
+                self._capacity.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            task = asyncio.create_task(self._run(job))
+            self.running[job['id']] = task
+            task.add_done_callback(lambda _, job_id=job['id']: self._finished(job_id))
+    
+    def _finished(self, job_id: int):
+        self.running.pop(job_id, None)
+        self._capacity.release()
+    
+    async def _run(self, job: Dict):
+        final = job['attempts'] >= self.max_attempts
+        if job['attempts'] > self.max_attempts:
+            # Its last attempt died with the process
+            LOGGER(__name__).error(f"Dropping job {job['id']} after {job['attempts'] - 1} attempt(s)")
+            await db.afinish_job(job['id'])
+            return
+        
+        if job['attempts'] > 1:
+            LOGGER(__name__).info(f"Running job {job['id']} again (attempt {job['attempts']} of {self.max_attempts})")
+        heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+        try:
+            await self._runner(job, final)
+        except JobDeferred as e:
+            await db.arelease_job(job['id'], self.owner, max(1, round(e.retry_after)))
+            return
+        except asyncio.CancelledError:
+            if self.stopping:
+                await db.arelease_job(job['id'], self.owner)
+                raise
+            # Cancelled by the user, e.g. /killall
+            await db.afinish_job(job['id'])
+            return
+        except Exception as e:
+            if final:
+                LOGGER(__name__).error(f"Job {job['id']} failed after {job['attempts']} attempt(s): {e}")
+                await db.afinish_job(job['id'])
+                return
+            # Errors that know when to retry (rate or resource limits) say so
+            delay = getattr(e, "retry_after", None) or min(30 * 2 ** (job['attempts'] - 1), 900)
+            LOGGER(__name__).warning(f"Job {job['id']} failed (attempt {job['attempts']}), retrying in {delay}s: {e}")
+            await db.aretry_job(job['id'], self.owner, int(delay), str(e))
+            return
+        finally:
+            heartbeat.cancel()
+        
+        await db.afinish_job(job['id'])
+    
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not await db.arenew_job_lease(job_id, self.owner, self.lease_seconds):
+                LOGGER(__name__).warning(f"Lost the lease of job {job_id}, it may run twice")
+                return
+
+
+# Initialize the shared job queue
+job_queue = JobQueue(
+    PyroConf.JOB_WORKERS,
+    lease_seconds=PyroConf.JOB_LEASE_SECONDS,
+    max_attempts=PyroConf.JOB_MAX_ATTEMPTS
+)
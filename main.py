@@ -1,22 +1,43 @@
 # Copyright (C) @Wolfy004
 # Channel: https://t.me/Wolfy004
 
+from time import time, perf_counter
+
+STARTUP_BEGAN = perf_counter()
+
 import os
 import shutil
-import psutil
 import asyncio
-from time import time
 
-from pyleaves import Leaves
 from pyrogram.enums import ParseMode
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.errors import PeerIdInvalid, BadRequest
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 
 from helpers.utils import (
     processMediaGroup,
     progressArgs,
-    send_media
+    send_media,
+    transfer_progress
+)
+
+from helpers.transfer import (
+    can_relay,
+    relay_media
+)
+
+from helpers.downloader import (
+    PARALLEL_MIN_SIZE,
+    parallel_download,
+    prune_partials
+)
+
+from helpers.uploader import ParallelUploadClient
+
+from helpers.file_cache import (
+    message_media,
+    send_delivered,
+    remember_delivered
 )
 
 from helpers.files import (
@@ -37,7 +58,12 @@ from config import PyroConf
 from logger import LOGGER
 from database import db
 from phone_auth import PhoneAuthHandler
-from access_control import admin_only, paid_or_admin_only, check_download_limit, register_user, check_user_session, get_user_client
+from access_control import admin_only, paid_or_admin_only, check_download_limit, register_user, check_user_session, get_user_client, release_user_client, update_user_session, get_auth_context, download_admission, RateLimited
+from client_pool import user_client_pool
+from scheduler import transfer_scheduler
+from jobs import job_queue, JobDeferred
+from batch import BatchPipeline
+from resources import resource_admission, ResourceShortage
 from admin_commands import (
     add_admin_command,
     remove_admin_command,
@@ -47,35 +73,128 @@ from admin_commands import (
     unban_user_command,
     broadcast_command,
     admin_stats_command,
+    queue_command,
     user_info_command,
     broadcast_callback_handler
 )
 
 # Initialize the bot client
-bot = Client(
+bot = ParallelUploadClient(
     "media_bot",
     api_id=PyroConf.API_ID,
     api_hash=PyroConf.API_HASH,
     bot_token=PyroConf.BOT_TOKEN,
     workers=1000,
     parse_mode=ParseMode.MARKDOWN,
+    parts_in_flight=PyroConf.UPLOAD_PARTS_IN_FLIGHT,
 )
 
 # Client for user session
-user = Client("user_session", workers=1000, session_string=PyroConf.SESSION_STRING) if PyroConf.SESSION_STRING else None
+user = Client(
+    "user_session",
+    workers=1000,
+    session_string=PyroConf.SESSION_STRING,
+    max_concurrent_transmissions=PyroConf.DOWNLOAD_CONNECTIONS,
+) if PyroConf.SESSION_STRING else None
 
 # Phone authentication handler
 phone_auth_handler = PhoneAuthHandler(PyroConf.API_ID, PyroConf.API_HASH)
 
-RUNNING_TASKS = set()
+def track_task(context, coro, label=""):
+    """Run a download as a scheduler job of the requesting user"""
+    return transfer_scheduler.submit(context.user_id, context.user_type, coro, label)
+
+
+async def queue_download(message: Message, post_url: str):
+    """Store a single post download as a job for a worker to run"""
+    post_url = post_url.split("?", 1)[0]
+    try:
+        chat_id, message_id = getChatMsgID(post_url)
+    except Exception as e:
+        await message.reply(f"**❌ {str(e)}**")
+        return
+
+    job_id, created = await job_queue.enqueue(message.from_user.id, chat_id, message_id, post_url, message)
+    await report_queued(message, job_id, created)
+
+
+async def report_queued(message: Message, job_id, created: bool):
+    """Tell the user where a stored job stands, dropping it again past their queue limit"""
+    if job_id is None:
+        await message.reply("**❌ Could not queue the download, please try again.**")
+        return
+    if not created:
+        await message.reply("⏳ **This link is already in your queue.**")
+        return
+    
+    # The job is stored before the limits apply, a crash cannot lose it
+    context = await get_auth_context(message)
+    waiting = (await db.aget_job_counts(context.user_id)).get('queued', 0)
+    try:
+        download_admission.check_queue(context.user_id, context.user_type, waiting)
+    except RateLimited as e:
+        if not await db.acancel_job(job_id):
+            # A worker picked it up meanwhile, it is already running
+            return
+        await message.reply(
+            f"⏳ **Too many downloads in progress.**\n\n"
+            f"Please try again in `{e.retry_after}` seconds."
+        )
+        return
+    
+    if waiting > 1:
+        await message.reply(f"🕒 **Queued** (position `{waiting}`), your download starts shortly.")
+
 
-def track_task(coro):
-    task = asyncio.create_task(coro)
-    RUNNING_TASKS.add(task)
-    def _remove(_):
-        RUNNING_TASKS.discard(task)
-    task.add_done_callback(_remove)
-    return task
+async def run_job(job: dict, final: bool):
+    """Worker body of a queued job.
+    
+    The user's rate and in-flight limits are applied here, a job past
+    them goes back to the queue. The request message is fetched again by
+    id, so a job redelivered after a restart still replies where the
+    user asked. A single post records its delivery on the job, the way a
+    batch records its progress, so a retry never sends it twice.
+    """
+    snapshot = await db.aget_auth_snapshot(job['user_id'])
+    if snapshot['is_banned']:
+        return
+    retry_after = download_admission.try_acquire(job['user_id'], snapshot['user_type'])
+    if retry_after is not None:
+        raise JobDeferred(retry_after)
+    
+    try:
+        if job['kind'] != "batch" and job['next_message_id'] > job['source_message_id']:
+            LOGGER(__name__).info(f"Job {job['id']} was delivered before it failed, not sending it again")
+            return
+        
+        message = await bot.get_messages(job['request_chat_id'], job['request_message_id'])
+        if not message or message.empty:
+            LOGGER(__name__).warning(f"Request of job {job['id']} was deleted, dropping the job")
+            return
+        
+        context = await get_auth_context(message)
+        user_client = await get_user_client(job['user_id'])
+        try:
+            if job['kind'] == "batch":
+                body = download_batch(bot, message, job, user_client)
+            else:
+                async def on_delivered():
+                    await db.aadvance_job(job['id'], job_queue.owner, job['source_message_id'] + 1)
+                
+                # Don't increment usage here - let handle_download do it after success
+                body = handle_download(
+                    bot, message, job['post_url'], user_client, True,
+                    raise_errors=not final, on_delivered=on_delivered
+                )
+            await track_task(context, body, job['post_url'])
+        except Exception as e:
+            if not final:
+                await message.reply(f"⚠️ **Download failed, retrying automatically:** `{e}`")
+            raise
+        finally:
+            await release_user_client(user_client)
+    finally:
+        download_admission.release(job['user_id'])
 
 
 @bot.on_message(filters.command("start") & filters.private)
@@ -120,7 +239,7 @@ async def help_command(_, message: Message):
         "   – Free users: 5 downloads per day\n"
         "   – Premium users: Unlimited downloads\n\n"
         "➤ **If the bot hangs**\n"
-        "   – Send `/killall` to cancel any pending downloads (Admin only).\n\n"
+        "   – Send `/killall` to cancel your pending downloads (admins cancel everyone's, or `/killall <user_id>`).\n\n"
         "➤ **Logs**\n"
         "   – Send `/logs` to download the bot’s logs file.\n\n"
         "➤ **Stats**\n"
@@ -136,11 +255,16 @@ async def help_command(_, message: Message):
     await message.reply(help_text, reply_markup=markup, disable_web_page_preview=True)
 
 
-async def handle_download(bot: Client, message: Message, post_url: str, user_client=None, increment_usage=True):
+async def handle_download(bot: Client, message: Message, post_url: str, user_client=None, increment_usage=True,
+                          raise_errors=False, chat_message=None, on_delivered=None) -> bool:
+    """Deliver one post in reply to message, returns whether it went out"""
     # Cut off URL at '?' if present
     if "?" in post_url:
         post_url = post_url.split("?", 1)[0]
 
+    reservation = None
+    download_path = None
+    delivered = False
     try:
         chat_id, message_id = getChatMsgID(post_url)
         
@@ -156,9 +280,11 @@ async def handle_download(bot: Client, message: Message, post_url: str, user_cli
                 "Please login with your phone number:\n"
                 "`/login +1234567890`"
             )
-            return
+            return False
             
-        chat_message = await client_to_use.get_messages(chat_id=chat_id, message_ids=message_id)
+        # Batches hand in the post they already fetched
+        if chat_message is None:
+            chat_message = await client_to_use.get_messages(chat_id=chat_id, message_ids=message_id)
 
         LOGGER(__name__).info(f"Downloading media from URL: {post_url}")
 
@@ -175,8 +301,8 @@ async def handle_download(bot: Client, message: Message, post_url: str, user_cli
             try:
                 is_premium = False
                 if client_to_use != user:
-                    # User's personal client
-                    me = await client_to_use.get_me()
+                    # User's personal client (pooled clients keep the account from start)
+                    me = client_to_use.me or await client_to_use.get_me()
                     is_premium = getattr(me, 'is_premium', False)
                 else:
                     # Bot's session
@@ -189,7 +315,7 @@ async def handle_download(bot: Client, message: Message, post_url: str, user_cli
                 is_premium = False
                 
             if not await fileSizeLimit(file_size, message, "download", is_premium):
-                return
+                return False
 
         parsed_caption = await get_parsed_msg(
             chat_message.caption or "", chat_message.caption_entities
@@ -203,69 +329,157 @@ async def handle_download(bot: Client, message: Message, post_url: str, user_cli
                 await message.reply(
                     "**Could not extract any valid media from the media group.**"
                 )
-            return
+            else:
+                delivered = True
+                if on_delivered:
+                    await on_delivered()
+            return delivered
 
         elif chat_message.media:
-            start_time = time()
-            progress_message = await message.reply("**📥 Downloading Progress...**")
-
-            filename = get_file_name(message_id, chat_message)
-            download_path = get_download_path(message.id, filename)
-
-            media_path = await chat_message.download(
-                file_name=download_path,
-                progress=Leaves.progress_for_pyrogram,
-                progress_args=progressArgs(
-                    "📥 Downloading Progress", progress_message, start_time
-                ),
-            )
-
-            LOGGER(__name__).info(f"Downloaded media: {media_path}")
-
-            media_type = (
-                "photo"
-                if chat_message.photo
-                else "video"
-                if chat_message.video
-                else "audio"
-                if chat_message.audio
-                else "document"
-            )
-            await send_media(
-                bot,
-                message,
-                media_path,
-                media_type,
-                parsed_caption,
-                progress_message,
-                start_time,
-            )
-
-            cleanup_download(media_path)
-            await progress_message.delete()
-            
-            # Only increment usage after successful download
+            # Take the quota slot before spending bandwidth, so concurrent
+            # links cannot all slip past the daily limit
             if increment_usage:
-                db.increment_usage(message.from_user.id)
+                context = await get_auth_context(message)
+                reservation, limit_text = await db.areserve_download(context.user_id, context.user_type)
+                if reservation is None:
+                    await message.reply(f"❌ **{limit_text}**")
+                    return False
+
+            # Posts delivered before are re-sent by file_id, no transfer needed
+            if await send_delivered(message, chat_message, parsed_caption):
+                delivered = True
+                if on_delivered:
+                    await on_delivered()
+            else:
+                media, _ = message_media(chat_message)
+                file_size = getattr(media, "file_size", 0) or 0
+
+                async def on_hold(resource, retry_after):
+                    wait = f" (about `{get_readable_time(retry_after)}`)" if retry_after else ""
+                    await message.reply(f"⏳ **Waiting for free {resource}{wait}**, your download starts shortly.")
+
+                # Set the disk space aside before writing, relayed files
+                # never touch the disk and only wait out memory or CPU load
+                relay = can_relay(chat_message)
+                if not relay:
+                    download_path = get_download_path(message.id, get_file_name(message_id, chat_message))
+                await resource_admission.reserve(download_path, 0 if relay else file_size, on_hold)
+
+                start_time = time()
+                progress_message = await message.reply("**📥 Downloading Progress...**")
+
+                if relay:
+                    # Nothing to process, pipe the source stream into the upload
+                    async with transfer_scheduler.slot("download", file_size), \
+                            transfer_scheduler.slot("upload", file_size):
+                        sent = await relay_media(
+                            client_to_use,
+                            bot,
+                            message,
+                            chat_message,
+                            parsed_caption,
+                            progress_message,
+                            start_time,
+                            parts_in_flight=PyroConf.UPLOAD_PARTS_IN_FLIGHT,
+                            connections=PyroConf.DOWNLOAD_CONNECTIONS,
+                        )
+                else:
+                    async with transfer_scheduler.slot("download", file_size):
+                        if file_size >= PARALLEL_MIN_SIZE:
+                            # Large files are fetched as ranges over several connections,
+                            # and resume from the chunks on disk after a failure or restart
+                            media_path = await parallel_download(
+                                client_to_use,
+                                chat_message,
+                                file_size,
+                                download_path,
+                                progress=transfer_progress,
+                                progress_args=progressArgs(
+                                    "📥 Downloading Progress", progress_message, start_time
+                                ),
+                                max_connections=PyroConf.DOWNLOAD_CONNECTIONS,
+                                resume_key=media.file_unique_id,
+                            )
+                        else:
+                            media_path = await chat_message.download(
+                                file_name=download_path,
+                                progress=transfer_progress,
+                                progress_args=progressArgs(
+                                    "📥 Downloading Progress", progress_message, start_time
+                                ),
+                            )
+
+                    LOGGER(__name__).info(f"Downloaded media: {media_path}")
+
+                    media_type = (
+                        "photo"
+                        if chat_message.photo
+                        else "video"
+                        if chat_message.video
+                        else "audio"
+                        if chat_message.audio
+                        else "document"
+                    )
+                    async with transfer_scheduler.slot("upload", file_size):
+                        sent = await send_media(
+                            bot,
+                            message,
+                            media_path,
+                            media_type,
+                            parsed_caption,
+                            progress_message,
+                            start_time,
+                        )
+                    cleanup_download(media_path)
+                    download_path = None
+
+                # Recorded before anything else can fail, so a retry does not send it twice
+                if sent is not None:
+                    delivered = True
+                    if on_delivered:
+                        await on_delivered()
+                await remember_delivered(chat_message, sent)
+                await progress_message.delete()
+
+            # Only count the download once it has been delivered, a file
+            # refused for its upload size is released by the finally below
+            if reservation and delivered:
+                await db.acommit_download(reservation)
 
         elif chat_message.text or chat_message.caption:
             await message.reply(parsed_text or parsed_caption)
+            delivered = True
+            if on_delivered:
+                await on_delivered()
         else:
             await message.reply("**No media or text found in the post URL.**")
 
+    except ResourceShortage as e:
+        if raise_errors:
+            raise
+        retry = (
+            f"Please try again in `{get_readable_time(e.retry_after)}`."
+            if e.retry_after else "Please try again later."
+        )
+        await message.reply(f"⏳ **Not enough {e.resource} on the server right now.**\n\n{retry}")
     except (PeerIdInvalid, BadRequest, KeyError):
         await message.reply("**Make sure the user client is part of the chat.**")
     except Exception as e:
+        if raise_errors:
+            # The job queue retries it and reports the last attempt's error
+            raise
         error_message = f"**❌ {str(e)}**"
         await message.reply(error_message)
         LOGGER(__name__).error(e)
     finally:
-        # Clean up user client if it was created
-        if user_client and user_client != user:
-            try:
-                await user_client.stop()
-            except:
-                pass
+        # Give the quota slot back if the download failed or was cancelled
+        if reservation:
+            await db.arelease_download(reservation)
+        # Remove a partial download and give its disk space back
+        if download_path:
+            cleanup_download(download_path)
+
+    return delivered
 
 
 @bot.on_message(filters.command("dl") & filters.private)
@@ -275,13 +489,7 @@ async def download_media(bot: Client, message: Message):
         await message.reply("**Provide a post URL after the /dl command.**")
         return
 
-    post_url = message.command[1]
-    
-    # Check if user has personal session
-    user_client = await get_user_client(message.from_user.id)
-    
-    # Don't increment usage here - let handle_download do it after success
-    await track_task(handle_download(bot, message, post_url, user_client, True))
+    await queue_download(message, message.command[1])
 
 
 @bot.on_message(filters.command("bdl") & filters.private)
@@ -309,76 +517,87 @@ async def download_range(bot: Client, message: Message):
     if start_id > end_id:
         return await message.reply("**❌ Invalid range: start ID cannot exceed end ID.**")
 
-    # Check if user has personal session
-    user_client = await get_user_client(message.from_user.id)
+    job_id, created = await job_queue.enqueue(
+        message.from_user.id, start_chat, start_id, args[1], message, end_message_id=end_id, kind="batch"
+    )
+    await report_queued(message, job_id, created)
+
+
+async def download_batch(bot: Client, message: Message, job: dict, user_client=None):
+    """Worker body of a /bdl job, continuing from the post the job got to"""
+    start_chat, _ = getChatMsgID(job['post_url'])
+    start_id, end_id = job['next_message_id'], job['end_message_id']
     client_to_use = user_client if user_client else user
-    
+
     try:
         await client_to_use.get_chat(start_chat)
     except Exception:
         pass
 
-    prefix = args[1].rsplit("/", 1)[0]
+    prefix = job['post_url'].rsplit("/", 1)[0]
     loading = await message.reply(f"📥 **Downloading posts {start_id}–{end_id}…**")
 
-    downloaded = skipped = failed = 0
-
-    for msg_id in range(start_id, end_id + 1):
-        url = f"{prefix}/{msg_id}"
-        try:
-            chat_msg = await client_to_use.get_messages(chat_id=start_chat, message_ids=msg_id)
-            if not chat_msg:
-                skipped += 1
-                continue
-
-            has_media = bool(chat_msg.media_group_id or chat_msg.media)
-            has_text  = bool(chat_msg.text or chat_msg.caption)
-            if not (has_media or has_text):
-                skipped += 1
-                continue
-
-            task = track_task(handle_download(bot, message, url, user_client, False))
-            try:
-                await task
-                downloaded += 1
-                # Increment usage count for batch downloads after success
-                db.increment_usage(message.from_user.id)
-            except asyncio.CancelledError:
-                await loading.delete()
-                return await message.reply(
-                    f"**❌ Batch canceled** after downloading `{downloaded}` posts."
-                )
+    context = await get_auth_context(message)
 
-        except Exception as e:
-            failed += 1
-            LOGGER(__name__).error(f"Error at {url}: {e}")
+    async def handle_post(url, chat_message):
+        # Errors go to the pipeline, which reports them and counts the post as failed
+        return await handle_download(
+            bot, message, url, user_client, False, raise_errors=True, chat_message=chat_message
+        )
 
-        await asyncio.sleep(3)
+    async def on_delivered(last_id):
+        # Increment usage count for batch downloads after success
+        await db.aincrement_usage(message.from_user.id)
+        # A redelivered batch continues after the last delivered post
+        # (for an album, its last member)
+        await db.aadvance_job(job['id'], job_queue.owner, last_id + 1)
+
+    pipeline = BatchPipeline(
+        bot,
+        message,
+        client_to_use,
+        start_chat,
+        prefix,
+        start_id,
+        end_id,
+        PyroConf.BATCH_CONCURRENCY.get(context.user_type, 1),
+        handle_post,
+        on_delivered,
+        status_message=loading,
+    )
+    try:
+        counts = await pipeline.run()
+    except asyncio.CancelledError:
+        # Shutdown hands the batch back to the queue without a word
+        if not job_queue.stopping:
+            await loading.delete()
+            await message.reply(
+                f"**❌ Batch canceled** after downloading `{pipeline.downloaded}` posts."
+            )
+        raise
 
     await loading.delete()
     await message.reply(
         "**✅ Batch Process Complete!**\n"
         "━━━━━━━━━━━━━━━━━━━\n"
-        f"📥 **Downloaded** : `{downloaded}` post(s)\n"
-        f"⏭️ **Skipped**    : `{skipped}` (no content)\n"
-        f"❌ **Failed**     : `{failed}` error(s)"
+        f"📥 **Downloaded** : `{counts['downloaded']}` post(s)\n"
+        f"⏭️ **Skipped**    : `{counts['skipped']}` (no content)\n"
+        f"❌ **Failed**     : `{counts['failed']}` error(s)"
     )
 
 
-@bot.on_message(filters.private & ~filters.command(["start", "help", "dl", "stats", "logs", "killall", "bdl", "myinfo", "login", "verify", "password", "logout", "cancel", "addadmin", "removeadmin", "setpremium", "removepremium", "ban", "unban", "broadcast", "adminstats", "userinfo"]))
+@bot.on_message(filters.private & ~filters.command(["start", "help", "dl", "stats", "logs", "killall", "bdl", "myinfo", "login", "verify", "password", "logout", "cancel", "addadmin", "removeadmin", "setpremium", "removepremium", "ban", "unban", "broadcast", "adminstats", "queue", "userinfo"]))
 @check_download_limit
 async def handle_any_message(bot: Client, message: Message):
     if message.text and not message.text.startswith("/"):
-        # Check if user has personal session
-        user_client = await get_user_client(message.from_user.id)
-        
-        # Don't increment usage here - let handle_download do it after success
-        await track_task(handle_download(bot, message, message.text, user_client, True))
+        await queue_download(message, message.text)
 
 
 @bot.on_message(filters.command("stats") & filters.private)
 @register_user
 async def stats(_, message: Message):
+    import psutil
+
     currentTime = get_readable_time(time() - PyroConf.BOT_START_TIME)
     total, used, free = shutil.disk_usage(".")
     total = get_readable_file_size(total)
@@ -417,14 +636,29 @@ async def logs(_, message: Message):
 
 
 @bot.on_message(filters.command("killall") & filters.private)
-@admin_only
+@register_user
 async def cancel_all_tasks(_, message: Message):
-    cancelled = 0
-    for task in list(RUNNING_TASKS):
-        if not task.done():
-            task.cancel()
-            cancelled += 1
-    await message.reply(f"**Cancelled {cancelled} running task(s).**")
+    context = await get_auth_context(message)
+    args = message.command[1:]
+
+    if not context.is_admin:
+        # Everyone can stop their own downloads
+        queued = await job_queue.cancel_queued(context.user_id)
+        cancelled = transfer_scheduler.cancel_user(context.user_id)
+        await message.reply(f"**Cancelled {cancelled} of your running and {queued} queued task(s).**")
+    elif args:
+        try:
+            target_id = int(args[0])
+        except ValueError:
+            await message.reply("**Usage: `/killall` or `/killall <user_id>`**")
+            return
+        queued = await job_queue.cancel_queued(target_id)
+        cancelled = transfer_scheduler.cancel_user(target_id)
+        await message.reply(f"**Cancelled {cancelled} running and {queued} queued task(s) of user `{target_id}`.**")
+    else:
+        queued = await job_queue.cancel_queued()
+        cancelled = transfer_scheduler.cancel_all()
+        await message.reply(f"**Cancelled {cancelled} running and {queued} queued task(s).**")
 
 
 # User Commands
@@ -498,7 +732,7 @@ async def verify_command(_, message: Message):
         if len(result) == 4:
             success, msg, needs_2fa, session_string = result
             if success and session_string:
-                db.set_user_session(user_id, session_string)
+                await update_user_session(user_id, session_string)
             await message.reply(msg)
         else:
             success, msg, needs_2fa = result
@@ -538,7 +772,7 @@ async def password_command(_, message: Message):
         await loading_msg.delete()
         
         if success and session_string:
-            db.set_user_session(user_id, session_string)
+            await update_user_session(user_id, session_string)
         
         await message.reply(msg)
         
@@ -553,7 +787,7 @@ async def logout_command(_, message: Message):
     """Logout from account"""
     user_id = message.from_user.id
     
-    if db.set_user_session(user_id, None):
+    if await update_user_session(user_id, None):
         await message.reply(
             "✅ **Logged out successfully!**\n\n"
             "Your session has been removed. Use `/login <phone_number>` to login again."
@@ -620,6 +854,12 @@ async def admin_stats(_, message: Message):
     await admin_stats_command(_, message)
 
 
+@bot.on_message(filters.command("queue") & filters.private)
+async def queue(_, message: Message):
+    """Transfer queue command wrapper"""
+    await queue_command(_, message)
+
+
 # Callback handler for broadcast confirmation
 @bot.on_callback_query()
 async def callback_handler(_, callback_query):
@@ -627,32 +867,83 @@ async def callback_handler(_, callback_query):
     await broadcast_callback_handler(_, callback_query)
 
 
+async def start_clients():
+    """Connect the bot and the user client concurrently"""
+    starts = [bot.start()]
+    if user and PyroConf.SESSION_STRING and len(PyroConf.SESSION_STRING) > 50 and not PyroConf.SESSION_STRING.startswith("your_"):
+        starts.append(user.start())
+    else:
+        LOGGER(__name__).warning("No valid SESSION_STRING provided - users must login with phone number")
+
+    bot_result, *user_result = await asyncio.gather(*starts, return_exceptions=True)
+    if isinstance(bot_result, BaseException):
+        raise bot_result
+    if user_result and isinstance(user_result[0], BaseException):
+        LOGGER(__name__).error(f"Failed to start user client: {user_result[0]}")
+    elif user_result:
+        LOGGER(__name__).info("User client started successfully")
+
+
+async def stop_clients():
+    await user_client_pool.close()
+    stops = [client.stop() for client in (bot, user) if client and client.is_connected]
+    await asyncio.gather(*stops, return_exceptions=True)
+
+
+async def main():
+    phases = [("imports", perf_counter() - STARTUP_BEGAN)]
+
+    # Initialize database on startup (skips the DDL when the schema is current)
+    phase_started = perf_counter()
+    db.init_database()
+
+    # Add initial admin if specified in config
+    if PyroConf.OWNER_ID and PyroConf.OWNER_ID > 0:
+        # Add owner to users table first
+        db.add_user(PyroConf.OWNER_ID, "Owner", "Bot", "Owner")
+        # Then set as admin
+        db.add_admin(PyroConf.OWNER_ID, PyroConf.OWNER_ID)
+        LOGGER(__name__).info(f"Added owner {PyroConf.OWNER_ID} as admin")
+
+    warmed = db.warm_auth_cache()
+    LOGGER(__name__).info(f"Warmed authorization cache with {warmed} user(s)")
+
+    db.start_usage_rollup(PyroConf.USAGE_RETENTION_DAYS)
+    phases.append(("database", perf_counter() - phase_started))
+
+    # Partial downloads are kept for resuming, drop the abandoned ones
+    pruned = prune_partials()
+    if pruned:
+        LOGGER(__name__).info(f"Removed {pruned} stale partial download(s)")
+
+    phase_started = perf_counter()
+    await start_clients()
+    phases.append(("clients", perf_counter() - phase_started))
+
+    # Picks up jobs left queued or interrupted by the previous run
+    job_queue.start(run_job)
+
+    LOGGER(__name__).info(
+        "Startup timings: "
+        + " | ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in phases)
+        + f" | total {(perf_counter() - STARTUP_BEGAN) * 1000:.0f}ms"
+    )
+
+    try:
+        await idle()
+    finally:
+        await job_queue.stop()
+        await stop_clients()
+
+
 if __name__ == "__main__":
     try:
         LOGGER(__name__).info("Bot Started!")
-        
-        # Initialize database on startup
-        LOGGER(__name__).info("Initializing database...")
-        db.init_database()
-        
-        # Add initial admin if specified in config
-        if PyroConf.OWNER_ID and PyroConf.OWNER_ID > 0:
-            # Add owner to users table first
-            db.add_user(PyroConf.OWNER_ID, "Owner", "Bot", "Owner")
-            # Then set as admin
-            db.add_admin(PyroConf.OWNER_ID, PyroConf.OWNER_ID)
-            LOGGER(__name__).info(f"Added owner {PyroConf.OWNER_ID} as admin")
-        
-        # Start the user client if valid session is provided
-        if user and PyroConf.SESSION_STRING and len(PyroConf.SESSION_STRING) > 50 and not PyroConf.SESSION_STRING.startswith("your_"):
-            user.start()
-            LOGGER(__name__).info("User client started successfully")
-        else:
-            LOGGER(__name__).warning("No valid SESSION_STRING provided - users must login with phone number")
-        bot.run()
+        bot.run(main())
     except KeyboardInterrupt:
         pass
     except Exception as err:
         LOGGER(__name__).error(err)
     finally:
+        db.close()
         LOGGER(__name__).info("Bot Stopped")
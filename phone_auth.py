@@ -22,10 +22,13 @@ class PhoneAuthHandler:
         try:
             session_name = f"user_{user_id}"
             
+            # Nothing to keep on disk: the exported session string is stored
+            # in the users table once login succeeds
             client = Client(
                 session_name,
                 api_id=self.api_id,
-                api_hash=self.api_hash
+                api_hash=self.api_hash,
+                in_memory=True
             )
             
             await client.connect()
@@ -0,0 +1,213 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+import math
+import os
+import shutil
+from time import monotonic
+from typing import Optional, Dict
+from config import PyroConf
+from logger import LOGGER
+
+MB = 1024 * 1024
+
+
+class ResourceShortage(Exception):
+    """A job was turned away for lack of a resource, retry_after is in seconds (None if unknown)"""
+    
+    def __init__(self, resource: str, retry_after: Optional[int]):
+        super().__init__(f"Not enough {resource}" + (f", retry after {retry_after}s" if retry_after else ""))
+        self.resource = resource
+        self.retry_after = retry_after
+
+
+class _Reservation:
+    """Disk bytes set aside for one file in the downloads folder"""
+    
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.started = monotonic()
+    
+    def outstanding(self) -> int:
+        """Reserved bytes not yet written, and so not yet missing from free space"""
+        written = 0
+        for candidate in (self.path, self.path + ".temp"):
+            try:
+                written += os.path.getsize(candidate)
+            except OSError:
+                pass
+        return max(0, self.size - written)
+
+
+class ResourceAdmission:
+    """Disk reservations and load shedding in front of jobs that write downloads.
+    
+    A job reserves the size of its file before it starts. Free disk space
+    counts the reserved bytes not written yet as used, so concurrent jobs
+    cannot overcommit the disk between them. While the disk would fall
+    below min_free, or the process RSS or the CPU use is past its limit,
+    new jobs are held until reservations are released. A job that cannot
+    start within max_wait, that would never fit, or that finds max_held
+    jobs already waiting is rejected with an estimate of when to retry.
+    """
+    
+    def __init__(self, root: str, min_free: int, max_rss: Optional[int], max_cpu: float,
+                 max_wait: float, max_held: int = 50, poll_interval: float = 2.0):
+        self.root = root
+        self.min_free = min_free
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self.max_wait = max_wait
+        self.max_held = max_held
+        self.poll_interval = poll_interval
+        self.held = 0
+        self.rejected = 0
+        self.avg_lifetime = None
+        self._reservations = {}
+        self._released = None
+        self._process = None
+        self._cpu_sampled = 0.0
+        self._cpu = 0.0
+    
+    def _free_disk(self) -> int:
+        os.makedirs(self.root, exist_ok=True)
+        return shutil.disk_usage(self.root).free
+    
+    def outstanding(self) -> int:
+        return sum(reservation.outstanding() for reservation in self._reservations.values())
+    
+    def _rss_limit(self) -> int:
+        # None is 75% of system memory, looked up on the first check so
+        # importing the bot does not load psutil
+        if self.max_rss is None:
+            import psutil
+            self.max_rss = int(psutil.virtual_memory().total * 0.75)
+        return self.max_rss
+    
+    def _rss(self) -> int:
+        if self._process is None:
+            import psutil
+            self._process = psutil.Process(os.getpid())
+        return self._process.memory_info().rss
+    
+    def _cpu_percent(self) -> float:
+        # Non-blocking, measured since the previous sample
+        now = monotonic()
+        if now - self._cpu_sampled >= 1.0:
+            import psutil
+            self._cpu = psutil.cpu_percent(interval=None)
+            self._cpu_sampled = now
+        return self._cpu
+    
+    def shortage(self, size: int = 0) -> Optional[str]:
+        """The resource that cannot take a job writing size bytes now, None if all can"""
+        if size and self._free_disk() - self.outstanding() - size < self.min_free:
+            return "disk space"
+        if self._rss_limit() and self._rss() > self.max_rss:
+            return "memory"
+        if self.max_cpu and self._cpu_percent() > self.max_cpu:
+            return "CPU"
+        return None
+    
+    def estimate(self, resource: str, size: int = 0) -> Optional[int]:
+        """Seconds until enough reservations should be released for the job to start"""
+        if self.avg_lifetime is None or not self._reservations:
+            return None
+        now = monotonic()
+        releases = sorted(
+            (max(0.0, self.avg_lifetime - (now - reservation.started)), reservation.size)
+            for reservation in self._reservations.values()
+        )
+        if resource != "disk space":
+            return math.ceil(releases[0][0])
+        
+        deficit = size + self.min_free + self.outstanding() - self._free_disk()
+        freed = 0
+        for remaining, reserved in releases:
+            freed += reserved
+            if freed >= deficit:
+                return math.ceil(remaining)
+        return None
+    
+    async def reserve(self, path: Optional[str], size: int = 0, on_hold=None):
+        """Wait until there is room for a job writing size bytes to path.
+        
+        With path None only the load is checked, for jobs that keep nothing
+        on disk. on_hold(resource, retry_after) is awaited once if the job
+        has to wait. Raises ResourceShortage if it cannot start.
+        """
+        if size and size + self.min_free > self._free_disk() - self.outstanding() + sum(
+            reservation.size for reservation in self._reservations.values()
+        ):
+            # Would not fit even once every other job is done
+            self.rejected += 1
+            raise ResourceShortage("disk space", None)
+        
+        resource = self.shortage(size)
+        if resource:
+            retry_after = self.estimate(resource, size)
+            if self.held >= self.max_held or (retry_after or 0) > self.max_wait:
+                self.rejected += 1
+                raise ResourceShortage(resource, retry_after)
+            
+            LOGGER(__name__).info(f"Holding a job of {size} bytes for {resource}")
+            if on_hold:
+                await on_hold(resource, retry_after)
+            
+            self.held += 1
+            deadline = monotonic() + self.max_wait
+            try:
+                while resource:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise ResourceShortage(resource, self.estimate(resource, size))
+                    if self._released is None:
+                        self._released = asyncio.Event()
+                    try:
+                        await asyncio.wait_for(self._released.wait(), min(self.poll_interval, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+                    resource = self.shortage(size)
+            finally:
+                self.held -= 1
+        
+        if path is not None:
+            path = os.path.abspath(path)
+            self._reservations[path] = _Reservation(path, size)
+    
+    def release(self, path: str):
+        """Give the reservation of path back, if it has one"""
+        reservation = self._reservations.pop(os.path.abspath(path), None)
+        if reservation is None:
+            return
+        
+        lifetime = monotonic() - reservation.started
+        self.avg_lifetime = lifetime if self.avg_lifetime is None else 0.8 * self.avg_lifetime + 0.2 * lifetime
+        if self._released is not None:
+            # Wake every held job to check again, later waiters get a new event
+            self._released.set()
+            self._released = None
+    
+    def snapshot(self) -> Dict:
+        """Reservations, free space and held or rejected jobs, for /queue"""
+        return {
+            'reservations': len(self._reservations),
+            'reserved': sum(reservation.size for reservation in self._reservations.values()),
+            'outstanding': self.outstanding(),
+            'free': self._free_disk(),
+            'held': self.held,
+            'rejected': self.rejected
+        }
+
+
+# Initialize the shared admission controller
+resource_admission = ResourceAdmission(
+    "downloads",
+    min_free=PyroConf.MIN_FREE_DISK_MB * MB,
+    max_rss=PyroConf.MAX_RSS_MB * MB if PyroConf.MAX_RSS_MB > 0 else None,
+    max_cpu=PyroConf.MAX_CPU_PERCENT,
+    max_wait=PyroConf.ADMISSION_MAX_WAIT
+)
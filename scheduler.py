@@ -0,0 +1,280 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import Optional, Dict, List
+from config import PyroConf
+from logger import LOGGER
+
+# Work of a higher tier may pause large transfers of a lower one
+PRIORITIES = {'free': 0, 'paid': 1, 'admin': 2}
+
+# Share of the slots each user of a tier gets while users compete
+WEIGHTS = {'free': 1, 'paid': 4, 'admin': 8}
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+_job_ids = itertools.count(1)
+
+
+class Job:
+    """One scheduled request of a user and the slots it currently holds"""
+    
+    def __init__(self, user_id: int, user_type: str, label: str = ""):
+        self.id = next(_job_ids)
+        self.user_id = user_id
+        self.user_type = user_type
+        self.priority = PRIORITIES.get(user_type, 0)
+        self.weight = WEIGHTS.get(user_type, 1)
+        self.label = label
+        self.created = monotonic()
+        self.task = None
+        self.holds = []
+
+
+class SlotHold:
+    """A job's claim on one slot of a pool, waiting, running or paused"""
+    
+    def __init__(self, pool: "SlotPool", job: Job, size: int):
+        self.pool = pool
+        self.job = job
+        self.size = size
+        self.tag = 0.0
+        self.started = None
+        self.granted = None
+        self.abandoned = False
+        self.preempting = None
+        self.pause_requested = False
+        self.resume_tag = None
+        self.lock = asyncio.Lock()
+
+
+class SlotPool:
+    """Bounded slots of one resource shared by weighted fair queuing.
+    
+    Every request gets a virtual finish tag, max(virtual time, the user's
+    last tag) + 1 / weight, and free slots go to the lowest tag. A user
+    with many queued jobs therefore only gets their weighted share, and a
+    paid user's single job overtakes a long free batch without starving
+    it. When all slots are busy, a waiter of a higher tier asks one large
+    transfer (size >= preempt_size) of a lower tier to pause; the transfer
+    gives its slot up at its next checkpoint and queues again right
+    behind the waiter.
+    """
+    
+    def __init__(self, name: str, slots: int, preempt_size: int):
+        self.name = name
+        self.slots = max(1, slots)
+        self.preempt_size = preempt_size
+        self.running = set()
+        self.paused = 0
+        self.completed = 0
+        self.avg_hold = None
+        self._waiting = []
+        self._virtual = 0.0
+        self._finish = {}
+        self._seq = itertools.count()
+    
+    def _tag(self, job: Job) -> float:
+        tag = max(self._virtual, self._finish.get(job.user_id, 0.0)) + 1 / job.weight
+        self._finish[job.user_id] = tag
+        if len(self._finish) > 10000:
+            # Tags at or behind virtual time carry no credit, forget them
+            self._finish = {user_id: last for user_id, last in self._finish.items() if last > self._virtual}
+        return tag
+    
+    async def acquire(self, job: Job, size: int = 0) -> SlotHold:
+        hold = SlotHold(self, job, size)
+        hold.tag = self._tag(job)
+        if len(self.running) < self.slots and not self.waiting():
+            self._grant(hold)
+            return hold
+        await self._wait(hold)
+        return hold
+    
+    def release(self, hold: SlotHold):
+        if hold in self.running:
+            self.running.discard(hold)
+            elapsed = monotonic() - hold.started
+            self.avg_hold = elapsed if self.avg_hold is None else 0.8 * self.avg_hold + 0.2 * elapsed
+            self.completed += 1
+        self._dispatch()
+    
+    async def pause(self, hold: SlotHold):
+        """Give the slot up for a higher tier and wait to get one back"""
+        async with hold.lock:
+            if not hold.pause_requested or hold not in self.running:
+                return
+            hold.pause_requested = False
+            self.running.discard(hold)
+            self.paused += 1
+            LOGGER(__name__).info(
+                f"Pausing {self.name} of job {hold.job.id} (user {hold.job.user_id}) for higher priority work"
+            )
+            self._dispatch()
+            hold.tag = hold.resume_tag
+            try:
+                await self._wait(hold)
+            finally:
+                self.paused -= 1
+    
+    def queued(self) -> List[SlotHold]:
+        return [hold for _, _, hold in self._waiting if not hold.abandoned]
+    
+    def waiting(self) -> int:
+        return len(self.queued())
+    
+    def eta(self, position: int) -> Optional[float]:
+        """Seconds until the waiter at position (1-based) gets a slot"""
+        if self.avg_hold is None:
+            return None
+        return position * self.avg_hold / self.slots
+    
+    def _grant(self, hold: SlotHold):
+        self.running.add(hold)
+        hold.started = monotonic()
+        self._virtual = max(self._virtual, hold.tag - 1 / hold.job.weight)
+        if hold.preempting is not None:
+            # Got a slot anyway, the paused job may keep running
+            hold.preempting.pause_requested = False
+            hold.preempting = None
+    
+    async def _wait(self, hold: SlotHold):
+        hold.granted = asyncio.get_running_loop().create_future()
+        hold.abandoned = False
+        heapq.heappush(self._waiting, (hold.tag, next(self._seq), hold))
+        self._preempt(hold)
+        try:
+            await hold.granted
+        except asyncio.CancelledError:
+            if hold in self.running:
+                # Granted just before the cancellation arrived
+                self.release(hold)
+            hold.abandoned = True
+            raise
+    
+    def _dispatch(self):
+        while len(self.running) < self.slots and self._waiting:
+            _, _, hold = heapq.heappop(self._waiting)
+            if hold.abandoned or hold.granted.done():
+                continue
+            self._grant(hold)
+            hold.granted.set_result(True)
+    
+    def _preempt(self, waiter: SlotHold):
+        if len(self.running) < self.slots:
+            return
+        victims = [
+            hold for hold in self.running
+            if hold.job.priority < waiter.job.priority and hold.size >= self.preempt_size
+            and not hold.pause_requested
+        ]
+        if not victims:
+            return
+        victim = min(victims, key=lambda hold: (hold.job.priority, -hold.size))
+        victim.pause_requested = True
+        victim.resume_tag = waiter.tag + 1e-9
+        waiter.preempting = victim
+
+
+class TransferScheduler:
+    """Runs download jobs and bounds the download, upload and ffmpeg work in them.
+    
+    submit() starts a job for a user; inside it, slot(kind) waits for a
+    slot of that pool and checkpoint() (called from transfer progress
+    callbacks) pauses the job when higher priority work needs its slot.
+    Work outside any job, such as admin commands, runs as a system job.
+    """
+    
+    def __init__(self, slots: Dict[str, int], preempt_size: int = 50 * 1024 * 1024):
+        self.pools = {name: SlotPool(name, count, preempt_size) for name, count in slots.items()}
+        self.jobs = {}
+        self._system_job = Job(0, 'admin', "system")
+    
+    def submit(self, user_id: int, user_type: str, coro, label: str = "") -> asyncio.Task:
+        """Run coro as a job of the user, returns its task"""
+        job = Job(user_id, user_type, label)
+        context = contextvars.copy_context()
+        context.run(_current_job.set, job)
+        job.task = asyncio.create_task(coro, context=context)
+        self.jobs[job.id] = job
+        job.task.add_done_callback(lambda _: self.jobs.pop(job.id, None))
+        return job.task
+    
+    @asynccontextmanager
+    async def slot(self, kind: str, size: int = 0):
+        """Hold one slot of the pool for the current job"""
+        job = _current_job.get() or self._system_job
+        pool = self.pools[kind]
+        hold = await pool.acquire(job, size)
+        job.holds.append(hold)
+        try:
+            yield hold
+        finally:
+            job.holds.remove(hold)
+            pool.release(hold)
+    
+    async def checkpoint(self):
+        """Pause here if higher priority work asked for one of the job's slots"""
+        job = _current_job.get()
+        if job is None:
+            return
+        for hold in list(job.holds):
+            # A locked hold is paused by another task of the job, wait with it
+            if hold.pause_requested or hold.lock.locked():
+                await hold.pool.pause(hold)
+    
+    def cancel_user(self, user_id: int) -> int:
+        """Cancel every job of a user, returns how many were cancelled"""
+        return self._cancel([job for job in self.jobs.values() if job.user_id == user_id])
+    
+    def cancel_all(self) -> int:
+        return self._cancel(list(self.jobs.values()))
+    
+    @staticmethod
+    def _cancel(jobs: List[Job]) -> int:
+        cancelled = 0
+        for job in jobs:
+            if not job.task.done():
+                job.task.cancel()
+                cancelled += 1
+        return cancelled
+    
+    def snapshot(self) -> Dict:
+        """Pool depths and ETAs and each user's jobs and share of busy slots, for /queue"""
+        pools = {}
+        users = {}
+        busy = 0
+        for name, pool in self.pools.items():
+            queued = pool.waiting()
+            pools[name] = {
+                'slots': pool.slots,
+                'busy': len(pool.running),
+                'queued': queued,
+                'paused': pool.paused,
+                'eta': pool.eta(queued) if queued else 0,
+                'completed': pool.completed
+            }
+            busy += len(pool.running)
+            for hold in pool.running:
+                users.setdefault(hold.job.user_id, {'jobs': 0, 'running': 0, 'queued': 0})['running'] += 1
+            for hold in pool.queued():
+                users.setdefault(hold.job.user_id, {'jobs': 0, 'running': 0, 'queued': 0})['queued'] += 1
+        
+        for job in self.jobs.values():
+            users.setdefault(job.user_id, {'jobs': 0, 'running': 0, 'queued': 0})['jobs'] += 1
+        for stats in users.values():
+            stats['share'] = stats['running'] / busy if busy else 0.0
+        
+        return {'pools': pools, 'users': users, 'jobs': len(self.jobs)}
+
+
+# Initialize the shared scheduler
+transfer_scheduler = TransferScheduler(
+    PyroConf.TRANSFER_SLOTS,
+    preempt_size=PyroConf.PREEMPT_MIN_SIZE_MB * 1024 * 1024
+)
@@ -0,0 +1,821 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import sqlite3
+import threading
+from functools import lru_cache
+from logger import LOGGER
+
+# Bump whenever the DDL in a backend's create_schema changes
+SCHEMA_VERSION = 4
+
+class StorageBackend:
+    """Connection and dialect layer underneath DatabaseManager.
+    
+    DatabaseManager only issues portable SQL with ? placeholders. A backend
+    hands out connections that accept it and owns everything that differs
+    between engines: connection setup, DDL, triggers and schema versioning.
+    """
+    
+    # True when other bot instances share the same database, so in-process
+    # caches must not be trusted for long
+    shared = False
+    auth_cache_ttl = 300
+    
+    def connect(self):
+        """Open or lease a connection for the calling thread"""
+        raise NotImplementedError
+    
+    def release(self, conn):
+        """Give back a connection obtained from connect"""
+        conn.close()
+    
+    def is_usable(self, conn) -> bool:
+        """Whether a connection handed out earlier can still be used"""
+        return True
+    
+    def schema_version(self, conn) -> int:
+        """Get the schema version stored in the database (0 if none)"""
+        raise NotImplementedError
+    
+    def create_schema(self, conn):
+        """Create tables, triggers and indexes and store SCHEMA_VERSION"""
+        raise NotImplementedError
+    
+    def close(self):
+        """Release backend-wide resources such as a connection pool"""
+        pass
+
+
+class SQLiteBackend(StorageBackend):
+    """Local SQLite file, the default backend"""
+    
+    def __init__(self, db_path: str = "bot_database.db", cache_size_kb: int = 16384,
+                 mmap_size: int = 256 * 1024 * 1024, statement_cache_size: int = 256):
+        self.db_path = db_path
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache_size = statement_cache_size
+    
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection and apply the performance pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable across application crashes in WAL mode, only an OS
+        # crash can lose the last transactions
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def schema_version(self, conn: sqlite3.Connection) -> int:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def create_schema(self, conn: sqlite3.Connection):
+        """Create tables, triggers and indexes"""
+        with conn:
+            cursor = conn.cursor()
+            
+            # Users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    user_type TEXT DEFAULT 'free',
+                    subscription_end DATE,
+                    joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_banned BOOLEAN DEFAULT FALSE,
+                    session_string TEXT
+                )
+            ''')
+            
+            # Daily usage tracking
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    date DATE,
+                    files_downloaded INTEGER DEFAULT 0,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id),
+                    UNIQUE(user_id, date)
+                )
+            ''')
+            
+            # Admins table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS admins (
+                    user_id INTEGER PRIMARY KEY,
+                    added_by INTEGER,
+                    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Broadcast history
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message TEXT,
+                    sent_by INTEGER,
+                    sent_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    total_users INTEGER,
+                    successful_sends INTEGER,
+                    FOREIGN KEY (sent_by) REFERENCES users(user_id)
+                )
+            ''')
+            
+            # Incrementally maintained statistics, kept up to date by the
+            # triggers below so /adminstats never scans the users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stat_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Per-day buckets: 'active' counts users by the day of their last
+            # activity, 'paid' counts subscriptions by their end date and
+            # 'downloads' sums files downloaded per day
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stat_buckets (
+                    kind TEXT,
+                    day TEXT,
+                    value INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (kind, day)
+                ) WITHOUT ROWID
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_insert_stats AFTER INSERT ON users
+                BEGIN
+                    INSERT INTO stat_counters (name, value) VALUES ('total_users', 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                    INSERT INTO stat_buckets (kind, day, value)
+                    SELECT 'active', date(NEW.last_activity), 1 WHERE NEW.last_activity IS NOT NULL
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + 1;
+                    INSERT INTO stat_buckets (kind, day, value)
+                    SELECT 'paid', NEW.subscription_end, 1
+                    WHERE NEW.user_type = 'paid' AND NEW.subscription_end IS NOT NULL
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + 1;
+                END
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_delete_stats AFTER DELETE ON users
+                BEGIN
+                    UPDATE stat_counters SET value = value - 1 WHERE name = 'total_users';
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'active' AND day = date(OLD.last_activity);
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'paid' AND day = OLD.subscription_end AND OLD.user_type = 'paid';
+                END
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_activity_stats AFTER UPDATE OF last_activity ON users
+                WHEN date(OLD.last_activity) IS NOT date(NEW.last_activity)
+                BEGIN
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'active' AND day = date(OLD.last_activity);
+                    INSERT INTO stat_buckets (kind, day, value)
+                    SELECT 'active', date(NEW.last_activity), 1 WHERE NEW.last_activity IS NOT NULL
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + 1;
+                END
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS users_paid_stats AFTER UPDATE OF user_type, subscription_end ON users
+                BEGIN
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'paid' AND day = OLD.subscription_end AND OLD.user_type = 'paid';
+                    INSERT INTO stat_buckets (kind, day, value)
+                    SELECT 'paid', NEW.subscription_end, 1
+                    WHERE NEW.user_type = 'paid' AND NEW.subscription_end IS NOT NULL
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + 1;
+                END
+            ''')
+            
+            # Raw usage rows are only deleted once folded into history, so
+            # there is deliberately no delete trigger on daily_usage
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS daily_usage_insert_stats AFTER INSERT ON daily_usage
+                BEGIN
+                    INSERT INTO stat_buckets (kind, day, value) VALUES ('downloads', NEW.date, NEW.files_downloaded)
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + excluded.value;
+                END
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS daily_usage_update_stats AFTER UPDATE OF files_downloaded ON daily_usage
+                BEGIN
+                    INSERT INTO stat_buckets (kind, day, value)
+                    VALUES ('downloads', NEW.date, NEW.files_downloaded - OLD.files_downloaded)
+                    ON CONFLICT(kind, day) DO UPDATE SET value = value + excluded.value;
+                END
+            ''')
+            
+            # Indexes for the queries that still filter the base tables
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_subscription
+                ON users (user_type, subscription_end)
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_usage_date ON daily_usage (date)')
+            
+            # Compact usage history: raw daily_usage rows older than the
+            # retention window are folded into per-user monthly rows and
+            # monthly totals keyed by integer months (YYYYMM)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_monthly (
+                    user_id INTEGER,
+                    month INTEGER,
+                    files_downloaded INTEGER NOT NULL DEFAULT 0,
+                    active_days INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, month)
+                ) WITHOUT ROWID
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_monthly_totals (
+                    month INTEGER PRIMARY KEY,
+                    files_downloaded INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Peer cache of personal user clients (access hashes per account),
+            # so in-memory clients resolve known chats after a restart
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_peers (
+                    owner_id INTEGER,
+                    peer_id INTEGER,
+                    access_hash INTEGER,
+                    type TEXT NOT NULL,
+                    username TEXT,
+                    phone_number TEXT,
+                    updated_at INTEGER NOT NULL,
+                    PRIMARY KEY (owner_id, peer_id)
+                ) WITHOUT ROWID
+            ''')
+            
+            # Bot-side file_ids of delivered media, keyed by the source post,
+            # so repeat requests are re-sent without downloading again
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS file_cache (
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    file_unique_id TEXT,
+                    file_id TEXT NOT NULL,
+                    media_type TEXT NOT NULL,
+                    last_used INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, message_id, file_unique_id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_cache_last_used ON file_cache (last_used)')
+            
+            # Durable download jobs; a row lives from the request until the
+            # job is done, so the unique key also deduplicates re-pasted links
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    source_chat TEXT NOT NULL,
+                    source_message_id INTEGER NOT NULL,
+                    end_message_id INTEGER NOT NULL,
+                    next_message_id INTEGER NOT NULL,
+                    post_url TEXT NOT NULL,
+                    request_chat_id INTEGER NOT NULL,
+                    request_message_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at INTEGER NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires INTEGER,
+                    last_error TEXT,
+                    created_at INTEGER NOT NULL,
+                    UNIQUE (user_id, source_chat, source_message_id, end_message_id)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)')
+            
+            # Existing databases get their counters built once
+            cursor.execute("SELECT 1 FROM stat_counters WHERE name = 'total_users'")
+            if cursor.fetchone() is None:
+                self._rebuild_stats(cursor)
+            
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+            LOGGER(__name__).info("Database initialized successfully")
+    
+    def _rebuild_stats(self, cursor: sqlite3.Cursor):
+        """Recompute the statistics tables from the base tables"""
+        cursor.execute('DELETE FROM stat_counters')
+        cursor.execute('DELETE FROM stat_buckets')
+        cursor.execute('''
+            INSERT INTO stat_counters (name, value)
+            SELECT 'total_users', COUNT(*) FROM users
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'active', date(last_activity), COUNT(*) FROM users
+            WHERE last_activity IS NOT NULL
+            GROUP BY date(last_activity)
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'paid', subscription_end, COUNT(*) FROM users
+            WHERE user_type = 'paid' AND subscription_end IS NOT NULL
+            GROUP BY subscription_end
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'downloads', date, SUM(files_downloaded) FROM daily_usage
+            GROUP BY date
+        ''')
+        LOGGER(__name__).info("Statistics counters rebuilt")
+
+
+@lru_cache(maxsize=512)
+def _pyformat(sql: str) -> str:
+    """Translate ? placeholders into the %s style psycopg2 expects"""
+    return sql.replace('%', '%%').replace('?', '%s')
+
+
+class _PostgresCursor:
+    """psycopg2 cursor that accepts ? placeholders"""
+    
+    def __init__(self, cursor, execute_batch):
+        self._cursor = cursor
+        self._execute_batch = execute_batch
+    
+    def execute(self, sql: str, params=()):
+        self._cursor.execute(_pyformat(sql), tuple(params))
+        return self
+    
+    def executemany(self, sql: str, seq_of_params):
+        # execute_batch sends pages of statements per round trip instead of
+        # one round trip per row
+        self._execute_batch(self._cursor, _pyformat(sql), list(seq_of_params))
+        return self
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _PostgresConnection:
+    """psycopg2 connection with the sqlite3 calls DatabaseManager relies on.
+    
+    DatabaseManager keeps one of these per thread, but a pooled psycopg2
+    connection is only leased while a `with` block runs and goes back to
+    the pool when the outermost block ends. Idle threads such as the
+    flusher therefore hold no server connection between units of work.
+    """
+    
+    def __init__(self, backend):
+        self._backend = backend
+        self._depth = 0
+        self.raw = None
+    
+    def _leased(self):
+        if self.raw is None:
+            raise RuntimeError("PostgreSQL connections are only usable inside a with block")
+        return self.raw
+    
+    def cursor(self) -> _PostgresCursor:
+        return _PostgresCursor(self._leased().cursor(), self._backend._execute_batch)
+    
+    def execute(self, sql: str, params=()) -> _PostgresCursor:
+        return self.cursor().execute(sql, params)
+    
+    def commit(self):
+        self._leased().commit()
+    
+    def rollback(self):
+        self._leased().rollback()
+    
+    def close(self):
+        raw, self.raw = self.raw, None
+        self._depth = 0
+        if raw is not None:
+            self._backend._put(raw)
+    
+    def __enter__(self):
+        # Nested blocks share the lease of the outermost one
+        if self._depth == 0:
+            self.raw = self._backend._lease()
+        self._depth += 1
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Same as sqlite3: commit on success, roll back on error. The
+        # outermost block ends the transaction and gives the connection back
+        self._depth -= 1
+        if self._depth:
+            return False
+        raw, self.raw = self.raw, None
+        try:
+            if raw.closed:
+                return False
+            if exc_type is None:
+                raw.commit()
+            else:
+                raw.rollback()
+        finally:
+            self._backend._put(raw)
+        return False
+
+
+class PostgresBackend(StorageBackend):
+    """PostgreSQL server shared by any number of bot instances.
+    
+    Connections come from a thread-safe pool and are leased per unit of
+    work; psycopg2 is only imported when this backend is selected.
+    """
+    
+    shared = True
+    auth_cache_ttl = 30
+    
+    # pg_advisory_xact_lock key that serializes schema creation between
+    # instances starting at the same time
+    SCHEMA_LOCK_KEY = 726170
+    
+    def __init__(self, dsn: str, min_connections: int = 1, max_connections: int = 10):
+        try:
+            from psycopg2 import pool
+            from psycopg2.extras import execute_batch
+        except ImportError as e:
+            raise RuntimeError("PostgreSQL storage requires psycopg2 (pip install psycopg2-binary)") from e
+        
+        self.dsn = dsn
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self._pool_class = pool.ThreadedConnectionPool
+        self._execute_batch = execute_batch
+        self._pool = None
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool raises once every connection is out, so
+        # callers wait here for one to come back instead
+        self._slots = threading.BoundedSemaphore(max_connections)
+    
+    def _get_pool(self):
+        # Created on first use so importing the bot never opens a socket
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._pool_class(self.min_connections, self.max_connections, self.dsn)
+            return self._pool
+    
+    def connect(self) -> _PostgresConnection:
+        return _PostgresConnection(self)
+    
+    def release(self, conn: _PostgresConnection):
+        conn.close()
+    
+    def _lease(self):
+        """Take a live connection from the pool for one unit of work"""
+        self._slots.acquire()
+        try:
+            pool = self._get_pool()
+            raw = pool.getconn()
+            if raw.closed:
+                # Dropped by the server while it sat in the pool
+                pool.putconn(raw, close=True)
+                raw = pool.getconn()
+            raw.autocommit = False
+            return raw
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def _put(self, raw):
+        try:
+            with self._lock:
+                pool = self._pool
+            if pool is None or pool.closed:
+                raw.close()
+            else:
+                pool.putconn(raw, close=bool(raw.closed))
+        finally:
+            self._slots.release()
+    
+    def schema_version(self, conn: _PostgresConnection) -> int:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT to_regclass('schema_meta') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                return 0
+            cursor.execute("SELECT value FROM schema_meta WHERE name = 'user_version'")
+            row = cursor.fetchone()
+            return row[0] if row else 0
+    
+    def create_schema(self, conn: _PostgresConnection):
+        """Create tables, trigger functions, triggers and indexes"""
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_advisory_xact_lock(?)', (self.SCHEMA_LOCK_KEY,))
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_meta (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("SELECT value FROM schema_meta WHERE name = 'user_version'")
+            row = cursor.fetchone()
+            if row and row[0] == SCHEMA_VERSION:
+                # Another instance created it while we waited for the lock
+                return
+            
+            # Same layout as the SQLite schema. Dates stay YYYY-MM-DD text and
+            # foreign keys are left out, matching what SQLite enforces
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    user_type TEXT DEFAULT 'free',
+                    subscription_end TEXT,
+                    joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_banned BOOLEAN DEFAULT FALSE,
+                    session_string TEXT
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    date TEXT,
+                    files_downloaded INTEGER DEFAULT 0,
+                    UNIQUE(user_id, date)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS admins (
+                    user_id BIGINT PRIMARY KEY,
+                    added_by BIGINT,
+                    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id BIGSERIAL PRIMARY KEY,
+                    message TEXT,
+                    sent_by BIGINT,
+                    sent_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    total_users INTEGER,
+                    successful_sends INTEGER
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stat_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stat_buckets (
+                    kind TEXT,
+                    day TEXT,
+                    value INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (kind, day)
+                )
+            ''')
+            
+            # Trigger functions mirroring the SQLite triggers
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION users_insert_stats() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO stat_counters (name, value) VALUES ('total_users', 1)
+                    ON CONFLICT (name) DO UPDATE SET value = stat_counters.value + 1;
+                    IF NEW.last_activity IS NOT NULL THEN
+                        INSERT INTO stat_buckets (kind, day, value)
+                        VALUES ('active', NEW.last_activity::date::text, 1)
+                        ON CONFLICT (kind, day) DO UPDATE SET value = stat_buckets.value + 1;
+                    END IF;
+                    IF NEW.user_type = 'paid' AND NEW.subscription_end IS NOT NULL THEN
+                        INSERT INTO stat_buckets (kind, day, value)
+                        VALUES ('paid', NEW.subscription_end, 1)
+                        ON CONFLICT (kind, day) DO UPDATE SET value = stat_buckets.value + 1;
+                    END IF;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION users_delete_stats() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE stat_counters SET value = value - 1 WHERE name = 'total_users';
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'active' AND day = OLD.last_activity::date::text;
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'paid' AND day = OLD.subscription_end AND OLD.user_type = 'paid';
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION users_activity_stats() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'active' AND day = OLD.last_activity::date::text;
+                    IF NEW.last_activity IS NOT NULL THEN
+                        INSERT INTO stat_buckets (kind, day, value)
+                        VALUES ('active', NEW.last_activity::date::text, 1)
+                        ON CONFLICT (kind, day) DO UPDATE SET value = stat_buckets.value + 1;
+                    END IF;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION users_paid_stats() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE stat_buckets SET value = value - 1
+                    WHERE kind = 'paid' AND day = OLD.subscription_end AND OLD.user_type = 'paid';
+                    IF NEW.user_type = 'paid' AND NEW.subscription_end IS NOT NULL THEN
+                        INSERT INTO stat_buckets (kind, day, value)
+                        VALUES ('paid', NEW.subscription_end, 1)
+                        ON CONFLICT (kind, day) DO UPDATE SET value = stat_buckets.value + 1;
+                    END IF;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION daily_usage_stats() RETURNS trigger AS $$
+                DECLARE
+                    delta INTEGER := NEW.files_downloaded;
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        delta := NEW.files_downloaded - OLD.files_downloaded;
+                    END IF;
+                    INSERT INTO stat_buckets (kind, day, value) VALUES ('downloads', NEW.date, delta)
+                    ON CONFLICT (kind, day) DO UPDATE SET value = stat_buckets.value + excluded.value;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            # Raw usage rows are only deleted once folded into history, so
+            # there is deliberately no delete trigger on daily_usage
+            triggers = (
+                ('users_insert_stats', 'INSERT', 'users', '', 'users_insert_stats'),
+                ('users_delete_stats', 'DELETE', 'users', '', 'users_delete_stats'),
+                ('users_activity_stats', 'UPDATE OF last_activity', 'users',
+                 'WHEN (OLD.last_activity::date IS DISTINCT FROM NEW.last_activity::date)',
+                 'users_activity_stats'),
+                ('users_paid_stats', 'UPDATE OF user_type, subscription_end', 'users', '', 'users_paid_stats'),
+                ('daily_usage_insert_stats', 'INSERT', 'daily_usage', '', 'daily_usage_stats'),
+                ('daily_usage_update_stats', 'UPDATE OF files_downloaded', 'daily_usage', '', 'daily_usage_stats')
+            )
+            for name, event, table, condition, function in triggers:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+                cursor.execute(f'''
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    FOR EACH ROW {condition} EXECUTE FUNCTION {function}()
+                ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_subscription
+                ON users (user_type, subscription_end)
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_usage_date ON daily_usage (date)')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_monthly (
+                    user_id BIGINT,
+                    month INTEGER,
+                    files_downloaded INTEGER NOT NULL DEFAULT 0,
+                    active_days INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, month)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_monthly_totals (
+                    month INTEGER PRIMARY KEY,
+                    files_downloaded INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_peers (
+                    owner_id BIGINT,
+                    peer_id BIGINT,
+                    access_hash BIGINT,
+                    type TEXT NOT NULL,
+                    username TEXT,
+                    phone_number TEXT,
+                    updated_at BIGINT NOT NULL,
+                    PRIMARY KEY (owner_id, peer_id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS file_cache (
+                    chat_id BIGINT,
+                    message_id BIGINT,
+                    file_unique_id TEXT,
+                    file_id TEXT NOT NULL,
+                    media_type TEXT NOT NULL,
+                    last_used BIGINT NOT NULL,
+                    PRIMARY KEY (chat_id, message_id, file_unique_id)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_cache_last_used ON file_cache (last_used)')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    source_chat TEXT NOT NULL,
+                    source_message_id BIGINT NOT NULL,
+                    end_message_id BIGINT NOT NULL,
+                    next_message_id BIGINT NOT NULL,
+                    post_url TEXT NOT NULL,
+                    request_chat_id BIGINT NOT NULL,
+                    request_message_id BIGINT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at BIGINT NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires BIGINT,
+                    last_error TEXT,
+                    created_at BIGINT NOT NULL,
+                    UNIQUE (user_id, source_chat, source_message_id, end_message_id)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)')
+            
+            cursor.execute("SELECT 1 FROM stat_counters WHERE name = 'total_users'")
+            if cursor.fetchone() is None:
+                self._rebuild_stats(cursor)
+            
+            cursor.execute('''
+                INSERT INTO schema_meta (name, value) VALUES ('user_version', ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            ''', (SCHEMA_VERSION,))
+            LOGGER(__name__).info("Database initialized successfully")
+    
+    def _rebuild_stats(self, cursor: _PostgresCursor):
+        """Recompute the statistics tables from the base tables"""
+        cursor.execute('DELETE FROM stat_counters')
+        cursor.execute('DELETE FROM stat_buckets')
+        cursor.execute('''
+            INSERT INTO stat_counters (name, value)
+            SELECT 'total_users', COUNT(*) FROM users
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'active', last_activity::date::text, COUNT(*) FROM users
+            WHERE last_activity IS NOT NULL
+            GROUP BY last_activity::date
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'paid', subscription_end, COUNT(*) FROM users
+            WHERE user_type = 'paid' AND subscription_end IS NOT NULL
+            GROUP BY subscription_end
+        ''')
+        cursor.execute('''
+            INSERT INTO stat_buckets (kind, day, value)
+            SELECT 'downloads', date, SUM(files_downloaded) FROM daily_usage
+            GROUP BY date
+        ''')
+        LOGGER(__name__).info("Statistics counters rebuilt")
+    
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and not pool.closed:
+            pool.closeall()
+
+
+def create_backend(database_url: str = "") -> StorageBackend:
+    """Pick a backend from a DATABASE_URL (empty means the local SQLite file)"""
+    if not database_url:
+        return SQLiteBackend()
+    if database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresBackend(database_url)
+    if database_url.startswith("sqlite:///"):
+        return SQLiteBackend(database_url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported DATABASE_URL scheme: {database_url.split(':', 1)[0]}")
@@ -0,0 +1,8 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import os
+import sys
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
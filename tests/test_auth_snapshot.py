@@ -0,0 +1,61 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import access_control
+from benchmark import CountingDatabaseManager, count_decorator_queries
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = CountingDatabaseManager(str(tmp_path / "count.db"))
+    original = access_control.db
+    yield manager
+    access_control.db = original
+    manager.close()
+
+
+def test_known_user_costs_one_query_per_message(manager):
+    # The registration upsert is buffered, the snapshot is the only read
+    assert asyncio.run(count_decorator_queries(manager)) == 1, manager.statements
+
+
+def test_new_user_costs_at_most_two_queries(manager):
+    access_control.db = manager
+    # Leave the one-off schema and counter setup out of the count
+    manager.get_connection()
+    manager.reset_statements()
+
+    async def reply(*args, **kwargs):
+        pass
+
+    @access_control.check_download_limit
+    async def handler(client, message):
+        return True
+
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=7, username="user7", first_name="First", last_name="Last"),
+        reply=reply
+    )
+    assert asyncio.run(handler(None, message))
+    assert len(manager.statements) <= 2, manager.statements
+
+
+def test_cached_snapshot_skips_the_join(manager):
+    manager.add_user(8, "user8")
+    manager.set_user_type(8, 'paid')
+    first = manager.get_auth_snapshot(8)
+    assert first['user_type'] == 'paid'
+
+    manager.reset_statements()
+    cached = manager.get_auth_snapshot(8)
+    # Paid users have no daily limit, the cached record answers alone
+    assert manager.statements == []
+    assert cached['user_type'] == 'paid' and not cached['is_banned']
+
+    manager.ban_user(8)
+    assert manager.get_auth_snapshot(8)['is_banned']
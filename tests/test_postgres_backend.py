@@ -0,0 +1,81 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import os
+import threading
+
+import pytest
+
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL.startswith(("postgres://", "postgresql://")),
+    reason="set DATABASE_URL to a PostgreSQL database to run these tests"
+)
+
+# Far above real Telegram ids, so the tests never touch a real user
+USER_ID = 9_000_000_001
+
+
+@pytest.fixture
+def manager():
+    pytest.importorskip("psycopg2")
+    from database import DatabaseManager
+    from storage import PostgresBackend
+
+    manager = DatabaseManager(backend=PostgresBackend(DATABASE_URL, max_connections=4))
+    yield manager
+    with manager.get_connection() as conn:
+        conn.execute('DELETE FROM daily_usage WHERE user_id = ?', (USER_ID,))
+        conn.execute('DELETE FROM users WHERE user_id = ?', (USER_ID,))
+    manager.close()
+
+
+def checked_out(manager) -> int:
+    return len(manager.backend._get_pool()._used)
+
+
+def test_round_trip(manager):
+    assert manager.add_user(USER_ID, "pg_user", "First", "Last")
+    user = manager.get_user(USER_ID)
+    assert user["username"] == "pg_user"
+    assert user["user_type"] == "free"
+
+    assert manager.increment_usage(USER_ID, 2)
+    assert manager.flush_writes()
+    assert manager.get_daily_usage(USER_ID) == 2
+
+
+def test_connections_go_back_to_the_pool(manager):
+    manager.add_user(USER_ID, "pg_user", "First", "Last")
+    assert checked_out(manager) == 0
+
+    # More threads than the pool holds, each keeping its handle afterwards
+    errors = []
+
+    def read():
+        try:
+            for _ in range(5):
+                assert manager.get_user(USER_ID) is not None
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert checked_out(manager) == 0
+
+
+def test_failed_unit_of_work_rolls_back(manager):
+    manager.add_user(USER_ID, "pg_user", "First", "Last")
+    with pytest.raises(RuntimeError):
+        with manager.get_connection() as conn:
+            conn.execute('UPDATE users SET username = ? WHERE user_id = ?', ("changed", USER_ID))
+            raise RuntimeError("abort")
+
+    assert manager.get_user(USER_ID)["username"] == "pg_user"
+    assert checked_out(manager) == 0
@@ -0,0 +1,51 @@
+# Copyright (C) @Wolfy004
+# Channel: https://t.me/Wolfy004
+
+import pytest
+
+from database import DatabaseManager, WriteBehindBuffer
+
+KEY = (7, "2026-01-01")
+
+
+def test_drained_usage_stays_visible_until_settled():
+    buffer = WriteBehindBuffer()
+    buffer.add_usage(*KEY, 3)
+
+    _, usage, _ = buffer.drain()
+    # The flush has not committed yet, quota reads must still see it
+    assert buffer.pending_usage(*KEY) == 3
+
+    buffer.add_usage(*KEY, 1)
+    assert buffer.pending_usage(*KEY) == 4
+
+    buffer.settle(usage)
+    assert buffer.pending_usage(*KEY) == 1
+
+
+def test_restored_usage_is_counted_once():
+    buffer = WriteBehindBuffer()
+    buffer.add_usage(*KEY, 2)
+
+    profiles, usage, peers = buffer.drain()
+    buffer.restore(profiles, usage, peers)
+    assert buffer.pending_usage(*KEY) == 2
+
+    _, usage, _ = buffer.drain()
+    assert usage == {KEY: 2}
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = DatabaseManager(str(tmp_path / "usage.db"))
+    yield manager
+    manager.close()
+
+
+def test_usage_is_counted_once_after_a_flush(manager):
+    manager.add_user(7, "user7")
+    manager.increment_usage(7, 2)
+    assert manager.get_daily_usage(7) == 2
+    assert manager.flush_writes()
+    assert manager.get_daily_usage(7) == 2
+    assert manager.get_auth_snapshot(7)["daily_usage"] == 2